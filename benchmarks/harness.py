@@ -0,0 +1,291 @@
+""" Benchmark harness sweeping transports, encoders, authentication,
+payload sizes and concurrency
+
+Reports throughput and latency percentiles for each combination and can
+write them as JSON, to be compared against a stored baseline:
+
+    $ python benchmarks/harness.py --output baseline.json
+    $ python benchmarks/harness.py --baseline baseline.json
+
+which exits with status 1 when a throughput or latency percentile got
+worse than the baseline by more than --threshold.
+"""
+
+import sys
+import time
+import argparse
+import itertools
+import threading
+import multiprocessing
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+import zmq
+
+from zmqservice import Responder, Requester, Publisher, Subscriber
+from zmqservice import Authenticator
+from zmqservice.encoder import JSONEncoder, MsgPackEncoder, PickleEncoder
+from zmqservice.metrics import Histogram, clock
+
+import util
+
+ENCODERS = {
+    'pickle': PickleEncoder,
+    'msgpack': MsgPackEncoder,
+    'json': JSONEncoder,
+}
+
+TRANSPORTS = ('inproc', 'ipc', 'tcp')
+
+# A result is identified by these parameters
+KEYS = ('pattern', 'transport', 'encoder', 'auth', 'size', 'concurrency')
+
+COLUMNS = (
+    ('PATTERN', 'pattern', 8),
+    ('TRANSPORT', 'transport', 10),
+    ('ENCODER', 'encoder', 9),
+    ('AUTH', 'auth', 6),
+    ('SIZE', 'size', 8),
+    ('CONC', 'concurrency', 5),
+    ('MSG/S', 'throughput', 12),
+    ('P50 US', 'p50', 10),
+    ('P90 US', 'p90', 10),
+    ('P99 US', 'p99', 10),
+    ('P99.9 US', 'p99.9', 10),
+)
+
+SECRET = 'bench-secret'
+
+# Messages exchanged before measuring, per client
+WARMUP = 100
+
+# Time given to subscribers to connect before publishing (slow joiners)
+JOIN_DELAY = 0.5
+
+# Subscribers stop waiting for messages dropped by the publisher after
+RECV_TIMEOUT = 2000
+
+
+class Case(object):
+    """ One combination of benchmark parameters """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, pattern, transport, encoder, auth, size,
+                 concurrency, n, index):
+        self.pattern = pattern
+        self.transport = transport
+        self.encoder = encoder
+        self.auth = auth
+        self.size = size
+        self.concurrency = concurrency
+        self.n = n
+        self.address = address(transport, index)
+
+    def options(self):
+        """ Return the keyword arguments of the endpoints """
+        return {
+            'encoder': ENCODERS[self.encoder](),
+            'authenticator':
+                Authenticator(SECRET) if self.auth == 'on' else None,
+        }
+
+    def payload(self):
+        """ Return a payload of about `size` bytes which every encoder
+        supports """
+        return 'x' * self.size
+
+    def describe(self):
+        """ Return the parameters identifying the result of this case """
+        return dict((key, getattr(self, key)) for key in KEYS)
+
+    def spawn(self, target, *args):
+        """ Run `target` next to the clients: in a thread for inproc (which
+        cannot cross processes), in another process otherwise """
+        if self.transport == 'inproc':
+            runner = threading.Thread(target=target, args=args)
+            runner.daemon = True
+        else:
+            runner = multiprocessing.Process(target=target, args=args)
+        runner.start()
+        return runner
+
+
+def address(transport, index):
+    """ Return a fresh address for the `index`th case on `transport` """
+    if transport == 'inproc':
+        return 'inproc://bench-{}'.format(index)
+    if transport == 'ipc':
+        return 'ipc:///tmp/zmqservice-bench-{}.sock'.format(index)
+    return 'tcp://127.0.0.1:{}'.format(15000 + index)
+
+
+def serve(case):
+    """ Answer the warmup and measured requests of all clients """
+    service = Responder(case.address, **case.options())
+    service.register('echo', lambda payload: payload)
+    for _ in range((case.n + WARMUP) * case.concurrency):
+        service.process()
+    service.close()
+
+
+def bench_reqrep(case):
+    """ Each of `concurrency` clients makes n calls, one at a time, and
+    records the round trip time of each """
+    service = case.spawn(serve, case)
+    histograms = [Histogram() for _ in range(case.concurrency)]
+    spans = []
+    payload = case.payload()
+
+    def client(histogram):
+        requester = Requester(case.address, **case.options())
+        for _ in range(WARMUP):
+            requester.call('echo', payload)
+        first = clock()
+        for _ in range(case.n):
+            started = clock()
+            requester.call('echo', payload)
+            histogram.record(clock() - started)
+        spans.append((first, clock()))
+        requester.close()
+
+    run_threads(client, histograms)
+    service.join()
+    # Throughput over the measured calls only, without warming up
+    duration = max(end for _, end in spans) - min(start for start, _ in spans)
+    return util.latency_stats(
+        util.merge(histograms), case.n * case.concurrency, duration)
+
+
+def subscribe(case, results):
+    """ Receive messages until the publishers go quiet and put the
+    latency stats in the `results` queue """
+    subscriber = Subscriber(
+        case.address, bind=True, timeouts=(None, RECV_TIMEOUT),
+        **case.options())
+    histogram = Histogram()
+    received = []
+
+    def record(tag, message):
+        sent, _ = message
+        now = time.time()
+        histogram.record(now - sent)
+        received.append(now)
+
+    subscriber.subscribe('bench', record)
+    try:
+        while True:
+            subscriber.process()
+    except zmq.Again:
+        pass
+    subscriber.close()
+
+    duration = received[-1] - received[0] if received else 0
+    results.put(util.latency_stats(histogram, len(received), duration))
+
+
+def bench_pubsub(case):
+    """ Each of `concurrency` publishers sends n messages as fast as it
+    can; latency is measured from publish to delivery (on one clock, as
+    both ends run on the same host) """
+    results = make_queue(case)
+    subscriber = case.spawn(subscribe, case, results)
+    time.sleep(JOIN_DELAY)
+    payload = case.payload()
+
+    def publisher(_):
+        client = Publisher(case.address, bind=False, **case.options())
+        time.sleep(JOIN_DELAY)
+        for _ in range(case.n):
+            client.publish('bench', (time.time(), payload))
+        client.close()
+
+    run_threads(publisher, range(case.concurrency))
+    stats = results.get()
+    subscriber.join()
+    stats['dropped'] = case.n * case.concurrency - stats['count']
+    return stats
+
+
+def make_queue(case):
+    """ Return a queue to get results back from `Case.spawn` """
+    if case.transport == 'inproc':
+        return Queue.Queue()
+    return multiprocessing.Queue()
+
+
+def run_threads(target, items):
+    """ Run `target(item)` in a thread for each item and wait for all """
+    threads = [threading.Thread(target=target, args=(item,))
+               for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+BENCHMARKS = {
+    'reqrep': bench_reqrep,
+    'pubsub': bench_pubsub,
+}
+
+
+def parse_args(argv):
+    """ Parse the command line; list options take several values """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pattern', nargs='+', default=['reqrep', 'pubsub'],
+                        choices=sorted(BENCHMARKS))
+    parser.add_argument('--transport', nargs='+', default=list(TRANSPORTS),
+                        choices=TRANSPORTS)
+    parser.add_argument('--encoder', nargs='+', default=['pickle'],
+                        choices=sorted(ENCODERS))
+    parser.add_argument('--auth', nargs='+', default=['off', 'on'],
+                        choices=['off', 'on'])
+    parser.add_argument('--size', nargs='+', type=int, default=[64, 4096],
+                        help='payload sizes in bytes')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1],
+                        help='number of clients (or publishers)')
+    parser.add_argument('-n', type=int, default=5000,
+                        help='messages per client')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='compare results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='regression threshold as a fraction '
+                             '(default: 0.1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    combinations = itertools.product(
+        args.pattern, args.transport, args.encoder, args.auth, args.size,
+        args.concurrency)
+
+    results = []
+    for index, (pattern, transport, encoder, auth, size, concurrency) in \
+            enumerate(combinations):
+        case = Case(pattern, transport, encoder, auth, size,
+                    concurrency, args.n, index)
+        result = case.describe()
+        result.update(BENCHMARKS[pattern](case))
+        results.append(result)
+        if index == 0:
+            util.print_header(COLUMNS)
+        util.print_row(result, COLUMNS)
+
+    if args.output:
+        util.write_results(args.output, results, n=args.n)
+    if args.baseline:
+        regressions = util.compare(
+            results, util.read_results(args.baseline), KEYS,
+            args.threshold)
+        util.print_regressions(regressions, KEYS)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+""" Open-loop load generator for a Responder
+
+Requests are sent on a fixed schedule at the target rate, whether or not
+earlier replies have arrived, so queueing delay shows up in the results
+instead of silently slowing the sender down (coordinated omission).
+Latency is measured from the time each request was meant to be sent.
+
+The rate is stepped up until the service saturates: when the achieved
+rate falls behind the offered rate, or when p99 exceeds --slo.
+
+    $ PYTHONPATH=. python benchmarks/loadgen.py --rates 1000 2000 5000
+"""
+
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+
+from zmqservice import Responder, ConcurrentResponder, PipelinedRequester
+from zmqservice.metrics import Histogram, clock
+
+import util
+
+COLUMNS = (
+    ('OFFERED', 'offered', 10),
+    ('ACHIEVED', 'throughput', 10),
+    ('P50 US', 'p50', 13),
+    ('P90 US', 'p90', 13),
+    ('P99 US', 'p99', 13),
+    ('P99.9 US', 'p99.9', 13),
+    ('MAX US', 'max', 13),
+    ('RAW P99 US', 'raw_p99', 13),
+    ('LOST', 'lost', 8),
+)
+
+# An offered rate is sustained when at least this share of it is achieved
+SUSTAINED = 0.95
+
+# Sleeping is not precise enough below this many seconds, spin instead
+SPIN = 0.0002
+
+
+def work(service_time):
+    """ Busy the service for `service_time` seconds """
+    deadline = clock() + service_time
+    while clock() < deadline:
+        pass
+    return True
+
+
+def serve(address, workers, service_time):
+    """ Run a Responder whose `work` method takes `service_time` """
+    if workers:
+        service = ConcurrentResponder(address, workers=workers)
+    else:
+        service = Responder(address)
+    service.register('work', lambda: work(service_time))
+    service.start()
+
+
+def wait_until(deadline):
+    """ Sleep, then spin, until `deadline` (a clock() value) """
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return
+        if remaining > SPIN:
+            time.sleep(remaining - SPIN)
+
+
+def run_step(requester, rate, duration, timeout):
+    """ Offer `rate` requests per second for `duration` seconds
+
+    Returns the latency stats, from the intended send times, plus the
+    99th percentile measured from the actual send times ('raw_p99'),
+    which is what a closed-loop benchmark would report
+    """
+    total = int(rate * duration)
+    histogram = Histogram()
+    raw = Histogram()
+    done = threading.Event()
+    completed = []
+    lock = threading.Lock()
+
+    def finished(intended, sent):
+        def callback(future):
+            now = clock()
+            # Callbacks run on the requester I/O thread, but a future which
+            # is already done runs its callback right away on the sender
+            with lock:
+                histogram.record(now - intended)
+                raw.record(now - sent)
+                completed.append(now)
+                if len(completed) == total:
+                    done.set()
+        return callback
+
+    started = clock()
+    for index in range(total):
+        intended = started + index / float(rate)
+        wait_until(intended)
+        sent = clock()
+        future = requester.call_async('work')
+        future.add_done_callback(finished(intended, sent))
+
+    done.wait(timeout)
+    with lock:
+        stats = util.latency_stats(
+            histogram, len(completed),
+            (completed[-1] if completed else clock()) - started)
+        stats['raw_p99'] = raw.percentile(99)
+        if stats['raw_p99'] is not None:
+            stats['raw_p99'] *= 1e6
+    stats['offered'] = float(rate)
+    # Requests without a reply within `timeout`
+    stats['lost'] = total - stats['count']
+    return stats
+
+
+def parse_args(argv):
+    """ Parse the command line """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--address',
+                        default='ipc:///tmp/zmqservice-loadgen.sock')
+    parser.add_argument('--rates', nargs='+', type=float,
+                        default=[1000, 2000, 4000, 8000, 16000, 32000],
+                        help='offered rates (requests/s), in order')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds per rate (default: 5)')
+    parser.add_argument('--service-time', type=float, default=50.0,
+                        help='microseconds each request keeps the '
+                             'service busy (default: 50)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='use a ConcurrentResponder with this many '
+                             'workers (default: a Responder)')
+    parser.add_argument('--slo', type=float,
+                        help='stop once p99 exceeds this many '
+                             'microseconds')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds to wait for the replies of a step '
+                             '(default: 10)')
+    parser.add_argument('--all', action='store_true',
+                        help='keep going after saturation')
+    parser.add_argument('--output', help='write results to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    service = multiprocessing.Process(
+        target=serve,
+        args=(args.address, args.workers, args.service_time / 1e6))
+    service.daemon = True
+    service.start()
+
+    requester = PipelinedRequester(args.address, max_outstanding=1000000)
+    # Warm up and wait for the service to be ready
+    requester.call('work')
+
+    results = []
+    saturation = None
+    util.print_header(COLUMNS)
+    try:
+        for rate in args.rates:
+            stats = run_step(requester, rate, args.duration, args.timeout)
+            results.append(stats)
+            util.print_row(stats, COLUMNS)
+
+            saturated = stats['lost'] or \
+                stats['throughput'] < SUSTAINED * rate or \
+                (args.slo and stats['p99'] > args.slo)
+            if saturated and saturation is None:
+                saturation = rate
+                if not args.all:
+                    break
+    finally:
+        requester.close()
+        service.terminate()
+
+    if saturation is None:
+        print('Not saturated up to {:,.0f} requests/s'.format(
+            args.rates[-1]))
+    else:
+        print('Saturated at {:,.0f} requests/s'.format(saturation))
+    if args.output:
+        util.write_results(
+            args.output, results, saturation=saturation,
+            service_time=args.service_time, workers=args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
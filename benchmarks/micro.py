@@ -0,0 +1,318 @@
+""" Micro-benchmarks of each processing stage of an Endpoint
+
+Stages run on their own, without sockets: encoders, the authenticator,
+subscription parsing, building requests, and a full send/receive pass
+over an in-memory stand-in transport. Each reports the best time per
+operation (ns/op) and, on Python 3, the bytes allocated per operation:
+
+    $ PYTHONPATH=. python benchmarks/micro.py --only encode --output micro.json
+    $ PYTHONPATH=. python benchmarks/micro.py --baseline micro.json
+"""
+
+import gc
+import sys
+import argparse
+import itertools
+import collections
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from zmqservice import Requester, Responder, Subscriber, Authenticator
+from zmqservice.encoder import (
+    JSONEncoder, MsgPackEncoder, PickleEncoder, CompressedEncoder,
+    TaggedEncoder, NDArrayEncoder)
+from zmqservice.metrics import clock
+
+import util
+
+KEYS = ('stage', 'case')
+
+COLUMNS = (
+    ('STAGE', 'stage', 28),
+    ('CASE', 'case', 32),
+    ('NS/OP', 'ns', 14),
+    ('ALLOC B/OP', 'alloc', 14),
+)
+
+# Compared against a baseline (lower is better)
+COMPARED = (('ns', False), ('alloc', False))
+
+SECRET = 'bench-secret'
+
+
+class MemorySocket(object):
+    """ A stand-in for a zmq socket which keeps sent messages in memory
+
+    An endpoint built on it receives the messages it sent, so whole
+    send/receive passes run without a network or zmq.
+    """
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.closed = False
+        self.linger = 0
+
+    def bind(self, address):
+        pass
+
+    connect = unbind = bind
+
+    def setsockopt(self, option, value):
+        pass
+
+    def getsockopt(self, option):
+        return -1
+
+    def send(self, data, flags=0, copy=True):
+        self.messages.append([data])
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        self.messages.append(list(frames))
+
+    def recv(self, flags=0):
+        return self.messages.popleft()[0]
+
+    def recv_multipart(self, flags=0, copy=True):
+        return self.messages.popleft()
+
+    def close(self):
+        self.closed = True
+
+
+def payloads():
+    """ Return realistic (name, payload) pairs which every encoder
+    supports """
+    record = {'id': 12345, 'name': 'sensor-12', 'active': True,
+              'value': 21.5, 'tags': ['a', 'b', 'c']}
+    return [
+        ('small', record),
+        ('records-100', [dict(record, id=i) for i in range(100)]),
+        ('text-64k', 'x' * 65536),
+    ]
+
+
+def encoders():
+    """ Return (name, encoder) pairs of the encoders to benchmark """
+    pairs = [
+        ('json', JSONEncoder()),
+        ('msgpack', MsgPackEncoder()),
+        ('pickle', PickleEncoder()),
+        ('tagged-msgpack', TaggedEncoder(MsgPackEncoder())),
+        ('zlib-pickle', CompressedEncoder(PickleEncoder())),
+    ]
+    return pairs
+
+
+def bench_encoders():
+    """ Encode and decode each payload with each encoder """
+    for name, encoder in encoders():
+        for shape, payload in payloads():
+            encoded = encoder.encode(payload)
+            yield ('encode ' + name, shape,
+                   lambda e=encoder, p=payload: e.encode(p))
+            yield ('decode ' + name, shape,
+                   lambda e=encoder, d=encoded: e.decode(d))
+    if numpy is None:
+        return
+    encoder = NDArrayEncoder()
+    for shape in ((16,), (1000, 100)):
+        array = numpy.ones(shape)
+        case = 'float64 ' + 'x'.join(str(size) for size in shape)
+        encoded = encoder.encode(array)
+        yield ('encode ndarray', case, lambda a=array: encoder.encode(a))
+        yield ('decode ndarray', case, lambda d=encoded: encoder.decode(d))
+        body, buffers = encoder.encode_frames(array)
+        yield ('encode_frames ndarray', case,
+               lambda a=array: encoder.encode_frames(a))
+        yield ('decode_frames ndarray', case,
+               lambda b=body, f=buffers: encoder.decode_frames(b, f))
+
+
+def bench_authenticator():
+    """ Sign, authenticate and split messages of a few sizes """
+    for binary in (False, True):
+        name = 'binary' if binary else 'hex'
+        authenticator = Authenticator(SECRET, binary=binary)
+        for size in (64, 4096, 65536):
+            encoded = b'x' * size
+            signed = authenticator.signed(encoded)
+            case = '{} {}B'.format(name, size)
+            yield ('auth.sign', case,
+                   lambda a=authenticator, e=encoded: a.sign(e))
+            yield ('auth.auth', case,
+                   lambda a=authenticator, s=signed: a.auth(s))
+            yield ('auth.split', case,
+                   lambda a=authenticator, s=signed: a.split(s))
+
+
+def bench_subscriber():
+    """ Parse subscriptions against 10, 1k and 100k subscribed tags """
+    for count in (10, 1000, 100000):
+        subscriber = Subscriber('inproc://micro', socket=MemorySocket())
+        for index in range(count):
+            subscriber.subscribe('topic.{}'.format(index), _noop)
+        hit = 'topic.{} payload'.format(count // 2).encode('utf-8')
+        miss = b'other.1 payload'
+        case = '{} tags'.format(count)
+        yield ('subscriber.parse', case + ' hit',
+               lambda s=subscriber: s.parse(hit))
+        yield ('subscriber.parse', case + ' miss',
+               lambda s=subscriber: s.parse(miss))
+
+
+def bench_requester():
+    """ Build and pack requests """
+    requester = Requester('inproc://micro', socket=MemorySocket())
+    args = (1, 'two', [3.0])
+    yield ('requester.build_payload', 'compact',
+           lambda: requester.build_payload('add', args))
+    payload = requester.build_payload('add', args)
+    yield ('requester.pack_request', 'compact',
+           lambda: requester.pack_request(payload))
+
+    compat = Requester('inproc://micro', socket=MemorySocket(), compat=True)
+    yield ('requester.build_payload', 'compat',
+           lambda: compat.build_payload('add', args))
+
+
+def bench_endpoint():
+    """ Send and receive through a whole Endpoint over MemorySocket """
+    shapes = dict(payloads())
+    for multipart, auth in itertools.product((False, True), (False, True)):
+        endpoint = Responder(
+            'inproc://micro', socket=MemorySocket(), multipart=multipart,
+            authenticator=Authenticator(SECRET) if auth else None)
+        case = '{} {}'.format('multipart' if multipart else 'flat',
+                              'auth' if auth else 'no-auth')
+        for shape in ('small', 'records-100'):
+            yield ('endpoint.send+receive', case + ' ' + shape,
+                   lambda e=endpoint, p=shapes[shape]: _roundtrip(e, p))
+        endpoint.register('echo', lambda value: value)
+        yield ('responder.handle', case, lambda e=endpoint: _handle(e))
+
+
+def _roundtrip(endpoint, payload):
+    endpoint.send(payload)
+    return endpoint.receive()
+
+
+def _handle(responder):
+    responder.send(('echo', ('hello',)), 1)
+    return responder.handle(responder.socket.recv_multipart())
+
+
+def _noop(tag, message):
+    pass
+
+
+BENCHMARKS = (
+    bench_encoders, bench_authenticator, bench_subscriber, bench_requester,
+    bench_endpoint,
+)
+
+
+def run(fun, loops):
+    """ Return the seconds taken by `loops` calls of `fun` """
+    started = clock()
+    for _ in itertools.repeat(None, loops):
+        fun()
+    return clock() - started
+
+
+def measure(fun, min_time, repeat):
+    """ Return the best time per call of `fun` in nanoseconds, each of
+    `repeat` measurements calling it for about `min_time` seconds """
+    loops = 1
+    while True:
+        elapsed = run(fun, loops)
+        if elapsed >= min_time / 10.0:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / elapsed))
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = min(run(fun, loops) for _ in range(repeat))
+    finally:
+        if enabled:
+            gc.enable()
+    return best / loops * 1e9
+
+
+def allocated(fun, calls=5):
+    """ Return the peak of the memory allocated by a call of `fun` in
+    bytes (on average), or None without tracemalloc """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(calls):
+            # Clearing the traces resets the peak to what is allocated next
+            tracemalloc.clear_traces()
+            fun()
+            total += tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return float(total) / calls
+
+
+def parse_args(argv):
+    """ Parse the command line """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--only', nargs='+', default=[],
+                        help='run the stages containing one of these')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='seconds per measurement (default: 0.1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='measurements per stage, the best is kept '
+                             '(default: 3)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='compare results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='regression threshold as a fraction '
+                             '(default: 0.1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = []
+    util.print_header(COLUMNS)
+    for benchmark in BENCHMARKS:
+        for stage, case, fun in benchmark():
+            if args.only and not any(part in stage for part in args.only):
+                continue
+            fun()  # Warm up
+            result = {
+                'stage': stage,
+                'case': case,
+                'ns': measure(fun, args.min_time, args.repeat),
+                'alloc': allocated(fun),
+            }
+            results.append(result)
+            util.print_row(result, COLUMNS)
+
+    if args.output:
+        util.write_results(args.output, results)
+    if args.baseline:
+        regressions = util.compare(
+            results, util.read_results(args.baseline), KEYS,
+            args.threshold, COMPARED)
+        util.print_regressions(regressions, KEYS)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,14 @@
+import sys
+import json
+import time
+import platform
+
+import zmq
+
+import zmqservice
+from zmqservice.metrics import Histogram, PERCENTILES
+
+
 def print_stats(n, duration):
     pairs = [
         ('Total messages', n),
@@ -7,3 +18,116 @@ def print_stats(n, duration):
     for pair in pairs:
         label, value = pair
         print(' * {:<25}: {:10,.2f}'.format(label, value))
+
+
+def merge(histograms):
+    """ Merge histograms into a new one """
+    merged = Histogram()
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged
+
+
+def latency_stats(histogram, count, duration):
+    """ Return throughput and latency percentiles (in microseconds) of
+    `count` messages handled in `duration` seconds """
+    stats = {
+        'count': count,
+        'duration': duration,
+        'throughput': count / duration if duration else None,
+    }
+    for key, value in histogram.summary().items():
+        if key != 'count':
+            stats[key] = None if value is None else value * 1e6
+    return stats
+
+
+def environment():
+    """ Describe where the benchmarks ran """
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'pyzmq': zmq.__version__,
+        'libzmq': zmq.zmq_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'zmqservice': getattr(zmqservice, '__version__', None),
+    }
+
+
+def print_header(columns):
+    """ Print the titles of (title, key, width) columns """
+    print(''.join('{:>{}}'.format(title, width)
+                  for title, _, width in columns))
+
+
+def print_row(row, columns):
+    """ Print a row (dict) under `print_header`; floats are shown with
+    one decimal """
+    cells = []
+    for _, key, width in columns:
+        value = row.get(key)
+        if value is None:
+            value = '-'
+        elif isinstance(value, float):
+            value = '{:,.1f}'.format(value)
+        cells.append('{:>{}}'.format(value, width))
+    print(''.join(cells))
+    sys.stdout.flush()
+
+
+def write_results(path, results, **meta):
+    """ Write results (a list of dicts) and the environment as JSON """
+    document = {'environment': environment(), 'results': results}
+    document.update(meta)
+    with open(path, 'w') as handle:
+        json.dump(document, handle, indent=2, sort_keys=True)
+
+
+def read_results(path):
+    """ Read results written by `write_results` """
+    with open(path) as handle:
+        return json.load(handle)['results']
+
+
+# Metrics compared against a baseline: key -> True when higher is better
+COMPARED = (('throughput', True),) + tuple(
+    ('p{:g}'.format(percent), False) for percent in PERCENTILES)
+
+
+def compare(results, baseline, keys, threshold=0.1, metrics=COMPARED):
+    """ Compare results to baseline results identified by `keys`
+
+    Returns a list of (result, metric, baseline value, value, change)
+    tuples for each of the (metric, higher is better) `metrics` which
+    got worse by more than `threshold` (a fraction)
+    """
+    reference = dict(
+        (tuple(row.get(key) for key in keys), row) for row in baseline)
+    regressions = []
+    for row in results:
+        old = reference.get(tuple(row.get(key) for key in keys))
+        if old is None:
+            continue
+        for metric, higher_is_better in metrics:
+            before, after = old.get(metric), row.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append((row, metric, before, after, change))
+    return regressions
+
+
+def print_regressions(regressions, keys):
+    """ Print the regressions found by `compare` """
+    if not regressions:
+        print('No regressions')
+        return
+    print('Regressions:')
+    for row, metric, before, after, change in regressions:
+        print(' * {}: {} {:,.1f} -> {:,.1f} ({:+.1%})'.format(
+            ' '.join(str(row.get(key)) for key in keys),
+            metric, before, after, change))
+
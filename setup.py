@@ -40,7 +40,18 @@ setup(
         'msgpack-python',
         'pyzmq',
         'nose',
+        'futures; python_version < "3"',
     ],
+    entry_points={
+        'console_scripts': [
+            'zmqservice-top = zmqservice.top:main',
+        ],
+    },
+    extras_require={
+        'numpy': ['numpy'],
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+    },
     #dependency_links=[
     #    'git+https://github.com/tonysimpson/nanomsg-python.git@master#egg=nanomsg',
     #],
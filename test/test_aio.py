@@ -0,0 +1,195 @@
+import unittest
+
+try:
+    import asyncio
+    from zmqservice import AsyncRequester, AsyncResponder, AsyncSubscriber
+except (ImportError, SyntaxError):
+    raise unittest.SkipTest('asyncio endpoints need Python 3.5+')
+
+from zmqservice import Requester
+from zmqservice import Publisher
+from zmqservice import Authenticator
+from zmqservice import ClientError
+
+
+def later(result, delay=0.05):
+    """ An async handler: resolves to `result` after `delay` seconds """
+    future = asyncio.get_event_loop().create_future()
+    asyncio.get_event_loop().call_later(delay, future.set_result, result)
+    return future
+
+
+class BaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(coro, timeout=5))
+
+
+class TestAsyncReqRep(BaseTestCase):
+
+    def setUp(self, authenticator=None, multipart=False):
+        super(TestAsyncReqRep, self).setUp()
+        self.addr = 'inproc://test-aio'
+        self.options = {'authenticator': authenticator, 'multipart': multipart}
+        self.service = AsyncResponder(self.addr, **self.options)
+        self.client = AsyncRequester(self.addr, **self.options)
+        self.service.register('divide', lambda x, y: x / y)
+        self.service.register('slow_echo', lambda x: later(x))
+        self.service.register('function', lambda: (lambda: None))
+
+    def tearDown(self):
+        self.client.close()
+        self.service.stop()
+        self.run_until_complete(asyncio.sleep(0))
+        super(TestAsyncReqRep, self).tearDown()
+
+    def test_call(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        res, err = self.run_until_complete(self.client.call('divide', 6, 2))
+        self.assertEqual(res, 3)
+        self.assertIsNone(err)
+        res, err = self.run_until_complete(self.client.call('divide', 6, 0))
+        self.assertIsNone(res)
+        self.assertIsNotNone(err)
+
+    def test_unencodable_result(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        res, err = self.run_until_complete(self.client.call('function'))
+        self.assertIsNone(res)
+        self.assertTrue(err.startswith('Cannot encode result'))
+
+    def test_max_tasks(self):
+        self.service.max_tasks = 2
+        self.service_task = self.loop.create_task(self.service.start())
+        depths = []
+
+        def depth(x):
+            depths.append(self.service.queue_depths()['tasks'])
+            return later(x)
+
+        self.service.register('slow_echo', depth)
+        calls = [self.client.call('slow_echo', i) for i in range(6)]
+        started = self.loop.time()
+        results = self.run_until_complete(asyncio.gather(*calls))
+        self.assertEqual([res for res, _ in results], list(range(6)))
+        self.assertEqual(max(depths), 2)
+        # Three waves of two calls each
+        self.assertGreaterEqual(self.loop.time() - started, 3 * 0.05)
+
+    def test_call_many(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        events = []
+
+        def record(x):
+            events.append(('start', x))
+            future = later(x, 0.01)
+            future.add_done_callback(lambda _: events.append(('end', x)))
+            return future
+
+        self.service.register('slow_echo', record)
+        calls = [('slow_echo', (i,)) for i in range(5)] + [('divide', (1, 0))]
+        results = self.run_until_complete(self.client.call_many(calls))
+        self.assertEqual(results[:5], [(i, None) for i in range(5)])
+        self.assertIsNotNone(results[5][1])
+        # Calls run one after the other, as with the sync Responder
+        self.assertEqual(events, [
+            (event, i) for i in range(5) for event in ('start', 'end')])
+
+    def test_concurrent_calls(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        calls = [self.client.call('slow_echo', i) for i in range(20)]
+        started = self.loop.time()
+        results = self.run_until_complete(asyncio.gather(*calls))
+        self.assertEqual([res for res, _ in results], list(range(20)))
+        # Handlers overlap instead of running one after the other
+        self.assertLess(self.loop.time() - started, 20 * 0.05)
+
+    def test_stats(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        self.assertRaises(
+            ClientError, self.run_until_complete, self.client.stats())
+        self.service.expose_stats = True
+        stats = self.run_until_complete(self.client.stats())
+        self.assertEqual(stats['queues'], {'tasks': 1})
+
+    def test_blocking_requester(self):
+        self.service_task = self.loop.create_task(self.service.start())
+        client = Requester(self.addr, timeouts=(1000, 1000), **self.options)
+        try:
+            call = self.loop.run_in_executor(
+                None, client.call, 'divide', 10, 5)
+            res, err = self.run_until_complete(call)
+        finally:
+            client.close()
+        self.assertEqual(res, 2)
+
+    def test_stop(self):
+        service_task = self.loop.create_task(self.service.start())
+        self.run_until_complete(asyncio.sleep(0))
+        self.service.stop()
+        self.run_until_complete(service_task)
+        self.assertTrue(self.service.socket.closed)
+
+
+class TestAsyncReqRepMultipart(TestAsyncReqRep):
+
+    def setUp(self):
+        super(TestAsyncReqRepMultipart, self).setUp(
+            Authenticator('my-secret'), multipart=True)
+
+
+class TestAsyncSubscriber(BaseTestCase):
+
+    def setUp(self):
+        super(TestAsyncSubscriber, self).setUp()
+        self.addr = 'inproc://test-aio-pubsub'
+        self.client = Publisher(self.addr)
+        self.service = AsyncSubscriber(self.addr)
+        self.service.subscribe('upper', lambda tag, line: line.upper())
+        self.service.subscribe(
+            'slow', lambda tag, line: later(line, delay=0.1))
+
+    def tearDown(self):
+        self.client.close()
+        self.service.stop()
+        super(TestAsyncSubscriber, self).tearDown()
+
+    def test_process(self):
+        self.client.publish('upper', 'hello world')
+        task = self.run_until_complete(self.service.process())
+        self.assertEqual(self.run_until_complete(task), 'HELLO WORLD')
+
+    def test_concurrent_handlers(self):
+        for i in range(10):
+            self.client.publish('slow', i)
+        tasks = [self.run_until_complete(self.service.process())
+                 for _ in range(10)]
+        started = self.loop.time()
+        results = self.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(results, list(range(10)))
+        self.assertLess(self.loop.time() - started, 10 * 0.1)
+
+    def test_drain(self):
+        batches = []
+        self.service.drain = 10
+        self.service.subscribe('bulk', batches.append, batch=True)
+        for i in range(5):
+            self.client.publish('bulk', i)
+        self.client.publish('upper', 'a')
+        self.run_until_complete(asyncio.sleep(0.05))
+        task = self.run_until_complete(self.service.process())
+        self.run_until_complete(task)
+        self.assertEqual(batches, [[(b'bulk', i) for i in range(5)]])
+
+
+if __name__ == '__main__':
+    unittest.main()
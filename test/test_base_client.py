@@ -14,8 +14,8 @@ class BaseTestCase(unittest.TestCase):
         self.service.register('echo', lambda x: x)
 
     def tearDown(self):
-        self.client.socket.close()
-        self.service.socket.close()
+        self.client.close()
+        self.service.close()
 
 
 class TestClient(BaseTestCase):
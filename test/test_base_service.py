@@ -17,8 +17,8 @@ class BaseTestCase(unittest.TestCase):
         self.service.register('echo', lambda x: x)
 
     def tearDown(self):
-        self.client.socket.close()
-        self.service.socket.close()
+        self.client.close()
+        self.service.close()
 
 
 class TestResponder(BaseTestCase):
@@ -42,13 +42,54 @@ class TestResponder(BaseTestCase):
         self.assertEqual(sent, got)
 
     def test_execute_method_w_success(self):
+        res = self.service.execute('divide', (6, 2), 1)
+        self.assertEqual(res, (3, None))
+
+    def test_execute_method_w_success_compat(self):
+        self.service.compat = True
         res = self.service.execute('divide', (6, 2), None)
         expected = {'result': 3, 'error': None, 'ref': None}
         self.assertEqual(res, expected)
 
     def test_execute_method_w_error(self):
-        res = self.service.execute('divide', (1, 0), None)
-        self.assertIsNotNone(res['error'])
+        result, err = self.service.execute('divide', (1, 0), 1)
+        self.assertIsNotNone(err)
+
+    def test_execute_batch(self):
+        calls = [('divide', (6, 2)), ('divide', (1, 0)), ('nope', ()), 1]
+        results, err = self.service.execute('__batch__', calls, 1)
+        self.assertIsNone(err)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], (3, None))
+        for result, err in results[1:]:
+            self.assertIsNone(result)
+            self.assertIsNotNone(err)
+
+    def test_execute_stats_not_exposed(self):
+        res, err = self.service.execute('__stats__', (), 1)
+        self.assertIsNone(res)
+        self.assertEqual(err, 'Method `__stats__` not found')
+
+    def test_execute_stats(self):
+        self.service.expose_stats = True
+        stats, err = self.service.execute('__stats__', (), 1)
+        self.assertIsNone(err)
+        self.assertFalse(stats['metrics'])
+        self.assertEqual(sorted(stats['methods']), ['divide', 'echo'])
+        self.assertEqual(stats['methods']['echo']['calls'], 0)
+        self.assertEqual(stats['queues'], {})
+
+    def test_execute_stats_metrics(self):
+        self.service.expose_stats = True
+        self.service.enable_metrics()
+        self.service.execute('divide', (6, 2), 1)
+        self.service.execute('divide', (1, 0), 2)
+        stats, err = self.service.execute('__stats__', (), 3)
+        self.assertTrue(stats['metrics'])
+        self.assertEqual(stats['methods']['divide']['calls'], 2)
+        self.assertEqual(stats['methods']['divide']['errors'], 1)
+        self.assertIsNotNone(stats['methods']['divide']['p99'])
+        self.assertEqual(stats['methods']['echo']['calls'], 0)
 
     def test_encoder(self):
         data = {'name': 'Joe Doe'}
@@ -67,6 +108,18 @@ class TestResponder(BaseTestCase):
         self.client.socket.send('"abc')
         self.assertRaises(error.DecodeError, self.service.receive)
 
+    def test_request_ref(self):
+        payload = self.client.build_payload('echo', ['hello'])
+        self.assertEqual(payload[2] + 1,
+                         self.client.build_payload('echo', [])[2])
+        frames = self.client.pack_request(payload)
+        self.assertEqual(self.service.unpack_request(frames), payload)
+
+    def test_request_without_ref(self):
+        frames = self.client.pack(('echo', ['hello']))
+        self.assertRaises(
+            error.DecodeError, self.service.unpack_request, frames)
+
     def test_payload_parse_error(self):
         for payload in [[1, 2], '', None]:
             self.assertRaises(
@@ -99,5 +152,63 @@ class TestResponder(BaseTestCase):
             error.AuthenticatorInvalidSignature, self.service.receive)
 
 
+class TestResponderMultipart(BaseTestCase):
+
+    def setUp(self):
+        super(TestResponderMultipart, self).setUp()
+        auth = crypto.Authenticator('my secret')
+        for endpoint in (self.client, self.service):
+            endpoint.multipart = True
+            endpoint.authenticator = auth
+
+    def test_send_and_receive(self):
+        payload = self.client.build_payload('echo', ['hello'])
+        self.client.send(payload)
+        self.assertEqual(tuple(self.service.receive()), payload)
+        self.service.send(['a', 'b'])
+        self.assertEqual(self.client.receive(), ['a', 'b'])
+
+    def test_frames(self):
+        frames = self.client.build_frames(['a', 'b'])
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(self.service.parse_frames(frames), ['a', 'b'])
+
+    def test_frames_ref(self):
+        frames = self.client.build_frames(['a', 'b'], ref=2 ** 64 - 1)
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(
+            self.service.parse_frames(frames, ref=True),
+            (2 ** 64 - 1, ['a', 'b']))
+        frames[1] = b'\x00' * 8
+        self.assertRaises(
+            error.AuthenticatorInvalidSignature,
+            self.service.parse_frames, frames, True, True)
+
+    def test_frames_binary_signature(self):
+        # A binary signer talks to a hex one through the wire version
+        self.client.authenticator = crypto.Authenticator(
+            'my secret', binary=True)
+        frames = self.client.build_frames(['a', 'b'])
+        self.assertEqual(frames[0][:1], b'\x02')
+        self.assertEqual(len(frames[-1]), 32)
+        self.assertEqual(self.service.parse_frames(frames), ['a', 'b'])
+        frames = self.service.build_frames(['c'])
+        self.assertEqual(frames[0][:1], b'\x01')
+        self.assertEqual(self.client.parse_frames(frames), ['c'])
+
+    def test_frames_invalid_signature(self):
+        frames = self.client.build_frames(['a', 'b'])
+        frames[1] = self.client.encode(['a', 'c'])
+        self.assertRaises(
+            error.AuthenticatorInvalidSignature,
+            self.service.parse_frames, frames)
+
+    def test_frames_wire_version(self):
+        self.service.authenticator = None
+        frames = [b'\x03\x00', self.client.encode('abc')]
+        self.assertRaises(
+            error.DecodeError, self.service.parse_frames, frames)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,11 @@
 import json
 import unittest
 
+import zmq
+
 from zmqservice import *
 from zmqservice import config
+from zmqservice import core
 
 
 class TestConfig(unittest.TestCase):
@@ -31,6 +34,29 @@ class TestConfig(unittest.TestCase):
         self.assertTrue(C.keys(), self.expected.keys())
         self.assertTrue(C.values(), self.expected.values())
 
+    def test_config_load_applies_nothing(self):
+        C = config.load(filecontent=json.dumps(
+            {'context': {'nope': 2}, 'zmq': {'context': {'io_threads': 2}}}))
+        self.assertEqual(C.context, {'nope': 2})
+        self.assertEqual(core._context_options, {})
+
+    def test_config_apply_context(self):
+        C = config.load(filecontent=json.dumps(
+            {'context': 'mine', 'zmq': {'context': {'max_sockets': 2048}}}))
+        core.setGlobalContext()
+        previous = zmq.context.get(zmq.MAX_SOCKETS)
+        try:
+            config.apply(C)
+            self.assertEqual(core._context_options, {'max_sockets': 2048})
+            self.assertEqual(zmq.context.get(zmq.MAX_SOCKETS), 2048)
+        finally:
+            core._context_options.clear()
+            zmq.context.set(zmq.MAX_SOCKETS, previous)
+
+    def test_config_apply_bad_context(self):
+        self.assertRaises(ConfigError, config.apply, {
+            'zmq': {'context': {'nope': 2}}})
+
     def test_dot_dict_get_and_set(self):
         d = config.DotDict()
         d['name'] = 'John Doe'
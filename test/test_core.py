@@ -1,7 +1,16 @@
+import os
+import threading
 import unittest
 
+import zmq
+
 from zmqservice import Subscriber
 from zmqservice import Publisher
+from zmqservice import Requester
+from zmqservice import Responder
+from zmqservice import ConfigError
+from zmqservice import configure_context
+from zmqservice import core
 
 
 class EndpointTest(unittest.TestCase):
@@ -14,13 +23,91 @@ class EndpointTest(unittest.TestCase):
         self.service.subscribe('lower', lambda line: line.lower())
 
     def tearDown(self):
-        self.client.socket.close()
-        self.service.socket.close()
+        self.client.close()
+        self.service.close()
 
 
 class CommunicatorTest(unittest.TestCase):
     pass
 
 
+class ContextTest(unittest.TestCase):
+
+    def setUp(self):
+        core.setGlobalContext()
+        self.max_sockets = zmq.context.get(zmq.MAX_SOCKETS)
+
+    def tearDown(self):
+        core._context_options.clear()
+        zmq.context.set(zmq.MAX_SOCKETS, self.max_sockets)
+
+    def test_configure_context(self):
+        configure_context(io_threads=2, max_sockets=2048)
+        context = core.create_context()
+        try:
+            self.assertEqual(context.get(zmq.IO_THREADS), 2)
+            self.assertEqual(context.get(zmq.MAX_SOCKETS), 2048)
+        finally:
+            context.term()
+        # The live context of the process is updated as well
+        self.assertEqual(zmq.context.get(zmq.MAX_SOCKETS), 2048)
+
+    def test_unknown_option(self):
+        self.assertRaises(ConfigError, configure_context, linger=0)
+        self.assertRaises(ConfigError, configure_context, nope=1)
+
+    def test_shared_context(self):
+        contexts = []
+        thread = threading.Thread(
+            target=lambda: contexts.append(Requester('inproc://ctx')))
+        thread.start()
+        thread.join()
+        contexts[0].close()
+        self.assertIs(contexts[0].socket.context, zmq.context)
+        self.assertEqual(zmq.procId, os.getpid())
+
+
+class InprocTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addr = 'inproc://test-inproc'
+        self.endpoints = []
+
+    def tearDown(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def start(self, endpoint):
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def test_connect_before_bind(self):
+        client = self.start(Requester(self.addr, timeouts=(1000, 1000)))
+        service = self.start(Responder(self.addr, timeouts=(1000, 1000)))
+        service.register('divide', lambda x, y: x / y)
+        client.socket.send_multipart(client.pack_request(
+            client.build_payload('divide', (6, 2))))
+        service.process()
+        ref, result, error = client.unpack_response(
+            client.socket.recv_multipart())
+        self.assertEqual((result, error), (3, None))
+
+    def test_threads(self):
+        service = self.start(Responder(self.addr, timeouts=(1000, 1000)))
+        service.register('divide', lambda x, y: x / y)
+        results = []
+
+        def call():
+            client = Requester(self.addr, timeouts=(1000, 1000))
+            results.append(client.call('divide', 6, 2))
+            client.close()
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        service.process()
+        thread.join()
+        self.assertEqual(results, [(3, None)])
+
+
 if __name__ == '__main__':
     unittest.main()
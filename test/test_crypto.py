@@ -33,5 +33,78 @@ class TestAuthenticator(unittest.TestCase):
         unsigned = self.authenticator.unsigned(signed)
         self.assertEqual(message, unsigned)
 
+    def test_split_does_not_copy(self):
+        signed = self.authenticator.signed(b'message')
+        message, signature = self.authenticator.split(signed)
+        self.assertIsInstance(message, memoryview)
+        self.assertEqual(message.tobytes(), b'message')
+        self.assertEqual(len(signature), self.authenticator.sig_size)
+
+    def test_binary_signature(self):
+        binary = crypto.Authenticator('my secret', binary=True)
+        signed = binary.signed(b'message')
+        self.assertEqual(len(signed), len(b'message') + 32)
+        binary.auth(signed)
+        self.assertEqual(bytes(binary.unsigned(signed)), b'message')
+        with self.assertRaises(error.AuthenticatorInvalidSignature):
+            self.authenticator.auth(signed)
+
+    def test_binary_frames_signature(self):
+        binary = crypto.Authenticator('my secret', binary=True)
+        frames = [b'header', b'message']
+        signature = binary.sign_frames(frames)
+        self.assertEqual(len(signature), 32)
+        binary.auth_frames(frames, signature)
+        # A hex authenticator verifies it when told the signature is binary
+        self.authenticator.auth_frames(frames, signature, True)
+        with self.assertRaises(error.AuthenticatorInvalidSignature):
+            self.authenticator.auth_frames(frames, signature)
+
+    def test_key_rotation(self):
+        sender = crypto.Authenticator('old secret', key_id=1)
+        receiver = crypto.Authenticator('old secret', key_id=1)
+        old = sender.signed(b'message')
+        self.assertEqual(old[-65:-64], b'\x01')
+        receiver.auth(old)
+
+        # Roll out the new key, then sign with it
+        receiver.add_key(2, 'new secret')
+        sender.add_key(2, 'new secret')
+        sender.use_key(2)
+        new = sender.signed(b'message')
+        receiver.auth(new)
+        receiver.auth(old)
+        frames = [b'header', b'message']
+        receiver.auth_frames(frames, sender.sign_frames(frames))
+
+        # Retire the old key
+        with self.assertRaises(ValueError):
+            receiver.retire_key(1)
+        receiver.use_key(2)
+        receiver.retire_key(1)
+        receiver.auth(new)
+        with self.assertRaises(error.AuthenticatorInvalidSignature):
+            receiver.auth(old)
+
+    def test_key_id_mismatch(self):
+        sender = crypto.Authenticator('my secret', key_id=1)
+        receiver = crypto.Authenticator('other secret', key_id=1)
+        with self.assertRaises(error.AuthenticatorInvalidSignature):
+            receiver.auth(sender.signed(b'message'))
+        with self.assertRaises(ValueError):
+            self.authenticator.add_key(2, 'new secret')
+
+    def test_good_frames_signature(self):
+        frames = [b'header', b'message']
+        signature = self.authenticator.sign_frames(frames)
+        self.authenticator.auth_frames(frames, signature)
+        self.authenticator.auth_frames(
+            [memoryview(frame) for frame in frames], memoryview(signature))
+
+    def test_bad_frames_signature(self):
+        signature = self.authenticator.sign_frames([b'header', b'message'])
+        with self.assertRaises(error.AuthenticatorInvalidSignature):
+            self.authenticator.auth_frames([b'headerm', b'essage'], signature)
+
 if __name__ == '__main__':
     unittest.main()
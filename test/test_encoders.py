@@ -1,10 +1,20 @@
+import sys
+import uuid
+import pickle
+import decimal
 import hashlib
+import datetime
+import unittest
+import subprocess
 from multiprocessing import Process
 
 from zmqservice import Responder
 from zmqservice import Requester
+from zmqservice import Publisher
+from zmqservice import Subscriber
 from zmqservice import encoder
 from zmqservice import Authenticator
+from zmqservice import DecodeError
 
 
 def check(res, expected):
@@ -43,7 +53,9 @@ def test_encoding():
     encoders = [
         encoder.JSONEncoder(),
         encoder.MsgPackEncoder(),
-        encoder.PickleEncoder()]
+        encoder.PickleEncoder(),
+        encoder.TaggedEncoder(encoder.MsgPackEncoder()),
+        encoder.CompressedEncoder(encoder.JSONEncoder(), min_size=0)]
 
     for test, expected in TESTS:
         for enc in encoders:
@@ -67,3 +79,361 @@ def test_encoding():
                 proc.terminate()
                 yield check, res, expected
                 # self.assertEqual(expected, res)
+
+
+def test_tagged_encoder():
+    """ Test messages are tagged with the content type of their encoder """
+    tagged = encoder.TaggedEncoder(encoders=[
+        encoder.JSONEncoder(), encoder.MsgPackEncoder()])
+    data = {'a': [1, 2]}
+    for enc in (None, encoder.JSONEncoder(), encoder.MsgPackEncoder()):
+        encoded = tagged.encode(data, enc)
+        content_type = (enc or encoder.PickleEncoder()).content_type
+        assert tagged.content_type_of(encoded) == content_type
+        assert tagged.decode(encoded) == data
+
+
+def test_tagged_encoder_unknown_type():
+    """ Test decoding a message with an unknown content type """
+    tagged = encoder.TaggedEncoder()
+    for data in (b'', b'\xff123'):
+        try:
+            tagged.decode(data)
+        except DecodeError:
+            pass
+        else:
+            raise AssertionError('DecodeError not raised')
+
+
+UNPICKLED = []
+
+
+def unpickled():
+    UNPICKLED.append(True)
+
+
+class Exploit(object):
+    """ Object which records being unpickled """
+
+    def __reduce__(self):
+        return unpickled, ()
+
+
+def test_tagged_encoder_rejects_pickle():
+    """ Test a JSON endpoint does not unpickle pickle-tagged messages """
+    message = encoder.TaggedEncoder().encode(Exploit())
+    assert encoder.TaggedEncoder.content_type_of(message) == 3
+    del UNPICKLED[:]
+    for tagged in (encoder.TaggedEncoder(encoder.JSONEncoder()),
+                   encoder.TaggedEncoder(encoder.JSONEncoder(),
+                                         [encoder.MsgPackEncoder()])):
+        try:
+            tagged.decode(message)
+        except DecodeError:
+            pass
+        else:
+            raise AssertionError('DecodeError not raised')
+    assert not UNPICKLED
+
+
+def test_register():
+    """ Test registering an encoder under a custom content type """
+    custom = encoder.JSONEncoder()
+    encoder.register(custom, 200)
+    assert encoder.get_encoder(200) is custom
+    assert encoder.TaggedEncoder(custom).encode(None) == b'\xc8null'
+    del encoder.ENCODERS[200]
+    for content_type in (0, 256):
+        try:
+            encoder.register(custom, content_type)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+
+
+def test_tagged_encoder_own_encoders():
+    """ Test a TaggedEncoder decodes with its own configured encoders
+    only """
+    compressed = encoder.CompressedEncoder(encoder.JSONEncoder(), min_size=0)
+    sender = encoder.TaggedEncoder(compressed)
+    encoded = sender.encode({'a': 'a' * 100})
+    assert sender.content_type_of(encoded) == 5
+    assert sender.decode(encoded) == {'a': 'a' * 100}
+
+    receiver = encoder.TaggedEncoder(encoders=[
+        encoder.CompressedEncoder(encoder.JSONEncoder())])
+    assert receiver.decode(encoded) == {'a': 'a' * 100}
+    # Registered encoders do not decode the ids it does not know
+    for tagged, message in [
+            (receiver, encoder.TaggedEncoder(
+                encoder.JSONEncoder()).encode([1])),
+            (encoder.TaggedEncoder(), encoded)]:
+        try:
+            tagged.decode(message)
+        except DecodeError:
+            pass
+        else:
+            raise AssertionError('DecodeError not raised')
+
+
+def test_tagged_encoder_needs_content_type():
+    """ Test encoders without a content type are refused """
+    try:
+        encoder.TaggedEncoder(encoder.Encoder())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+
+def test_encoder_per_method():
+    """ Test a requester choosing encoders per method and per call """
+    address = 'ipc:///tmp/test-encoders.sock'
+    proc = Process(
+        target=start_service, args=(address, encoder.TaggedEncoder(
+            encoders=[encoder.JSONEncoder(), encoder.MsgPackEncoder()])))
+    proc.start()
+
+    client = Requester(
+        address, encoder=encoder.TaggedEncoder(
+            encoder.JSONEncoder(), [encoder.PickleEncoder()]),
+        timeouts=(3000, 3000))
+    client.set_encoder('upper', encoder.MsgPackEncoder())
+    sent = []
+    pack = client.pack
+
+    def spy(payload, ref=None, encoder=None):
+        frames = pack(payload, ref, encoder)
+        sent.append(client.encoder.content_type_of(frames[0][8:]))
+        return frames
+
+    client.pack = spy
+    try:
+        assert client.call('divide', 10, 2) == (5, None)
+        assert client.call('upper', {'a': 'a'}) == ({'a': 'A'}, None)
+        assert client.call_with(
+            encoder.PickleEncoder(), 'divide', 10, 2) == (5, None)
+    finally:
+        client.close()
+        proc.terminate()
+    assert sent == [1, 2, 3]
+
+
+def arrays():
+    """ Return a message holding arrays of various layouts """
+    if encoder.load_numpy() is None:
+        raise unittest.SkipTest('numpy is not installed')
+    numpy = encoder.numpy
+    grid = numpy.arange(12, dtype='>i4').reshape(3, 4)
+    return {'grid': grid,
+            'nested': [grid.T, grid[:, ::2], (numpy.zeros(0), 'text')],
+            'scalar': numpy.float32(1.5)}
+
+
+def check_arrays(got, sent):
+    """ Check a message from `arrays` was received unchanged """
+    numpy = encoder.numpy
+    for got_array, sent_array in [
+            (got['grid'], sent['grid']),
+            (got['nested'][0], sent['nested'][0]),
+            (got['nested'][1], sent['nested'][1]),
+            (got['nested'][2][0], sent['nested'][2][0])]:
+        assert got_array.dtype == sent_array.dtype
+        assert numpy.array_equal(got_array, sent_array)
+    assert got['nested'][2][1] == 'text'
+    assert got['scalar'] == sent['scalar']
+
+
+def test_ndarray_encoder():
+    """ Test arrays round trip through the single buffer form """
+    sent = arrays()
+    enc = encoder.NDArrayEncoder()
+    check_arrays(enc.decode(enc.encode(sent)), sent)
+
+
+def test_ndarray_frames():
+    """ Test arrays travel as separate frames and are not copied """
+    sent = arrays()
+    auth = Authenticator('my-secret')
+    publisher = Publisher('inproc://test-ndarray', encoder.NDArrayEncoder(),
+                          authenticator=auth, multipart=True)
+    subscriber = Subscriber(
+        'inproc://test-ndarray',
+        encoder.TaggedEncoder(encoders=[encoder.NDArrayEncoder()]),
+        authenticator=auth, multipart=True)
+    try:
+        frames = publisher.build_frames(sent)
+        # header, body, 4 arrays and the signature
+        assert len(frames) == 7
+        got = publisher.parse_frames(frames)
+        check_arrays(got, sent)
+        assert encoder.numpy.may_share_memory(got['grid'], sent['grid'])
+
+        # A TaggedEncoder receiver decodes with its NDArrayEncoder
+        publisher.encoder = encoder.TaggedEncoder(encoder.NDArrayEncoder())
+        subscriber.subscribe('arrays', lambda tag, message: message)
+        publisher.publish('arrays', sent)
+        check_arrays(subscriber.process(), sent)
+    finally:
+        publisher.close()
+        subscriber.close()
+
+
+def test_numpy_imported_lazily():
+    """ Test importing zmqservice does not import numpy """
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, zmqservice; print("numpy" in sys.modules)'])
+    assert output.strip() == b'False'
+
+
+def test_tagged_ndarray_inner_encoder():
+    """ Test arrays sent with another inner encoder than the registered
+    NDArrayEncoder's are decoded with it """
+    if encoder.load_numpy() is None:
+        raise unittest.SkipTest('numpy is not installed')
+    sent = {'grid': encoder.numpy.arange(6).reshape(2, 3), 'name': 'grid'}
+    tagged = encoder.TaggedEncoder(
+        encoder.NDArrayEncoder(encoder.MsgPackEncoder()))
+    got = tagged.decode(tagged.encode(sent))
+    assert got['name'] == 'grid'
+    assert encoder.numpy.array_equal(got['grid'], sent['grid'])
+
+
+def test_pickle_protocol():
+    """ Test pickling with the highest protocol """
+    enc = encoder.PickleEncoder(pickle.HIGHEST_PROTOCOL)
+    data = {'a': [1, 2.5, b'bytes'], 'b': ('x', None)}
+    assert enc.decode(enc.encode(data)) == data
+
+
+def test_pickle_out_of_band():
+    """ Test large buffers travel as separate frames """
+    if pickle.HIGHEST_PROTOCOL < 5:
+        raise unittest.SkipTest('pickle protocol 5 is not available')
+    enc = encoder.PickleEncoder(out_of_band=True, min_size=1024)
+    blob = bytearray(b'x' * 4096)
+    sent = {'blob': pickle.PickleBuffer(blob),
+            'small': pickle.PickleBuffer(b'y' * 16)}
+
+    body, buffers = enc.encode_frames(sent)
+    assert len(buffers) == 1
+    assert buffers[0].obj is blob
+    got = enc.decode_frames(body, buffers)
+    assert got['blob'].obj is blob
+    assert bytes(got['small']) == b'y' * 16
+
+    # Without multipart the buffers are pickled in band
+    got = enc.decode(enc.encode(sent))
+    assert bytes(got['blob']) == bytes(blob)
+
+    publisher = Publisher('inproc://test-pickle5', enc, multipart=True)
+    subscriber = Subscriber('inproc://test-pickle5', multipart=True)
+    try:
+        assert len(publisher.build_frames(sent)) == 3
+        subscriber.subscribe('blob', lambda tag, message: message)
+        publisher.publish('blob', sent)
+        got = subscriber.process()
+        assert isinstance(got['blob'], memoryview)
+        assert bytes(got['blob']) == bytes(blob)
+    finally:
+        publisher.close()
+        subscriber.close()
+
+
+MESSAGES = [
+    {'sensor': 'rack-{}'.format(i), 'status': 'nominal', 'value': i}
+    for i in range(100)]
+
+
+def test_compressed_encoder():
+    """ Test compressing with each available algorithm """
+    big = {'text': 'repetitive ' * 100}
+    for algorithm in encoder.CODECS:
+        enc = encoder.CompressedEncoder(
+            encoder.JSONEncoder(), algorithm, min_size=64)
+        encoded = enc.encode(big)
+        assert len(encoded) < len(encoder.JSONEncoder().encode(big))
+        assert bytearray(encoded[:1])[0] == encoder.CODECS[algorithm].id
+
+        # Decoded by an encoder using another algorithm
+        assert encoder.CompressedEncoder(
+            encoder.JSONEncoder()).decode(encoded) == big
+
+        # Small messages are not compressed
+        assert enc.encode('small') == b'\x00"small"'
+        assert enc.decode(enc.encode('small')) == 'small'
+
+
+def test_compressed_dictionary():
+    """ Test compressing with a dictionary trained from samples """
+    if not encoder.CODECS['zlib'].dictionaries:
+        raise unittest.SkipTest('zlib dictionaries need Python 3')
+    enc = encoder.CompressedEncoder(encoder.JSONEncoder(), min_size=0)
+    plain = sum(len(enc.encode(message)) for message in MESSAGES)
+    dictionary = enc.train(MESSAGES[:50], 1024)
+    assert len(dictionary) <= 1024
+    assert sum(len(enc.encode(message)) for message in MESSAGES) < plain
+
+    receiver = encoder.CompressedEncoder(
+        encoder.JSONEncoder(), dictionary=dictionary)
+    for message in MESSAGES:
+        assert receiver.decode(enc.encode(message)) == message
+
+    # The other end needs the dictionary
+    try:
+        encoder.CompressedEncoder(encoder.JSONEncoder()).decode(
+            enc.encode(MESSAGES[0]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+
+def test_compressed_unknown_algorithm():
+    """ Test unavailable algorithms are rejected """
+    try:
+        encoder.CompressedEncoder(algorithm='nope')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError not raised')
+
+
+def test_msgpack_ext_types():
+    """ Test datetimes, Decimals and UUIDs round trip through msgpack """
+    enc = encoder.MsgPackEncoder()
+    naive = datetime.datetime(2016, 2, 29, 23, 59, 58, 123456)
+    aware = naive.replace(tzinfo=encoder._timezone(-5 * 3600))
+    before_epoch = datetime.datetime(1900, 1, 1, 0, 0, 0, 1)
+    sent = {'when': [naive, aware, before_epoch],
+            'price': decimal.Decimal('-12.3400'),
+            'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'plain': [1, 'two', 3.5, None]}
+    got = enc.decode(enc.encode(sent))
+    assert got == sent
+    assert got['when'][1].utcoffset() == datetime.timedelta(hours=-5)
+    assert got['when'][0].tzinfo is None
+    assert str(got['price']) == '-12.3400'
+
+
+def test_msgpack_unsupported_type():
+    """ Test the packer is still usable after failing on a type """
+    enc = encoder.MsgPackEncoder()
+    try:
+        enc.encode([1, object()])
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('TypeError not raised')
+    assert enc.decode(enc.encode([1, 2])) == [1, 2]
+
+
+def test_msgpack_stream():
+    """ Test decoding concatenated messages from one buffer """
+    enc = encoder.MsgPackEncoder()
+    messages = [{'a': i, 'b': decimal.Decimal(i)} for i in range(10)]
+    assert enc.decode_stream(enc.encode_stream(messages)) == messages
+    assert enc.decode_stream(memoryview(enc.encode_stream([]))) == []
+
@@ -0,0 +1,175 @@
+import threading
+import unittest
+
+import zmq
+
+from zmqservice import Metrics
+from zmqservice import Requester
+from zmqservice import Responder
+from zmqservice import Publisher
+from zmqservice import Subscriber
+from zmqservice import crypto
+from zmqservice.metrics import Histogram
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertIsNone(histogram.mean())
+        self.assertEqual(histogram.summary()['count'], 0)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for micros in range(1, 1001):
+            histogram.record(micros / 1e6)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.mean(), 500.5e-6, delta=1e-9)
+        self.assertEqual(histogram.min, 1000)
+        self.assertEqual(histogram.max, 1000000)
+        # Buckets bound the relative error to 1/16
+        for percent in (50, 90, 99):
+            expected = percent * 10e-6
+            self.assertAlmostEqual(
+                histogram.percentile(percent), expected,
+                delta=expected / 16)
+        self.assertEqual(histogram.percentile(100), 1e-3)
+
+    def test_small_values(self):
+        histogram = Histogram()
+        histogram.record(5e-9)
+        histogram.record(-1)
+        self.assertEqual(histogram.min, 0)
+        self.assertEqual(histogram.percentile(100), 5e-9)
+
+    def test_merge(self):
+        first, second = Histogram(), Histogram()
+        first.record(1e-3)
+        second.record(2e-3, 3)
+        first.merge(second)
+        self.assertEqual(first.count, 4)
+        self.assertEqual(first.max, 2000000)
+        self.assertAlmostEqual(first.percentile(50), 2e-3, delta=2e-3 / 16)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        metrics.record('encode', 1e-6)
+        metrics.record('echo', 2e-6, 'methods')
+        metrics.transfer('out', 10)
+        metrics.transfer('out', 5)
+        metrics.count('retries')
+        metrics.error('echo')
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['stages']['encode']['count'], 1)
+        self.assertEqual(snapshot['methods']['echo']['count'], 1)
+        self.assertEqual(snapshot['counters'], {
+            'messages_out': 2, 'bytes_out': 15, 'retries': 1})
+        self.assertEqual(snapshot['errors'], {'echo': 1})
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {
+            'stages': {}, 'methods': {}, 'counters': {}, 'errors': {}})
+
+
+class TestResponderMetrics(unittest.TestCase):
+
+    def setUp(self):
+        addr = 'inproc://test-metrics'
+        self.client = Requester(addr)
+        self.service = Responder(addr)
+        self.service.register('echo', lambda x: x)
+
+    def tearDown(self):
+        self.client.close()
+        self.service.close()
+
+    def request(self, *args):
+        payload = self.client.build_payload('echo', args)
+        return self.service.handle(self.client.pack_request(payload))
+
+    def test_disabled(self):
+        self.assertIsNone(self.service.metrics)
+        self.request('hello')
+
+    def test_stages_and_methods(self):
+        metrics = self.service.enable_metrics()
+        self.request('hello')
+        self.request('world')
+
+        self.assertEqual(metrics.histogram('decode').count, 2)
+        self.assertEqual(metrics.histogram('echo', 'methods').count, 2)
+        self.assertIsNone(metrics.histogram('verify'))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['messages_in'], 2)
+        self.assertGreater(counters['bytes_in'], 0)
+
+        self.service.disable_metrics()
+        self.request('again')
+        self.assertEqual(metrics.histogram('decode').count, 2)
+
+    def test_shared_multipart(self):
+        auth = crypto.Authenticator('my secret')
+        metrics = Metrics()
+        for endpoint in (self.client, self.service):
+            endpoint.multipart = True
+            endpoint.authenticator = auth
+            endpoint.enable_metrics(metrics)
+
+        response, ref = self.request('hello')
+        self.service.pack_response(response, ref)
+
+        for stage in ('encode', 'sign', 'verify', 'decode'):
+            self.assertIsNotNone(metrics.histogram(stage), stage)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['messages_out'], 2)
+        self.assertEqual(counters['messages_in'], 1)
+
+    def test_roundtrip(self):
+        self.service.socket.setsockopt(zmq.RCVTIMEO, 3000)
+        metrics = self.client.enable_metrics()
+        thread = threading.Thread(target=self.service.process)
+        thread.start()
+        self.assertEqual(self.client.call('echo', 'hello'), ('hello', None))
+        thread.join()
+        self.assertEqual(metrics.histogram('roundtrip').count, 1)
+
+
+class TestSubscriberMetrics(unittest.TestCase):
+
+    def setUp(self):
+        addr = 'inproc://test-metrics-pubsub'
+        self.client = Publisher(addr)
+        self.service = Subscriber(addr)
+        self.results = []
+        self.service.subscribe('upper', lambda tag, line: line.upper())
+        self.service.subscribe(
+            'batch', lambda pairs: self.results.append(pairs), batch=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.service.close()
+
+    def test_per_subscription(self):
+        metrics = self.service.enable_metrics()
+        self.client.publish('upper', 'hello')
+        self.client.publish('upper.1', 'hello')
+        self.client.publish('batch.one', 'world')
+        self.assertEqual(self.service.process(), 'HELLO')
+        self.assertEqual(self.service.process(), 'HELLO')
+        self.service.process()
+
+        # Received tags are counted under the subscription they match
+        methods = metrics.snapshot()['methods']
+        self.assertEqual(sorted(methods), ['batch', 'upper'])
+        self.assertEqual(methods['upper']['count'], 2)
+        self.assertEqual(methods['batch']['count'], 1)
+        self.assertEqual(metrics.snapshot()['counters']['messages_in'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,29 @@
+import time
 import unittest
 
 from zmqservice import Subscriber
 from zmqservice import Publisher
 from zmqservice import Authenticator
+from zmqservice import SubscriberError
+from zmqservice import PublisherError
+from zmqservice.pubsub import TopicIndex
 
 
 class BaseTestCase(unittest.TestCase):
 
-    def setUp(self, authenticator=None):
+    def setUp(self, authenticator=None, multipart=False, **options):
         self.addr = 'inproc://test'
-        self.client = Publisher(self.addr, authenticator=authenticator)
-        self.service = Subscriber(self.addr, authenticator=authenticator)
-        self.service.subscribe('upper', lambda line: line.upper())
-        self.service.subscribe('lower', lambda line: line.lower())
+        self.client = Publisher(
+            self.addr, authenticator=authenticator, multipart=multipart,
+            **options)
+        self.service = Subscriber(
+            self.addr, authenticator=authenticator, multipart=multipart)
+        self.service.subscribe('upper', lambda tag, line: line.upper())
+        self.service.subscribe('lower', lambda tag, line: line.lower())
 
     def tearDown(self):
-        self.client.socket.close()
-        self.service.socket.close()
+        self.client.close()
+        self.service.close()
 
 
 class TestPubSub(BaseTestCase):
@@ -34,6 +41,57 @@ class TestPubSub(BaseTestCase):
         lowercase = self.service.process()
         self.assertEqual(lowercase, line.lower())
 
+    def test_longest_prefix(self):
+        self.service.subscribe('up', lambda tag, line: 'up')
+        self.service.subscribe('upper.first', lambda tag, line: 'first')
+        self.client.publish('upper.first.word', 'hello world')
+        self.client.publish('upper.all', 'hello world')
+        self.client.publish('up.all', 'hello world')
+        self.assertEqual(self.service.process(), 'first')
+        self.assertEqual(self.service.process(), 'HELLO WORLD')
+        self.assertEqual(self.service.process(), 'up')
+
+    def test_unsubscribe(self):
+        self.service.unsubscribe('upper')
+        self.assertNotIn('upper', self.service.methods)
+        self.assertIsNone(self.service.match(b'upper'))
+        self.client.publish('upper', 'hello world')
+        self.client.publish('lower', 'HELLO WORLD')
+        self.assertEqual(self.service.process(), 'hello world')
+        self.assertRaises(SubscriberError, self.service.unsubscribe, 'upper')
+
+
+class TestTopicIndex(unittest.TestCase):
+
+    def test_match(self):
+        index = TopicIndex()
+        index.add('a', 1)
+        index.add('abc', 2)
+        index.add(b'abd', 3)
+        self.assertEqual(index.match(b'abcdef'), 2)
+        self.assertEqual(index.match(b'abd'), 3)
+        self.assertEqual(index.match(b'ab'), 1)
+        self.assertIsNone(index.match(b'b'))
+        self.assertEqual(len(index), 3)
+
+    def test_catch_all(self):
+        index = TopicIndex()
+        index.add('', 0)
+        index.add('abc', 1)
+        self.assertEqual(index.match(b'abc'), 1)
+        self.assertEqual(index.match(b'xyz'), 0)
+
+    def test_remove(self):
+        index = TopicIndex()
+        index.add('abc', 1)
+        index.add('abd', 2)
+        index.remove('abc')
+        self.assertIsNone(index.match(b'abc'))
+        self.assertEqual(index.lengths, [3])
+        index.remove('abd')
+        self.assertEqual(index.lengths, [])
+        self.assertNotIn('abd', index)
+
 
 class TestPubWithAuthentication(BaseTestCase):
 
@@ -54,5 +112,171 @@ class TestPubWithAuthentication(BaseTestCase):
         lowercase = self.service.process()
         self.assertEqual(lowercase, line.lower())
 
+
+class TestPubSubMultipart(BaseTestCase):
+
+    def setUp(self):
+        super(TestPubSubMultipart, self).setUp(multipart=True)
+
+    def test_pub_sub(self):
+        line = 'hello world'
+        self.client.publish('upper', line)
+
+        frames = self.service.socket.recv_multipart()
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[0], b'upper')
+
+        self.client.publish('lower', line.upper())
+        lowercase = self.service.process()
+        self.assertEqual(lowercase, line.lower())
+
+
+class TestPubSubMultipartWithAuthentication(BaseTestCase):
+
+    def setUp(self):
+        authenticator = Authenticator('my-secret')
+        super(TestPubSubMultipartWithAuthentication, self).setUp(
+            authenticator, multipart=True)
+
+    def test_pub_sub(self):
+        line = 'hello world'
+        self.client.publish('upper', line)
+        uppercase = self.service.process()
+        self.assertEqual(uppercase, line.upper())
+
+    def test_tampered_body(self):
+        self.client.publish('upper', 'hello world')
+        frames = self.service.socket.recv_multipart()
+        frames[2] = self.client.encode('HELLO WORLD')
+        self.client.socket.send_multipart(frames)
+        self.assertIsNone(self.service.process())
+
+    def test_rerouted_tag(self):
+        self.client.publish('upper', 'hello world')
+        frames = self.service.socket.recv_multipart()
+        frames[0] = b'lower'
+        self.client.socket.send_multipart(frames)
+        self.assertIsNone(self.service.process())
+
+    def test_batch(self):
+        self.client.batch_size = 2
+        self.client.publish('upper', 'hello')
+        self.client.publish('upper', 'world')
+        self.service.drain = 2
+        self.assertEqual(self.service.process(), 'WORLD')
+
+
+class TestDrain(BaseTestCase):
+
+    def setUp(self):
+        super(TestDrain, self).setUp()
+        self.service.drain = 10
+        self.batches = []
+        self.service.subscribe('bulk', self.batches.append, batch=True)
+
+    def publish(self, tag, messages):
+        for message in messages:
+            self.client.publish(tag, message)
+        # Wait for all messages to arrive before draining
+        time.sleep(0.05)
+
+    def test_batch_handler(self):
+        self.publish('bulk', range(5))
+        self.client.publish('upper', 'a')
+        time.sleep(0.05)
+        self.assertEqual(self.service.process(), None)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(
+            self.batches[0], [(b'bulk', message) for message in range(5)])
+        self.assertEqual(self.service.socket.poll(0), 0)
+
+    def test_drain_limit(self):
+        self.service.drain = 3
+        self.publish('bulk', range(5))
+        self.service.process()
+        self.service.process()
+        self.assertEqual(
+            [[message for _, message in batch] for batch in self.batches],
+            [[0, 1, 2], [3, 4]])
+
+    def test_per_message_handlers(self):
+        self.publish('upper', ['a', 'b'])
+        self.assertEqual(self.service.process(), 'B')
+
+    def test_single_message(self):
+        self.service.drain = 1
+        self.publish('bulk', [1])
+        self.service.process()
+        self.assertEqual(self.batches, [[(b'bulk', 1)]])
+
+    def test_resubscribe_per_message(self):
+        self.service.subscribe('bulk', lambda tag, message: message)
+        self.publish('bulk', [1, 2])
+        self.assertEqual(self.service.process(), 2)
+        self.assertEqual(self.batches, [])
+
+
+class TestPubSubBatching(BaseTestCase):
+
+    def setUp(self):
+        super(TestPubSubBatching, self).setUp(multipart=True, batch_size=3)
+
+    def assertNothingReceived(self):
+        self.assertEqual(self.service.socket.poll(50), 0)
+
+    def test_batch_size(self):
+        self.client.publish('upper', 'a')
+        self.client.publish('lower', 'B')
+        self.client.publish('upper', 'b')
+        self.assertNothingReceived()
+        self.client.publish('upper', 'c')
+
+        self.assertEqual(self.service.process(), 'A')
+        self.assertEqual(len(self.service.backlog), 2)
+        self.assertEqual(self.service.process(), 'B')
+        self.assertEqual(self.service.process(), 'C')
+        self.assertNothingReceived()
+
+        # The batch of 'lower' is not full yet
+
+        self.client.flush()
+        self.assertEqual(self.service.process(), 'b')
+
+    def test_batch_frames(self):
+        for message in ['a', 'b', 'c']:
+            self.client.publish('upper', message)
+        frames = self.service.socket.recv_multipart()
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(frames[0], b'upper')
+
+    def test_batch_window(self):
+        self.client.batch_size = None
+        self.client.batch_window = 50000
+        self.client.publish('upper', 'a')
+        self.assertNothingReceived()
+        time.sleep(0.05)
+        self.client.publish('upper', 'b')
+        self.assertEqual(self.service.process(), 'A')
+        self.assertEqual(self.service.process(), 'B')
+
+    def test_close_flushes(self):
+        self.client.publish('upper', 'a')
+        self.client.close()
+        self.assertEqual(self.service.process(), 'A')
+
+    def test_batch_with_authentication(self):
+        auth = Authenticator('my-secret')
+        self.service.authenticator = auth
+        self.client.authenticator = auth
+        for message in ['a', 'b', 'c']:
+            self.client.publish('upper', message)
+        results = [self.service.process() for _ in range(3)]
+        self.assertEqual(results, ['A', 'B', 'C'])
+
+    def test_batching_requires_multipart(self):
+        self.assertRaises(
+            PublisherError, Publisher, 'inproc://batch', batch_size=10)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,15 @@
+import time
 import unittest
+import threading
 from multiprocessing import Process
 
 from zmqservice import Responder
+from zmqservice import ConcurrentResponder
+from zmqservice import PipelinedRequester
 from zmqservice import Requester
 from zmqservice import encoder
 from zmqservice import Authenticator
+from zmqservice import ClientError
 
 
 class BaseTestCase(unittest.TestCase):
@@ -13,10 +18,12 @@ class BaseTestCase(unittest.TestCase):
         self.addr = 'ipc:///tmp/test-reqprep.sock'
 
     def tearDown(self):
-        self.client.socket.close()
+        self.client.close()
 
-    def start_service(self, addr, authenticator=None):
-        s = Responder(addr, authenticator=authenticator, timeouts=(3000, 3000))
+    def start_service(self, addr, authenticator=None, multipart=False,
+                      compat=False):
+        s = Responder(addr, authenticator=authenticator, timeouts=(3000, 3000),
+                      multipart=multipart, compat=compat)
         s.register('divide', lambda x, y: x / y)
         s.start()
 
@@ -42,6 +49,20 @@ class TestTCPProtocol(BaseTestCase):
         self.assertTrue(err is not None)
 
 
+class TestBatch(BaseTestCase):
+
+    def test_call_many(self):
+        proc = Process(target=self.start_service, args=(self.addr,))
+        proc.start()
+        self.client = Requester(self.addr, timeouts=(3000, 3000))
+        results = self.client.call_many(
+            [('divide', (x, 2)) for x in range(100)] + [('divide', (1, 0))])
+        proc.terminate()
+        self.assertEqual(results[:100], [(x / 2, None) for x in range(100)])
+        self.assertTrue(results[100][0] is None)
+        self.assertTrue(results[100][1] is not None)
+
+
 class TestAuthentication(BaseTestCase):
 
     def make_req(self, *args):
@@ -61,6 +82,289 @@ class TestAuthentication(BaseTestCase):
         self.assertTrue(err is None)
 
 
+class TestMultipart(BaseTestCase):
+
+    def make_req(self, *args):
+        auth = Authenticator('my-secret')
+        proc = Process(target=self.start_service,
+                       args=(self.addr, auth, True))
+        proc.start()
+        self.client = Requester(
+            self.addr, authenticator=auth, timeouts=(3000, 3000),
+            multipart=True)
+        res, err = self.client.call('divide', *args)
+        proc.terminate()
+        return res, err
+
+    def test_req_rep_w_success(self):
+        res, err = self.make_req(12, 2)
+        self.assertEqual(6, res)
+        self.assertTrue(err is None)
+
+    def test_req_rep_w_error(self):
+        res, err = self.make_req(6, 0)
+        self.assertTrue(res is None)
+        self.assertTrue(err is not None)
+
+
+class TestCompat(BaseTestCase):
+
+    def make_client(self, multipart=False):
+        auth = Authenticator('my-secret')
+        proc = Process(target=self.start_service,
+                       args=(self.addr, auth, multipart, True))
+        proc.start()
+        self.client = Requester(
+            self.addr, authenticator=auth, timeouts=(3000, 3000),
+            multipart=multipart, compat=True)
+        return proc
+
+    def test_req_rep(self):
+        proc = self.make_client()
+        self.assertEqual(self.client.call('divide', 12, 2), (6, None))
+        self.assertEqual(
+            self.client.call_many([('divide', (6, 3))]), [(2, None)])
+        proc.terminate()
+
+    def test_req_rep_multipart(self):
+        proc = self.make_client(multipart=True)
+        self.assertEqual(self.client.call('divide', 12, 2), (6, None))
+        proc.terminate()
+
+    def test_payload(self):
+        self.client = Requester(self.addr, compat=True)
+        method, args, ref = self.client.build_payload('divide', (1, 2))
+        self.assertEqual(len(ref), 36)
+
+
+class TestConcurrentResponder(BaseTestCase):
+
+    def start_service(self, addr, authenticator=None, multipart=False):
+        s = ConcurrentResponder(
+            addr, authenticator=authenticator, multipart=multipart, workers=8,
+            expose_stats=True)
+        s.register('divide', lambda x, y: x / y)
+        s.register('sleep', lambda delay: time.sleep(delay) or delay)
+        s.register('function', lambda: (lambda: None))
+        s.start()
+
+    def call_all(self, calls):
+        """ Make each call from its own client and thread """
+        results = [None] * len(calls)
+        finished = []
+
+        def call(position, method, args):
+            client = Requester(self.addr, timeouts=(3000, 3000))
+            results[position] = client.call(method, *args)
+            finished.append(position)
+            client.close()
+
+        threads = [
+            threading.Thread(target=call, args=(position, method, args))
+            for position, (method, args) in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, finished
+
+    def setUp(self):
+        super(TestConcurrentResponder, self).setUp()
+        self.proc = Process(target=self.start_service, args=(self.addr,))
+        self.proc.start()
+        self.client = Requester(self.addr, timeouts=(3000, 3000))
+
+    def tearDown(self):
+        super(TestConcurrentResponder, self).tearDown()
+        self.proc.terminate()
+
+    def test_req_rep(self):
+        self.assertEqual(self.client.call('divide', 6, 2), (3, None))
+        res, err = self.client.call('divide', 6, 0)
+        self.assertTrue(res is None)
+        self.assertTrue(err is not None)
+
+    def test_slow_calls_overlap(self):
+        started = time.time()
+        results, _ = self.call_all([('sleep', (0.2,))] * 8)
+        self.assertEqual(results, [(0.2, None)] * 8)
+        self.assertTrue(time.time() - started < 8 * 0.2)
+
+    def test_replies_out_of_order(self):
+        results, finished = self.call_all(
+            [('sleep', (0.5,)), ('divide', (6, 3))])
+        self.assertEqual(results, [(0.5, None), (2, None)])
+        self.assertEqual(finished, [1, 0])
+
+    def test_unencodable_result(self):
+        res, err = self.client.call('function')
+        self.assertTrue(res is None)
+        self.assertTrue(err.startswith('Cannot encode result'))
+        self.assertEqual(self.client.call('divide', 6, 2), (3, None))
+
+    def test_stats(self):
+        stats = self.client.stats()
+        self.assertEqual(stats['pid'], self.proc.pid)
+        self.assertEqual(stats['queues'], {'requests': 0, 'replies': 0})
+        self.assertFalse(stats['metrics'])
+        self.assertEqual(stats['methods']['divide']['calls'], 0)
+
+
+class TestConcurrentResponderInProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.addr = 'inproc://test-concurrent'
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.service = ConcurrentResponder(
+            self.addr, workers=1, max_pending=2)
+        self.service.register('wait', self.wait)
+        self.client = PipelinedRequester(self.addr, timeouts=(3000, 3000))
+
+    def tearDown(self):
+        self.done.set()
+        self.client.close()
+        self.service.close()
+
+    def wait(self):
+        self.started.set()
+        self.done.wait(3)
+        return 'done'
+
+    def serve(self, futures):
+        """ Run the service until every future is resolved """
+        while not all(future.done() for future in futures):
+            if self.service.socket.poll(10) or \
+               self.service.waker.socket.poll(10):
+                self.service.process()
+
+    def test_max_pending(self):
+        futures = [self.client.call_async('wait') for _ in range(3)]
+        self.service.process()
+        self.assertTrue(self.started.wait(3))
+        self.service.process()
+        self.assertEqual(self.service.queue_depths()['requests'], 1)
+
+        # The third request stays in the socket queue
+        self.service.process()
+        self.assertEqual(self.service.queue_depths()['requests'], 1)
+        self.assertTrue(self.service.socket.poll(0))
+
+        self.done.set()
+        self.serve(futures)
+        self.assertEqual(
+            [future.result() for future in futures], [('done', None)] * 3)
+        self.assertEqual(self.service.queue_depths()['requests'], 0)
+
+    def test_handling_error(self):
+        def fail(frames):
+            raise RuntimeError('boom')
+
+        self.service.handle = fail
+        self.done.set()
+        futures = [self.client.call_async('wait') for _ in range(3)]
+        self.serve(futures)
+        for future in futures:
+            res, err = future.result()
+            self.assertTrue(res is None)
+            self.assertEqual(err, 'Cannot handle request: boom')
+
+
+class TestPipelinedRequester(TestConcurrentResponder):
+
+    def setUp(self):
+        super(TestPipelinedRequester, self).setUp()
+        self.client.close()
+        self.client = PipelinedRequester(self.addr, timeouts=(3000, 3000))
+
+    def test_call_async(self):
+        futures = [self.client.call_async('divide', x, 2) for x in range(200)]
+        results = [future.result(3) for future in futures]
+        self.assertEqual(results, [(x / 2, None) for x in range(200)])
+        self.assertEqual(self.client.pending, {})
+
+    def test_slow_calls_overlap(self):
+        started = time.time()
+        futures = [self.client.call_async('sleep', 0.2) for _ in range(8)]
+        results = [future.result(3) for future in futures]
+        self.assertEqual(results, [(0.2, None)] * 8)
+        self.assertTrue(time.time() - started < 8 * 0.2)
+
+    def test_max_outstanding(self):
+        self.client.close()
+        self.client = PipelinedRequester(
+            self.addr, timeouts=(3000, 3000), max_outstanding=4)
+        started = time.time()
+        futures = [self.client.call_async('sleep', 0.2) for _ in range(8)]
+        results = [future.result(3) for future in futures]
+        self.assertEqual(results, [(0.2, None)] * 8)
+        # Two waves of four calls each
+        self.assertTrue(0.4 <= time.time() - started < 8 * 0.2)
+
+    def test_close_fails_pending_calls(self):
+        future = self.client.call_async('sleep', 1)
+        self.client.close()
+        self.assertRaises(ClientError, future.result, 1)
+        self.assertRaises(ClientError, self.client.call_async, 'sleep', 1)
+
+    def test_roundtrip_metrics(self):
+        metrics = self.client.enable_metrics()
+        futures = [self.client.call_async('divide', x, 2) for x in range(5)]
+        for future in futures:
+            future.result(3)
+        # Callbacks run on the I/O thread, which closing waits for
+        self.client.close()
+        self.assertEqual(metrics.histogram('roundtrip').count, 5)
+
+    def test_unencodable_results_free_slots(self):
+        self.client.close()
+        self.client = PipelinedRequester(
+            self.addr, timeouts=(3000, 3000), max_outstanding=2)
+        futures = [self.client.call_async('function') for _ in range(4)]
+        for future in futures:
+            self.assertTrue(future.result(3)[1] is not None)
+        self.assertEqual(self.client.pending, {})
+
+    def test_deadline(self):
+        self.client.close()
+        self.client = PipelinedRequester(
+            self.addr, timeouts=(3000, 200), max_outstanding=1)
+        future = self.client.call_async('sleep', 1)
+        self.assertRaises(ClientError, future.result, 3)
+        self.assertEqual(self.client.pending, {})
+        # The slot of the expired call is free again
+        self.assertEqual(self.client.call('divide', 6, 2), (3, None))
+
+
+class TestPipelinedRequesterSendError(BaseTestCase):
+
+    def test_no_peer(self):
+        # Nothing listens, so IMMEDIATE leaves no pipe to send to
+        self.client = PipelinedRequester(
+            'tcp://127.0.0.1:5599', timeouts=(100, 500), max_outstanding=1,
+            tuning='low-latency')
+        for _ in range(3):
+            future = self.client.call_async('divide', 6, 2)
+            self.assertRaises(ClientError, future.result, 3)
+        self.assertEqual(self.client.pending, {})
+        self.assertTrue(self.client._thread.is_alive())
+
+
+class TestPipelinedRequesterWithResponder(BaseTestCase):
+
+    def test_call_async(self):
+        proc = Process(target=self.start_service, args=(self.addr,))
+        proc.start()
+        self.client = PipelinedRequester(self.addr, timeouts=(3000, 3000))
+        futures = [self.client.call_async('divide', x, 2) for x in range(50)]
+        results = [future.result(3) for future in futures]
+        res, err = self.client.call('divide', 1, 0)
+        proc.terminate()
+        self.assertEqual(results, [(x / 2, None) for x in range(50)])
+        self.assertTrue(res is None)
+        self.assertTrue(err is not None)
+
+
 class TestErrors(BaseTestCase):
 
     def make_req(self, *args):
@@ -69,24 +373,25 @@ class TestErrors(BaseTestCase):
         self.client = Requester(self.addr, timeouts=(3000, 3000))
 
         # Change encoder to force service to fail on encoding
-        # since the service uses a MsgPack encoder
+        # since the service uses a Pickle encoder
         self.client.encoder = encoder.JSONEncoder()
 
         # Build and send payload to service to trigger decoding
-        payload = self.client.build_payload('divide', args)
-        self.client.send(payload)
+        self.client.send(('divide', args), 42)
 
-        # Change back to msg pack encoder to read the service response
-        self.client.encoder = encoder.MsgPackEncoder()
+        # Change back to pickle encoder to read the service response
+        self.client.encoder = encoder.PickleEncoder()
 
-        out = self.client.receive()
+        out = self.client.receive(ref=True)
         proc.terminate()
         return out
 
     def test_decode_error(self):
-        out = self.make_req(6, 2)
-        # response shoud be empty since there was a decode error
-        self.assertEqual('', out)
+        ref, (res, err) = self.make_req(6, 2)
+        # The error reply carries the reference of the request
+        self.assertEqual(ref, 42)
+        self.assertTrue(res is None)
+        self.assertTrue(err.startswith('Cannot decode request'))
 
 
 if __name__ == '__main__':
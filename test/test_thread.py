@@ -0,0 +1,224 @@
+import time
+import threading
+import unittest
+
+from zmqservice import Publisher
+from zmqservice import SubscriberThread
+from zmqservice import SubscriberError
+from zmqservice.thread import SubscriberQueue
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+def upper(tag, line):
+    return line.upper()
+
+
+class TestSubscriberQueue(unittest.TestCase):
+
+    def fill(self, queue, items):
+        for item in items:
+            queue.put(item)
+
+    def drain(self, queue):
+        items = []
+        while True:
+            try:
+                items.append(queue.get(False))
+            except Queue.Empty:
+                return items
+
+    def test_unbounded(self):
+        queue = SubscriberQueue()
+        self.fill(queue, [('a', i) for i in range(10)])
+        self.assertEqual(len(self.drain(queue)), 10)
+        stats = queue.stats()
+        self.assertEqual(stats['enqueued'], 10)
+        self.assertEqual(stats['dropped'], 0)
+        self.assertEqual(stats['peak'], 10)
+        self.assertEqual(stats['depth'], 0)
+
+    def test_block(self):
+        queue = SubscriberQueue(2, 'block')
+        self.fill(queue, [('a', 1), ('a', 2)])
+        self.assertRaises(Queue.Full, queue.put, ('a', 3), True, 0.01)
+        self.assertEqual(self.drain(queue), [('a', 1), ('a', 2)])
+
+    def test_drop_oldest(self):
+        queue = SubscriberQueue(2, 'drop-oldest')
+        self.fill(queue, [('a', 1), ('a', 2), ('a', 3)])
+        self.assertEqual(self.drain(queue), [('a', 2), ('a', 3)])
+        stats = queue.stats()
+        self.assertEqual(stats['enqueued'], 3)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['peak'], 2)
+
+    def test_drop_newest(self):
+        queue = SubscriberQueue(2, 'drop-newest')
+        self.fill(queue, [('a', 1), ('a', 2), ('a', 3)])
+        self.assertEqual(self.drain(queue), [('a', 1), ('a', 2)])
+        self.assertEqual(queue.stats()['enqueued'], 2)
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+    def test_conflate(self):
+        queue = SubscriberQueue(0, 'conflate')
+        self.fill(queue, [('a', 1), ('b', 1), ('a', 2), ('c', 1), ('a', 3)])
+        self.assertEqual(self.drain(queue), [('a', 3), ('b', 1), ('c', 1)])
+        self.assertEqual(queue.stats()['dropped'], 2)
+        self.assertEqual(queue.stats()['peak'], 3)
+
+    def test_conflate_bounded(self):
+        queue = SubscriberQueue(2, 'conflate')
+        self.fill(queue, [('a', 1), ('b', 1), ('c', 1), ('b', 2)])
+        self.assertEqual(self.drain(queue), [('b', 2), ('c', 1)])
+        self.assertEqual(queue.stats()['dropped'], 2)
+
+    def test_task_done(self):
+        queue = SubscriberQueue(1, 'drop-oldest')
+        self.fill(queue, [('a', 1), ('a', 2)])
+        queue.get()
+        queue.task_done()
+        # join() returns once every queued message has been handled
+        queue.join()
+
+    def test_unknown_policy(self):
+        self.assertRaises(SubscriberError, SubscriberQueue, 1, 'nope')
+
+
+class TestSubscriberThread(unittest.TestCase):
+
+    def setUp(self):
+        self.addr = 'inproc://test-thread'
+        self.client = Publisher(self.addr)
+        self.thread = SubscriberThread(
+            self.addr, queue_size=1, queue_policy='conflate')
+        self.results = []
+        self.thread.subscribe('upper', lambda tag, line: self.results.append(
+            line.upper()))
+        self.thread.subscribe('lower', lambda tag, line: self.results.append(
+            line.lower()))
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.close()
+
+    def test_conflate(self):
+        # Run the receive side by hand rather than starting the thread
+        self.client.publish('upper', 'first')
+        self.client.publish('upper', 'second')
+        self.client.publish('lower', 'THIRD')
+        for _ in range(3):
+            self.thread.subscriber.process()
+
+        self.thread.handler(timeout=1)
+        self.assertRaises(Queue.Empty, self.thread.handler, False)
+        self.assertEqual(self.results, ['third'])
+
+        stats = self.thread.stats()
+        self.assertEqual(stats['enqueued'], 3)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['peak'], 1)
+
+
+    def test_close_running_thread(self):
+        self.thread.start()
+        # Publish until the subscription reaches the publisher
+        while not self.results:
+            self.client.publish('upper', 'line')
+            try:
+                self.thread.handler(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.assertEqual(self.results[0], 'LINE')
+        self.thread.close()
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(self.thread.subscriber.socket.closed)
+
+
+class TestSubscriberThreadDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.thread = None
+
+    def start(self, **options):
+        self.thread = SubscriberThread('inproc://test-dispatch', **options)
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.thread.close()
+
+    def test_unknown_pool(self):
+        self.assertRaises(
+            SubscriberError, SubscriberThread, 'inproc://test-dispatch-x',
+            workers=1, pool='fibers')
+
+    def test_ordered_per_tag(self):
+        self.start(workers=4)
+        seen = {}
+        lock = threading.Lock()
+
+        def record(tag, value):
+            time.sleep(0.001 * (value % 3))
+            with lock:
+                seen.setdefault(tag, []).append(value)
+
+        tags = [b'a', b'b', b'c', b'd']
+        self.thread.subscribe('', record)
+        for value in range(20):
+            for tag in tags:
+                self.thread.queue.put((tag, value))
+
+        futures = [self.thread.handler(False) for _ in range(80)]
+        for future in futures:
+            future.result(5)
+        for tag in tags:
+            self.assertEqual(seen[tag], list(range(20)))
+
+    def test_same_partition(self):
+        self.start(workers=3)
+        self.assertIs(self.thread.partition(b'a'), self.thread.partition(b'a'))
+
+    def test_slow_callback_backpressure(self):
+        self.start(workers=1, in_flight=1, queue_size=2,
+                   queue_policy='drop-oldest')
+        handled = []
+        self.thread.subscribe('', lambda tag, value: (
+            time.sleep(0.05), handled.append(value)))
+
+        def consume():
+            while True:
+                try:
+                    self.thread.handler(timeout=0.5)
+                except Queue.Empty:
+                    return
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for value in range(20):
+            self.thread.queue.put((b'slow', value))
+            time.sleep(0.005)
+        consumer.join()
+        self.thread.close()
+
+        # The backlog stayed in the bounded queue, which dropped the excess
+        dropped = self.thread.stats()['dropped']
+        self.assertGreaterEqual(dropped, 10)
+        self.assertEqual(len(handled) + dropped, 20)
+        self.assertEqual(handled[-1], 19)
+
+    def test_process_pool(self):
+        self.start(workers=2, pool='process')
+        self.thread.subscribe('upper', upper)
+        self.thread.queue.put((b'upper', 'hello'))
+        self.thread.queue.put((b'upper.world', 'world'))
+        first = self.thread.handler(False)
+        second = self.thread.handler(False)
+        self.assertEqual(first.result(10), 'HELLO')
+        self.assertEqual(second.result(10), 'WORLD')
+
+
+if __name__ == '__main__':
+    unittest.main()
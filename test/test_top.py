@@ -0,0 +1,85 @@
+import sys
+import unittest
+from multiprocessing import Process
+
+from zmqservice import Responder
+from zmqservice import top
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+STATS = {
+    'pid': 42,
+    'uptime': 10.0,
+    'rss': 3 * 1024 * 1024,
+    'metrics': True,
+    'queues': {'requests': 2, 'replies': 0},
+    'methods': {
+        'fast': {'calls': 10, 'errors': 0, 'mean': 2e-6, 'max': 5e-6,
+                 'p50': 2e-6, 'p90': 3e-6, 'p99': 4e-6, 'p99.9': 5e-6},
+        'slow': {'calls': 5, 'errors': 1, 'mean': 0.2, 'max': 1.5,
+                 'p50': 0.1, 'p90': 0.5, 'p99': 1.5, 'p99.9': 1.5},
+    },
+    'stages': {'decode': {'count': 15, 'p50': 1e-6, 'p99': 3e-6}},
+    'counters': {'bytes_in': 2048, 'bytes_out': 512},
+}
+
+
+def start_service(addr):
+    service = Responder(addr, expose_stats=True)
+    service.register('echo', lambda x: x)
+    service.enable_metrics()
+    service.start()
+
+
+class TestRender(unittest.TestCase):
+
+    def test_format(self):
+        self.assertEqual(top.format_time(None), '-')
+        self.assertEqual(top.format_time(1.5), '1.5s')
+        self.assertEqual(top.format_time(0.0025), '2.5ms')
+        self.assertEqual(top.format_time(4e-6), '4.0us')
+        self.assertEqual(top.format_time(5e-8), '50ns')
+        self.assertEqual(top.format_size(512), '512B')
+        self.assertEqual(top.format_size(3 * 1024 * 1024), '3M')
+
+    def test_render(self):
+        lines = top.render(STATS).splitlines()
+        self.assertIn('rss 3M', lines[0])
+        self.assertEqual(lines[1], 'queues replies 0, requests 2')
+        methods = [line.split()[0] for line in lines[4:6]]
+        self.assertEqual(methods, ['fast', 'slow'])
+        self.assertIn('decode', lines[-1])
+
+    def test_render_sort_and_rate(self):
+        previous = dict(STATS, uptime=5.0, methods={
+            'fast': {'calls': 5}, 'slow': {'calls': 5}})
+        lines = top.render(STATS, previous, sort='p99').splitlines()
+        self.assertEqual(lines[4].split()[:3], ['slow', '5', '0.0'])
+        self.assertEqual(lines[5].split()[:3], ['fast', '10', '1.0'])
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.addr = 'ipc:///tmp/test-top.sock'
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_main(self):
+        proc = Process(target=start_service, args=(self.addr,))
+        proc.start()
+        try:
+            code = top.main([self.addr, '-n', '1'])
+        finally:
+            proc.terminate()
+        self.assertEqual(code, 0)
+        output = sys.stdout.getvalue()
+        self.assertIn('pid {}'.format(proc.pid), output)
+        self.assertIn('echo', output)
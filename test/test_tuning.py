@@ -0,0 +1,124 @@
+import json
+import unittest
+
+import zmq
+
+from zmqservice import Requester
+from zmqservice import Publisher
+from zmqservice import Subscriber
+from zmqservice import ConfigError
+from zmqservice import register_profile
+from zmqservice import config
+from zmqservice import tuning
+
+
+class TestResolve(unittest.TestCase):
+
+    def tearDown(self):
+        tuning.PROFILES.pop('feed', None)
+        tuning.PROFILES.pop('loop', None)
+
+    def test_none(self):
+        self.assertEqual(tuning.resolve(None), {})
+        self.assertEqual(tuning.resolve('default'), {})
+
+    def test_profile(self):
+        options = tuning.resolve('high-throughput')
+        self.assertEqual(options['sndhwm'], 100000)
+        self.assertEqual(options['rcvbuf'], 4 * 1024 * 1024)
+
+    def test_dict_extends_profile(self):
+        options = tuning.resolve({'profile': 'low-latency', 'rcvhwm': 10})
+        self.assertEqual(options['rcvhwm'], 10)
+        self.assertEqual(options['immediate'], 1)
+
+    def test_register_profile(self):
+        register_profile('feed', {'profile': 'bulk', 'sndhwm': 5})
+        options = tuning.resolve('feed')
+        self.assertEqual(options['sndhwm'], 5)
+        self.assertEqual(options['linger'], 30000)
+
+    def test_errors(self):
+        self.assertRaises(ConfigError, tuning.resolve, 'nope')
+        self.assertRaises(ConfigError, tuning.resolve, {'sndtimeo': 1})
+        self.assertRaises(ConfigError, tuning.resolve, {'profile': 'nope'})
+        self.assertRaises(
+            ConfigError, register_profile, 'loop', {'profile': 'loop'})
+
+    def test_config_apply(self):
+        conf = config.load(filecontent=json.dumps({
+            'profiles': 'mine',
+            'zmq': {'profiles': {
+                'feed': {'profile': 'low-latency', 'rcvhwm': 7}}}}))
+        self.assertNotIn('feed', tuning.PROFILES)
+        config.apply(conf)
+        self.assertEqual(tuning.resolve('feed')['rcvhwm'], 7)
+
+
+class TestEndpointTuning(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoints = []
+
+    def tearDown(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def start(self, endpoint):
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def test_default(self):
+        client = self.start(Requester('inproc://test-tuning'))
+        self.assertEqual(client.socket.getsockopt(zmq.SNDHWM), 1000)
+        self.assertEqual(client.socket.getsockopt(zmq.LINGER), 0)
+
+    def test_profile(self):
+        client = self.start(
+            Requester('inproc://test-tuning', tuning='high-throughput'))
+        self.assertEqual(client.socket.getsockopt(zmq.SNDHWM), 100000)
+        self.assertEqual(client.socket.getsockopt(zmq.RCVHWM), 100000)
+
+    def test_options_and_linger(self):
+        publisher = self.start(Publisher(
+            'inproc://test-tuning-pub',
+            tuning={'profile': 'bulk', 'sndhwm': 50}))
+        self.assertEqual(publisher.socket.getsockopt(zmq.SNDHWM), 50)
+        self.assertEqual(publisher.socket.getsockopt(zmq.LINGER), 30000)
+        publisher.socket.setsockopt(zmq.LINGER, 0)
+
+        subscriber = self.start(Subscriber(
+            'inproc://test-tuning-pub', tuning='low-latency'))
+        self.assertEqual(subscriber.socket.getsockopt(zmq.RCVHWM), 1000)
+        self.assertEqual(subscriber.socket.getsockopt(zmq.IMMEDIATE), 1)
+
+    def test_bulk_sends_everything_on_close(self):
+        address = 'tcp://127.0.0.1:5598'
+        publisher = self.start(Publisher(address, tuning='bulk'))
+        # A slow subscriber, so messages are still queued on closing
+        subscriber = self.start(Subscriber(
+            address, timeouts=(None, 3000),
+            tuning={'rcvhwm': 1, 'rcvbuf': 64 * 1024}))
+        subscriber.subscribe('data', lambda tag, message: message)
+        # Wait for the subscription to reach the publisher
+        while True:
+            publisher.publish('data', b'')
+            if subscriber.socket.poll(100):
+                break
+        while subscriber.socket.poll(100):
+            subscriber.process()
+
+        chunk = b'x' * (256 * 1024)
+        for _ in range(200):
+            publisher.publish('data', chunk)
+        publisher.close()
+        for _ in range(200):
+            self.assertEqual(subscriber.process(), chunk)
+
+    def test_unknown_profile(self):
+        self.assertRaises(
+            ConfigError, Requester, 'inproc://test-tuning', tuning='nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
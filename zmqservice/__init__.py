@@ -1,9 +1,19 @@
 """Main module for zmqservice"""
 
+import sys
+
 from zmqservice.thread import SubscriberThread
-from zmqservice.reqrep import Requester, Responder
+from zmqservice.reqrep import (
+    Requester,
+    Responder,
+    ConcurrentResponder,
+    PipelinedRequester
+)
 from zmqservice.pubsub import Subscriber, Publisher
 from zmqservice.crypto import Authenticator
+from zmqservice.metrics import Metrics
+from zmqservice.core import configure_context
+from zmqservice.tuning import register_profile
 from zmqservice.error import (
     ZmqServiceError,
     ServiceError,
@@ -19,13 +29,20 @@ from zmqservice.error import (
 )
 
 __all__ = [
-    'SubscriberThread', 'Requester', 'Responder', 'Subscriber', 'Publisher',
-    'Authenticator', 'ZmqServiceError', 'ServiceError', 'ClientError',
-    'ConfigError', 'AuthenticatorInvalidSignature', 'RequestParseError',
+    'SubscriberThread', 'Requester', 'Responder', 'ConcurrentResponder',
+    'PipelinedRequester', 'Subscriber', 'Publisher',
+    'Authenticator', 'Metrics', 'configure_context', 'register_profile',
+    'ZmqServiceError', 'ServiceError', 'ClientError', 'ConfigError',
+    'AuthenticatorInvalidSignature', 'RequestParseError',
     'PublisherError', 'SubscriberError', 'EncodeError',
     'DecodeError', 'AuthenticateError'
 ]
 
+# asyncio endpoints need Python 3.5+
+if sys.version_info >= (3, 5):
+    from zmqservice.aio import AsyncRequester, AsyncResponder, AsyncSubscriber
+    __all__ += ['AsyncRequester', 'AsyncResponder', 'AsyncSubscriber']
+
 """ # Deprication example...
 ######################################################################
 # Emit warnings for deprecated components
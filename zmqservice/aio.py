@@ -0,0 +1,456 @@
+'''
+The MIT License (MIT)
+
+Copyright (c) 2016 Tony Walker
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import asyncio
+import inspect
+import logging
+
+import zmq
+import zmq.asyncio
+
+from .error import ClientError
+from .error import DecodeError
+from .error import RequestParseError
+from .error import AuthenticateError
+from .error import AuthenticatorInvalidSignature
+from .core import setGlobalContext, split_envelope
+from .reqrep import Responder, Requester, BATCH_METHOD, STATS_METHOD
+from .reqrep import ROUNDTRIP
+from .pubsub import Subscriber, _dispatch_tag
+from .metrics import METHODS, clock
+
+
+def setGlobalAsyncContext():
+    """ Create an asyncio context sharing the global zmq context
+
+    Sharing the underlying context lets asyncio endpoints talk to
+    blocking endpoints of the same process over inproc.
+    """
+    setGlobalContext()
+    context = getattr(zmq, 'asyncio_context', None)
+    if context is None or context.underlying != zmq.context.underlying:
+        zmq.asyncio_context = zmq.asyncio.Context.shadow(
+            zmq.context.underlying)
+
+
+async def _call(fun, *args):
+    """ Call a plain or an `async def` function and return its result """
+    result = fun(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class AsyncProcess(object):
+    """ A long running process driven by an asyncio event loop
+
+    Each received message is handled in its own task, so many handlers
+    can wait on I/O concurrently.
+    """
+
+    tasks = None
+
+    def spawn(self, coro):
+        """ Schedule `coro` as a task tracked by this process """
+        if self.tasks is None:
+            self.tasks = set()
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def start(self):
+        """ Start and listen for messages until stopped """
+        self.logger.debug(
+            'Starting AsyncZMQProcess on {}'.format(self.address))
+        while not self.socket.closed:
+            try:
+                await self.process()
+            except (asyncio.CancelledError, zmq.ZMQError):
+                # Closing the socket (see `stop`) interrupts the receive
+                if not self.socket.closed:
+                    raise
+
+    def stop(self):
+        """ Cancel running handlers and close the socket """
+        self.logger.debug('Stopping AsyncZMQProcess')
+        for task in list(self.tasks or ()):
+            task.cancel()
+        self.close()
+
+
+class AsyncResponder(AsyncProcess, Responder):
+    """ A service which responds to requests concurrently
+
+    Uses a ROUTER socket so it can be called by `Requester` (REQ) and
+    `AsyncRequester` (DEALER) clients. Functions registered with
+    `register` may be plain functions or `async def` functions.
+
+    With `max_tasks` set, at most that many requests are handled at once;
+    further requests wait in the socket queue.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, address, encoder=None, authenticator=None,
+                 socket=None, bind=True, timeouts=(None, None),
+                 multipart=False, compat=False, tuning=None, max_tasks=None,
+                 expose_stats=False):
+        setGlobalAsyncContext()
+        socket = socket or zmq.asyncio_context.socket(zmq.ROUTER)
+        super(AsyncResponder, self).__init__(
+            address, encoder, authenticator, socket, bind, timeouts,
+            multipart, compat, tuning, expose_stats)
+        self.max_tasks = max_tasks
+        # Created on first use, within the event loop
+        self.task_slots = None
+
+    async def execute(self, method, args, ref):
+        """ Execute the method with args and return the response """
+
+        if method == BATCH_METHOD:
+            result, error = await self.execute_many(args), None
+        elif method == STATS_METHOD and self.expose_stats:
+            result, error = self.stats(), None
+        else:
+            result, error = await self.invoke(method, args)
+        return self.build_response(result, error, ref)
+
+    def queue_depths(self):
+        """ Return the number of requests being handled """
+        return {'tasks': len(self.tasks or ())}
+
+    async def execute_many(self, calls):
+        """ Execute a batch of (method, args) calls in order, each once the
+        previous one is done (as `Responder.execute_many` does)
+
+        Returns a list of (result, error) pairs, one for each call
+        """
+        results = []
+        for call in calls:
+            results.append(await self.invoke_call(call))
+        return results
+
+    async def invoke_call(self, call):
+        """ Invoke a (method, args) pair """
+        try:
+            method, args = call
+        except Exception as exception:
+            return None, 'Malformed call: {}'.format(exception)
+        return await self.invoke(method, args)
+
+    async def invoke(self, method, args):
+        """ Call (or await) the function registered as `method` and
+        return a (result, error) pair """
+        fun = self.methods.get(method)
+        if not fun:
+            return None, 'Method `{}` not found'.format(method)
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        try:
+            return await _call(fun, *args), None
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            logging.error(exception, exc_info=1)
+            if metrics is not None:
+                metrics.error(method)
+            return None, str(exception)
+        finally:
+            if metrics is not None:
+                metrics.record(method, clock() - started, METHODS)
+
+    async def process(self):
+        """ Receive a request and handle it in a new task
+
+        With `max_tasks` set, waits for a task to finish first if that
+        many are running
+        """
+        if not self.max_tasks:
+            frames = await self.socket.recv_multipart(copy=False)
+            return self.spawn(self.respond(frames))
+
+        if self.task_slots is None:
+            self.task_slots = asyncio.Semaphore(self.max_tasks)
+        await self.task_slots.acquire()
+        try:
+            frames = await self.socket.recv_multipart(copy=False)
+        except BaseException:
+            self.task_slots.release()
+            raise
+        task = self.spawn(self.respond(frames))
+        task.add_done_callback(lambda _: self.task_slots.release())
+        return task
+
+    # pylint: disable=logging-format-interpolation
+    # pylint: disable=duplicate-code
+    async def respond(self, frames):
+        """ Process a request and send the response back to its sender """
+
+        try:
+            envelope, frames = split_envelope(frames)
+        except RequestParseError as exception:
+            # Without an envelope there is no way to reply
+            logging.error(
+                'Service error while parsing request: {}'
+                .format(exception), exc_info=1)
+            return
+
+        try:
+            method, args, ref = self.unpack_request(frames)
+            response = await self.execute(method, args, ref)
+
+        except AuthenticateError as exception:
+            logging.error(
+                'Service error while authenticating request: {}'
+                .format(exception), exc_info=1)
+            response, ref = self.error_response(
+                frames, 'Cannot authenticate request')
+
+        except AuthenticatorInvalidSignature as exception:
+            logging.error(
+                'Service error while authenticating request: {}'
+                .format(exception), exc_info=1)
+            response, ref = self.error_response(
+                frames, 'Cannot authenticate request')
+
+        except DecodeError as exception:
+            logging.error(
+                'Service error while decoding request: {}'
+                .format(exception), exc_info=1)
+            response, ref = self.error_response(
+                frames, 'Cannot decode request: {}'.format(exception))
+
+        except RequestParseError as exception:
+            logging.error(
+                'Service error while parsing request: {}'
+                .format(exception), exc_info=1)
+            response, ref = self.error_response(
+                frames, 'Cannot parse request: {}'.format(exception))
+
+        else:
+            logging.debug('Service received request: {}'.format(
+                (method, args, ref)))
+
+        frames = self.pack_response(response, ref)
+        await self.socket.send_multipart(envelope + frames, copy=False)
+
+
+class AsyncRequester(Requester):
+    """ A requester client for asyncio
+
+    Uses a DEALER socket so that many calls can be in flight at once.
+    Replies are matched to their calls by reference.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, address, encoder=None, authenticator=None,
+                 socket=None, bind=False, timeouts=(None, None),
+                 multipart=False, compat=False, tuning=None):
+        setGlobalAsyncContext()
+        socket = socket or zmq.asyncio_context.socket(zmq.DEALER)
+        super(AsyncRequester, self).__init__(
+            address, encoder, authenticator, socket, bind, timeouts,
+            multipart, compat, tuning)
+        self.pending = {}
+        self.reader = None
+
+    async def call(self, method, *args):
+        """ Make a call to a `Responder` and return the result """
+        return await self.call_with(None, method, *args)
+
+    # pylint: disable=logging-format-interpolation
+    async def call_with(self, encoder, method, *args):
+        """ Make a call with the request encoded by `encoder` and return
+        the result """
+
+        payload = self.build_payload(method, args)
+        logging.debug('* Client will send payload: {}'.format(payload))
+
+        # Honour the receive timeout (in milliseconds) for the whole call
+        timeout = self.socket.getsockopt(zmq.RCVTIMEO)
+        timeout = timeout / 1000.0 if timeout >= 0 else None
+
+        ref = payload[2]
+        frames = [b''] + self.pack_request(payload, encoder)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[ref] = future
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        try:
+            await self.socket.send_multipart(frames, copy=False)
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.ensure_future(self.read())
+            result = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(ref, None)
+        if metrics is not None:
+            metrics.record(ROUNDTRIP, clock() - started)
+        return result
+
+    async def call_many(self, calls):
+        """ Make many calls to a `Responder` in a single request
+
+        `calls` is a sequence of (method, args) pairs. Returns a list of
+        (result, error) pairs in the same order.
+        """
+        res, err = await self.call(
+            BATCH_METHOD, *[tuple(call) for call in calls])
+        if err is not None:
+            raise ClientError(err)
+        return [tuple(pair) for pair in res]
+
+    async def stats(self):
+        """ Return the stats and health of the `Responder` (see
+        `Responder.stats`) """
+        res, err = await self.call(STATS_METHOD)
+        if err is not None:
+            raise ClientError(err)
+        return res
+
+    # pylint: disable=logging-format-interpolation
+    async def read(self):
+        """ Receive replies and resolve the calls waiting for them """
+        while self.pending:
+            try:
+                frames = await self.socket.recv_multipart(copy=False)
+                _, frames = split_envelope(frames)
+                ref, result, error = self.unpack_response(frames)
+                future = self.pending.get(ref)
+            except zmq.Again:
+                continue
+            except Exception as exception:
+                logging.error(
+                    'Client error while reading response: {}'
+                    .format(exception), exc_info=1)
+                continue
+            if future is not None and not future.done():
+                future.set_result((result, error))
+
+    def close(self):
+        """ Cancel pending calls and close the socket """
+        for future in self.pending.values():
+            future.cancel()
+        if self.reader is not None:
+            self.reader.cancel()
+        super(AsyncRequester, self).close()
+
+
+class AsyncSubscriber(AsyncProcess, Subscriber):
+    """ A Subscriber for asyncio
+
+    Functions passed to `subscribe` may be plain functions or `async def`
+    functions; each message is handled in its own task.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, address, encoder=None, authenticator=None,
+                 socket=None, bind=None, timeouts=(None, None), logger=None,
+                 multipart=False, drain=1, tuning=None):
+        setGlobalAsyncContext()
+        socket = socket or zmq.asyncio_context.socket(zmq.SUB)
+        super(AsyncSubscriber, self).__init__(
+            address, encoder, authenticator, socket, bind, timeouts, logger,
+            multipart, drain, tuning)
+
+    async def receive_subscription(self, flags=0):
+        """ Receive a subscription, verify and decode its message
+
+        Returns a (tag, message, function) tuple
+        """
+        if self.backlog:
+            return self.backlog.popleft()
+        if self.multipart:
+            frames = await self.socket.recv_multipart(flags, copy=False)
+        else:
+            frames = [await self.socket.recv(flags)]
+        return self.parse_subscription(frames)
+
+    # pylint: disable=logging-format-interpolation
+    async def process(self):
+        """ Receive subscriptions and handle them in new tasks
+
+        Waits for a subscription, then drains up to `drain` - 1 more which
+        are already waiting. Returns the last task started (None if
+        nothing to run)
+        """
+
+        received = []
+        flags = 0
+
+        for _ in range(self.drain):
+            try:
+                tag, message, fun = await self.receive_subscription(flags)
+
+            except zmq.Again:
+                if not flags:
+                    raise
+                break
+
+            except (AuthenticateError,
+                    AuthenticatorInvalidSignature) as exception:
+                self.logger.error(
+                    'Subscriber error while authenticating request: {}'
+                    .format(exception), exc_info=1)
+
+            except DecodeError as exception:
+                self.logger.error(
+                    'Subscriber error while decoding request: {}'
+                    .format(exception), exc_info=1)
+
+            except RequestParseError as exception:
+                self.logger.error(
+                    'Subscriber error while parsing request: {}'
+                    .format(exception), exc_info=1)
+            else:
+                self.logger.debug(
+                    'Subscriber received payload: {}'
+                    .format(message))
+                if fun is not None:
+                    received.append((tag, message, fun))
+
+            flags = zmq.NOBLOCK
+
+        task = None
+        for fun, args in self.schedule(received):
+            task = self.spawn(self.dispatch(fun, *args))
+        return task
+
+    async def dispatch(self, fun, *args):
+        """ Run a subscribed function """
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        try:
+            return await _call(fun, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            self.logger.error(exception, exc_info=1)
+        finally:
+            if metrics is not None:
+                metrics.record(_dispatch_tag(self.index, args),
+                               clock() - started, METHODS)
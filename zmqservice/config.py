@@ -3,6 +3,9 @@
 import io
 import json
 
+from .core import configure_context
+from .tuning import register_profile
+
 
 class DotDict(dict):
     """ Access a dictionary like an object """
@@ -23,6 +26,8 @@ def load(filepath=None, filecontent=None):
     Usage:
         config.load(filepath=None, filecontent=None):
         Provide either a filepath or a json string
+
+    Nothing is applied to zmq: see `apply`.
     """
     conf = DotDict()
 
@@ -33,3 +38,24 @@ def load(filepath=None, filecontent=None):
     configs = json.loads(filecontent)
     conf.update(configs.items())
     return conf
+
+
+def apply(conf):
+    """ Apply the zmq settings of a configuration read by `load`
+
+    They are read from its `zmq` object, the rest of the configuration
+    being left to the service. Its `context` object sets the options of
+    the zmq context shared by the endpoints of the process (see
+    `configure_context`), e.g.:
+        {"zmq": {"context": {"io_threads": 2, "max_sockets": 4096}}}
+
+    Its `profiles` object adds socket tuning profiles, which endpoints use
+    by name with `tuning` (see `register_profile`), e.g.:
+        {"zmq": {"profiles": {"feed": {"profile": "low-latency",
+                                       "rcvhwm": 100}}}}
+    """
+    settings = conf.get('zmq', {})
+    if 'context' in settings:
+        configure_context(**settings['context'])
+    for name, options in settings.get('profiles', {}).items():
+        register_profile(name, options)
@@ -25,6 +25,7 @@ SOFTWARE.
 
 import os
 import sys
+import struct
 import signal
 import logging
 import threading
@@ -35,15 +36,89 @@ from .error import DecodeError
 from .error import AuthenticateError
 from .error import AuthenticatorInvalidSignature
 from .error import EndpointError
+from .error import ConfigError
+from .error import RequestParseError
+from .encoder import TaggedEncoder
+from .metrics import Metrics, clock, frames_size
+from . import tuning as tuning_profiles
+
+
+# Multipart messages start with a fixed-size header frame of the form:
+# (wire-version, flags)
+# Version 2 messages are signed with a binary rather than a hex digest
+WIRE_VERSION = 1
+WIRE_VERSION_BINARY = 2
+HEADER = struct.Struct('!BB')
+
+# Header flags
+FLAG_BATCH = 0x01  # Each frame after the header is a separate message
+FLAG_REF = 0x02    # The header is followed by a REF frame
+FLAG_BUFFERS = 0x04  # The body is followed by out-of-band buffer frames
+
+# Requests and replies carry a 64-bit reference matching replies to calls.
+# It prefixes the (signed) body of flat messages and travels in its own
+# frame in multipart messages.
+REF = struct.Struct('!Q')
+
+
+# Options of the zmq context which may be set with `configure_context`
+CONTEXT_OPTIONS = (
+    'io_threads', 'max_sockets', 'max_msgsz', 'ipv6', 'blocky',
+    'thread_priority', 'thread_sched_policy',
+)
+
+# Options given to `configure_context`, applied to new contexts
+_context_options = {}
+
+
+def configure_context(**options):
+    """ Set options of the zmq context shared by all the endpoints of a
+    process, by their lower case zmq names:
+
+        io_threads   background I/O threads (default 1); raise it for
+                     processes moving a lot of data over tcp or ipc
+        max_sockets  maximum number of sockets (default 1023)
+
+    and max_msgsz, ipv6, blocky, thread_priority and thread_sched_policy.
+
+    io_threads and max_sockets only take effect before the first socket
+    of the context is created, so call this before creating endpoints.
+    The options also apply to contexts created after a fork.
+    """
+    for name in options:
+        if name not in CONTEXT_OPTIONS or not hasattr(zmq, name.upper()):
+            raise ConfigError('Unknown context option: {}'.format(name))
+    _context_options.update(options)
+
+    if getattr(zmq, 'procId', None) == os.getpid():
+        _set_context_options(zmq.context, options)
+
+
+def _set_context_options(context, options):
+    for name, value in options.items():
+        context.set(getattr(zmq, name.upper()), value)
+
+
+def create_context():
+    """ Return a new zmq context with the options of `configure_context` """
+    context = zmq.Context()
+    _set_context_options(context, _context_options)
+    return context
+
 
 def setGlobalContext():
+    """ Create the zmq context shared by all the endpoints of a process
+
+    Endpoints of a process talk over inproc through this context, from
+    any thread and without going through the kernel.
+    """
     procId = getattr(zmq, 'procId', None)
     # This is the first import or ...
     # This is a new process (from a fork or similar), the old context is stale
     if (procId is None and getattr(zmq, 'context', None) is None) or \
        procId != os.getpid():
 
-        zmq.context = zmq.Context()
+        zmq.context = create_context()
         zmq.procId = os.getpid()
 
 class Endpoint(object):
@@ -57,12 +132,30 @@ class Endpoint(object):
         encode -> sign(*) -> socket send
 
     (*) Sign/Verify only if authenticator is available
+
+    `tuning` sets socket options such as high water marks and kernel
+    buffer sizes: the name of a profile (low-latency, high-throughput,
+    bulk or one added with `register_profile`) or a dict of options.
+
+    Call `enable_metrics` to record the time spent in each stage and the
+    bytes sent and received (see `Metrics`); disabled it costs an
+    attribute lookup per stage.
+
+    By default a message travels as a single frame with the signature
+    appended to the encoded payload. With `multipart` enabled the header,
+    body and signature travel as separate frames and are sent and received
+    without copying:
+        [header, body, signature(*)]
     """
 
+    # Metrics recorded by this endpoint, None unless enabled
+    metrics = None
+
     # pylint: disable=too-many-arguments
     # pylint: disable=no-member
     def __init__(self, socket, address, bind, encoder, authenticator,
-                 timeouts=(None, None), logger=None):
+                 timeouts=(None, None), logger=None, multipart=False,
+                 tuning=None):
 
         # timeouts must be a pair of the form:
         # (send-timeout-value, recv-timeout-value)
@@ -73,11 +166,16 @@ class Endpoint(object):
         self.encoder = encoder
         self.authenticator = authenticator
         self.logger = logger or logging.getLogger()
+        self.multipart = multipart
+        self.tuning = tuning
         self.initialize(timeouts)
 
     def initialize(self, timeouts):
         """ Bind or connect the zmq socket to some address """
 
+        # Socket options only apply to connections made afterwards
+        tuning_profiles.apply(self.socket, self.tuning, self.logger)
+
         # Bind or connect to address
         try:
             if self.bind is True:
@@ -85,11 +183,39 @@ class Endpoint(object):
             else:
                 self.socket.connect(self.address)
         except zmq.error.ZMQError:
-            self.socket.connect(self.address)
+            self._connect()
 
         # Set send and recv timeouts
         self._set_timeouts(timeouts)
 
+    def _connect(self):
+        try:
+            self.socket.connect(self.address)
+        except zmq.error.ZMQError as exception:
+            if not self.address.startswith('inproc://'):
+                raise
+            # libzmq < 4 refuses inproc connections before the bind
+            raise EndpointError(
+                'Cannot connect to {} ({}): bind inproc endpoints first, '
+                'from the same process'.format(self.address, exception))
+
+    def close(self):
+        """ Unbind (if bound) and close the zmq socket
+
+        A socket which lingers is not unbound, as unbinding drops the
+        messages still queued for its peers: its address is released
+        once they are sent (or the linger period is over).
+        """
+        if self.bind is True and not self.socket.closed and \
+           self.socket.getsockopt(zmq.LINGER) == 0:
+            try:
+                # Release the address right away instead of waiting for
+                # the socket to be reaped, so it can be bound again
+                self.socket.unbind(self.address)
+            except zmq.error.ZMQError:
+                pass
+        self.socket.close()
+
     def _set_timeouts(self, timeouts):
         #Set socket timeouts for send and receive respectively
 
@@ -108,30 +234,202 @@ class Endpoint(object):
         if recv_timeout is not None:
             self.socket.setsockopt(zmq.RCVTIMEO, recv_timeout)
 
-    def send(self, payload):
+    def enable_metrics(self, metrics=None):
+        """ Start recording metrics, into `metrics` if given (to share
+        them between endpoints), and return them """
+        self.metrics = metrics or Metrics()
+        return self.metrics
+
+    def disable_metrics(self):
+        """ Stop recording metrics """
+        self.metrics = None
+
+    def send(self, payload, ref=None):
         """ Encode and sign (optional) the send through socket """
-        payload = self.encode(payload)
-        payload = self.sign(payload)
-        self.socket.send(payload)
+        if self.multipart:
+            self.socket.send_multipart(self.pack(payload, ref), copy=False)
+            return
+        self.socket.send(self.pack(payload, ref)[0])
 
-    def receive(self, decode=True):
+    def receive(self, decode=True, ref=False):
         """ Receive from socket, authenticate and decode payload """
-        payload = self.socket.recv()
-        payload = self.verify(payload)
+        if self.multipart:
+            frames = self.socket.recv_multipart(copy=False)
+        else:
+            frames = [self.socket.recv()]
+        return self.unpack(frames, decode, ref)
+
+    def pack(self, payload, ref=None, encoder=None):
+        """ Encode and sign (optional) payload into the frames of a message
+
+        Used by sockets which need to prepend a routing envelope. A `ref`
+        (64-bit unsigned int) is carried in the message header
+        """
+        if self.multipart:
+            return self.build_frames(payload, ref=ref, encoder=encoder)
+        body = self.encode(payload, encoder)
+        if ref is not None:
+            body = REF.pack(ref) + body
+        return [self.sign(body)]
+
+    def unpack(self, frames, decode=True, ref=False):
+        """ Authenticate and decode the frames of a message (sans envelope)
+
+        With `ref` returns a (ref, payload) pair
+        """
+        if self.multipart:
+            return self.parse_frames(frames, decode, ref)
+        if len(frames) != 1:
+            raise DecodeError('Unexpected multipart message')
+        payload = self.verify(_bytes(frames[0]))
+        if ref:
+            if len(payload) < REF.size:
+                raise DecodeError('Message has no reference')
+            reference = REF.unpack_from(payload)[0]
+            payload = payload[REF.size:]
         if decode:
             payload = self.decode(payload)
+        if ref:
+            return reference, payload
         return payload
 
+    def read_ref(self, frames):
+        """ Return the reference of a message (sans envelope) without
+        verifying or decoding it, or None if it has none """
+        if self.multipart:
+            if len(frames) < 3:
+                return None
+            header, reference = _buffer(frames[0]), _buffer(frames[1])
+            if len(header) != HEADER.size or len(reference) != REF.size or \
+               not HEADER.unpack(header)[1] & FLAG_REF:
+                return None
+            return REF.unpack(reference)[0]
+        if len(frames) != 1:
+            return None
+        payload = _bytes(frames[0])
+        if len(payload) < REF.size:
+            return None
+        return REF.unpack_from(payload)[0]
+
+    def build_frames(self, payload, flags=0, ref=None, encoder=None,
+                     tag=None):
+        """ Encode payload into a list of frames:
+        [header, ref(*), body, buffer(*)..., sig(*)]
+
+        A subscription `tag`, sent in a frame of its own ahead of these,
+        is covered by the signature """
+        body, buffers = self.encode_frames(payload, encoder)
+        if buffers:
+            flags |= FLAG_BUFFERS
+        if ref is None:
+            frames = [self.build_header(flags)]
+        else:
+            frames = [self.build_header(flags | FLAG_REF),
+                      REF.pack(ref)]
+        frames.append(body)
+        frames.extend(buffers)
+        return self.sign_frames(frames, tag)
+
+    def build_header(self, flags=0):
+        """ Return the header frame of a multipart message """
+        if self.authenticator and self.authenticator.binary:
+            return HEADER.pack(WIRE_VERSION_BINARY, flags)
+        return HEADER.pack(WIRE_VERSION, flags)
+
+    def build_batch(self, encoded, tag=None):
+        """ Sign already encoded payloads into the frames of a batch:
+        [header, body, body, ..., sig(*)] """
+        frames = [self.build_header(FLAG_BATCH)]
+        frames.extend(encoded)
+        return self.sign_frames(frames, tag)
+
+    def parse_frames(self, frames, decode=True, ref=False):
+        """ Verify the frames of a multipart message and decode its body
+
+        With `ref` returns a (ref, payload) pair
+        """
+        reference, payloads = self.read_frames(frames, decode)
+        if len(payloads) != 1:
+            raise DecodeError('Unexpected batch of messages')
+        if not ref:
+            return payloads[0]
+        if reference is None:
+            raise DecodeError('Message has no reference')
+        return reference, payloads[0]
+
+    def parse_batch(self, frames, decode=True, tag=None):
+        """ Verify the frames of a multipart message and decode its bodies
+
+        Returns a list of payloads, of a single one unless the message
+        is a batch. The signature must cover the subscription `tag` if
+        given.
+        """
+        return self.read_frames(frames, decode, tag)[1]
+
+    def read_frames(self, frames, decode=True, tag=None):
+        """ Verify the frames of a multipart message and split them
+
+        Returns a (ref, payloads) pair, ref being None unless the header
+        has FLAG_REF set. Undecoded messages with out-of-band buffers are
+        returned as a (body, buffers) payload.
+        """
+        frames = self.verify_frames(
+            [_buffer(frame) for frame in frames], tag)
+        if len(frames) < 2 or len(frames[0]) != HEADER.size:
+            raise DecodeError('Malformed multipart message')
+        version, flags = HEADER.unpack(frames[0])
+        if version not in (WIRE_VERSION, WIRE_VERSION_BINARY):
+            raise DecodeError(
+                'Unsupported wire version: {}'.format(version))
+        payloads = frames[1:]
+        reference = None
+        if flags & FLAG_REF:
+            if len(payloads) < 2 or len(payloads[0]) != REF.size:
+                raise DecodeError('Malformed multipart message')
+            reference = REF.unpack(payloads[0])[0]
+            payloads = payloads[1:]
+        if flags & FLAG_BUFFERS:
+            if flags & FLAG_BATCH or not payloads:
+                raise DecodeError('Malformed multipart message')
+            body, buffers = payloads[0], payloads[1:]
+            if decode:
+                return reference, [self.decode(body, buffers)]
+            return reference, [(body, buffers)]
+        if len(payloads) != 1 and not flags & FLAG_BATCH:
+            raise DecodeError('Malformed multipart message')
+        if decode:
+            payloads = [self.decode(payload) for payload in payloads]
+        return reference, payloads
+
     def sign(self, payload):
         """ Sign payload using the supplied authenticator """
+        metrics = self.metrics
         if self.authenticator:
-            return self.authenticator.signed(payload)
+            if metrics is None:
+                payload = self.authenticator.signed(payload)
+            else:
+                started = clock()
+                payload = self.authenticator.signed(payload)
+                metrics.record('sign', clock() - started)
+        if metrics is not None:
+            metrics.transfer('out', len(payload))
         return payload
 
     def verify(self, payload):
         """ Verify payload authenticity via the supplied authenticator """
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.transfer('in', len(payload))
         if not self.authenticator:
             return payload
+        if metrics is None:
+            return self._verify(payload)
+        started = clock()
+        payload = self._verify(payload)
+        metrics.record('verify', clock() - started)
+        return payload
+
+    def _verify(self, payload):
         try:
             self.authenticator.auth(payload)
             return self.authenticator.unsigned(payload)
@@ -140,19 +438,175 @@ class Endpoint(object):
         except Exception as exception:
             raise AuthenticateError(str(exception))
 
-    def decode(self, payload):
-        """ Decode payload """
+    def sign_frames(self, frames, tag=None):
+        """ Append a signature frame using the supplied authenticator
+
+        The signature also covers `tag` if given, a frame which is sent
+        ahead of the message (the subscription tag of pub/sub)
+        """
+        metrics = self.metrics
+        if self.authenticator:
+            if metrics is None:
+                frames.append(self._sign_frames(frames, tag))
+            else:
+                started = clock()
+                frames.append(self._sign_frames(frames, tag))
+                metrics.record('sign', clock() - started)
+        if metrics is not None:
+            metrics.transfer('out', frames_size(frames))
+        return frames
+
+    def _sign_frames(self, frames, tag=None):
+        if tag is not None:
+            frames = [tag] + frames
+        return self.authenticator.sign_frames(frames)
+
+    def verify_frames(self, frames, tag=None):
+        """ Verify and strip the signature frame of a multipart message,
+        which must also cover `tag` if given """
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.transfer('in', frames_size(frames))
+        if not self.authenticator:
+            return frames
+        if metrics is None:
+            return self._verify_frames(frames, tag)
+        started = clock()
+        frames = self._verify_frames(frames, tag)
+        metrics.record('verify', clock() - started)
+        return frames
+
+    def _verify_frames(self, frames, tag=None):
+        try:
+            frames, signature = frames[:-1], frames[-1]
+            # The wire version tells whether the signature is binary
+            binary = bytearray(frames[0][:1])[0] == WIRE_VERSION_BINARY
+            signed = frames if tag is None else [tag] + frames
+            self.authenticator.auth_frames(signed, signature, binary)
+            return frames
+        except AuthenticatorInvalidSignature:
+            raise
+        except Exception as exception:
+            raise AuthenticateError(str(exception))
+
+    def decode(self, payload, buffers=None):
+        """ Decode payload (and its out-of-band buffers) """
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
         try:
-            return self.encoder.decode(payload)
+            if buffers:
+                payload = self.encoder.decode_frames(payload, buffers)
+            else:
+                payload = self.encoder.decode(payload)
         except Exception as exception:
             raise DecodeError(str(exception))
+        if metrics is not None:
+            metrics.record('decode', clock() - started)
+        return payload
 
-    def encode(self, payload):
-        """ Encode payload """
+    def encode(self, payload, encoder=None):
+        """ Encode payload (with `encoder` if given, which needs a
+        TaggedEncoder to tell the receiver) """
+        args = (payload,) if encoder is None else \
+            self._encode_args(payload, encoder)
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        try:
+            encoded = self.encoder.encode(*args)
+        except Exception as exception:
+            raise EncodeError(str(exception))
+        if metrics is not None:
+            metrics.record('encode', clock() - started)
+        return encoded
+
+    def encode_frames(self, payload, encoder=None):
+        """ Encode payload into a (body, buffers) pair. Encoders which
+        support it return buffers to be sent as frames without copying """
+        args = (payload,) if encoder is None else \
+            self._encode_args(payload, encoder)
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
         try:
-            return self.encoder.encode(payload)
+            if hasattr(self.encoder, 'encode_frames'):
+                encoded = self.encoder.encode_frames(*args)
+            else:
+                encoded = self.encoder.encode(*args), []
         except Exception as exception:
             raise EncodeError(str(exception))
+        if metrics is not None:
+            metrics.record('encode', clock() - started)
+        return encoded
+
+    def _encode_args(self, payload, encoder):
+        if encoder is None or encoder is self.encoder:
+            return (payload,)
+        if not isinstance(self.encoder, TaggedEncoder):
+            raise EncodeError(
+                'Choosing an encoder per message needs a TaggedEncoder')
+        return (payload, encoder)
+
+
+def split_envelope(frames):
+    """ Split a message into its routing envelope and its content
+
+    The envelope is made of all frames up to (and including) the
+    empty delimiter frame, as used by REQ, REP and ROUTER sockets.
+    """
+    for position, frame in enumerate(frames):
+        if not len(_buffer(frame)):
+            return frames[:position + 1], frames[position + 1:]
+    raise RequestParseError('Message has no envelope delimiter')
+
+
+def _buffer(frame):
+    """ Return a zero-copy view of a received frame """
+    return getattr(frame, 'buffer', frame)
+
+
+def _bytes(frame):
+    """ Return the content of a received frame as bytes """
+    return getattr(frame, 'bytes', frame)
+
+
+class Waker(object):
+    """ Wake up a thread polling zmq sockets from any other thread
+
+    zmq sockets must not be used by more than one thread at a time, so
+    other threads queue their work and call `wake`. The polling thread
+    registers `socket` and calls `clear` when it becomes readable.
+    """
+
+    def __init__(self):
+        setGlobalContext()
+        address = 'inproc://zmqservice-waker-{}'.format(id(self))
+        self.lock = threading.Lock()
+        self.socket = zmq.context.socket(zmq.PULL)
+        self.socket.linger = 0
+        self.socket.bind(address)
+        self._waker = zmq.context.socket(zmq.PUSH)
+        self._waker.linger = 0
+        self._waker.connect(address)
+
+    def wake(self):
+        """ Make `socket` readable (callable from any thread) """
+        with self.lock:
+            self._waker.send(b'')
+
+    def clear(self):
+        """ Drain pending wake ups (from the polling thread) """
+        while True:
+            try:
+                self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+    def close(self):
+        """ Close both ends """
+        self._waker.close()
+        self.socket.close()
 
 
 class Process(object):
@@ -172,5 +626,5 @@ class Process(object):
     def stop(self, dummy_signum=None, dummy_frame=None):
         """ Shutdown process (this method is also a signal handler) """
         self.logger.debug('Stopping ZMQProcess')
-        self.socket.close()
+        self.close()
         sys.exit(0)
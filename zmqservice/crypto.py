@@ -23,28 +23,93 @@ SOFTWARE.
 
 '''
 
+import sys
 import hmac
+import struct
 import hashlib
 
 from .error import AuthenticatorInvalidSignature
 
 
+_LENGTH = struct.Struct('!Q')
+_KEY_ID = struct.Struct('!B')
+
+
 class Authenticator(object):
-    """ This object is used to authenticate messages """
+    """ This object is used to authenticate messages
+
+    Signatures are hex digests unless `binary` is set, which halves their
+    size. Multipart endpoints tell which kind a message carries by its wire
+    version, so binary signers can still be verified by (and verify) hex
+    peers. Single frame messages have no such header: both ends must use
+    the same kind.
 
-    def __init__(self, secret, digestmod=None):
+    With a `key_id` (0-255) the authenticator holds a keyring: signatures
+    start with the id of the key which made them and are verified with
+    any key added with `add_key`. To rotate, add the new key everywhere,
+    then `use_key` it everywhere, then `retire_key` the old one.
+    """
+
+    def __init__(self, secret, digestmod=None, binary=False, key_id=None):
         assert secret
         self.secret = secret.encode('utf-8')
         self.digestmod = digestmod or hashlib.sha256
-        self.sig_size = self.digestmod().digest_size * 2
+        self.binary = binary
+        self.digest_size = self.digestmod().digest_size
+        self.sig_size = self.digest_size * (1 if binary else 2)
+        self.keys = {}
         self._hmac = hmac.new(self.secret, digestmod=self.digestmod)
+        # (key id prefix, precomputed HMAC) used to sign
+        self._signer = (b'', self._hmac)
+        self.key_id = key_id
+        if key_id is not None:
+            self.sig_size += _KEY_ID.size
+            self.add_key(key_id, secret)
+            self.use_key(key_id)
+
+    def add_key(self, key_id, secret):
+        """ Accept signatures made with `secret` under `key_id` """
+        if self.key_id is None:
+            raise ValueError('Keys need an authenticator with a key_id')
+        _KEY_ID.pack(key_id)  # Validate the id
+        assert secret
+        self.keys[key_id] = hmac.new(
+            secret.encode('utf-8'), digestmod=self.digestmod)
+
+    def use_key(self, key_id):
+        """ Sign with the key added under `key_id` """
+        self._signer = (_KEY_ID.pack(key_id), self.keys[key_id])
+        self.key_id = key_id
+
+    def retire_key(self, key_id):
+        """ Stop accepting signatures made with `key_id` """
+        if key_id == self.key_id:
+            raise ValueError('Key {} is used to sign'.format(key_id))
+        del self.keys[key_id]
 
     def sign(self, encoded):
         """ Return authentication signature of encoded bytes """
-        signature = self._hmac.copy()
+        prefix, state = self._signer
+        signature = state.copy()
         signature.update(encoded)
+        return prefix + self._digest(signature, self.binary)
+
+    @staticmethod
+    def _digest(signature, binary):
+        if binary:
+            return signature.digest()
         return signature.hexdigest().encode('utf-8')
 
+    def _verifier(self, signature):
+        """ Return the precomputed HMAC which made a signature and the
+        signature sans key id """
+        if self.key_id is None:
+            return self._hmac, signature
+        state = self.keys.get(bytearray(signature[:1] or b'\0')[0])
+        if state is None:
+            raise AuthenticatorInvalidSignature('Unknown key id')
+        return state, signature[_KEY_ID.size:]
+
     def signed(self, encoded):
         """ Sign encoded bytes and append signature """
         signature = self.sign(encoded)
@@ -53,18 +118,48 @@ class Authenticator(object):
     def unsigned(self, encoded):
         """ Remove signature and return just the message """
         message, _ = self.split(encoded)
+        if sys.version_info[0] < 3:
+            # Python 2 decoders do not read memoryviews
+            return message.tobytes()
         return message
 
     def split(self, encoded):
-        """ Split into signature and message """
-        maxlen = len(encoded) - self.sig_size
-        message = encoded[:maxlen]
-        signature = encoded[-self.sig_size:]
-        return message, signature
+        """ Split into signature and message (memoryviews, so the message
+        is not copied) """
+        view = memoryview(encoded)
+        maxlen = max(len(view) - self.sig_size, 0)
+        return view[:maxlen], view[maxlen:]
+
+    def sign_frames(self, frames, binary=None):
+        """ Return authentication signature of a sequence of frames
+
+        Each frame is prefixed by its length so that frame boundaries
+        are covered by the signature. Frames are never concatenated.
+        """
+        prefix, state = self._signer
+        return prefix + self._hash_frames(state, frames, binary)
+
+    def _hash_frames(self, state, frames, binary=None):
+        signature = state.copy()
+        for frame in frames:
+            signature.update(_LENGTH.pack(len(frame)))
+            signature.update(frame)
+        return self._digest(
+            signature, self.binary if binary is None else binary)
+
+    def auth_frames(self, frames, signature, binary=None):
+        """ Validate integrity of a sequence of frames """
+        state, signature = self._verifier(memoryview(signature).tobytes())
+        computed = self._hash_frames(state, frames, binary)
+        if not hmac.compare_digest(signature, computed):
+            raise AuthenticatorInvalidSignature
 
     def auth(self, encoded):
         """ Validate integrity of encoded bytes """
         message, signature = self.split(encoded)
-        computed = self.sign(message)
-        if not hmac.compare_digest(signature, computed):
+        state, signature = self._verifier(signature.tobytes())
+        computed = state.copy()
+        computed.update(message)
+        if not hmac.compare_digest(
+                signature, self._digest(computed, self.binary)):
             raise AuthenticatorInvalidSignature
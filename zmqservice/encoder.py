@@ -23,14 +23,68 @@ SOFTWARE.
 
 '''
 
+import sys
+import zlib
 import json
+import uuid
 import pickle
+import struct
+import decimal
 import logging
+import datetime
+import threading
+import collections
 import msgpack
 
+from .error import DecodeError
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# numpy is slow to import, so it is imported on first use (see load_numpy)
+numpy = None
+_numpy_missing = False
+
+_TAG = struct.Struct('!B')
+_COUNT = struct.Struct('!I')
+_LENGTH = struct.Struct('!Q')
+
+
+def load_numpy():
+    """ Import numpy on first use and return it, or None if it is not
+    installed """
+    # pylint: disable=global-statement
+    global numpy, _numpy_missing
+    if numpy is None and not _numpy_missing:
+        try:
+            import numpy as module
+        except ImportError:
+            _numpy_missing = True
+        else:
+            numpy = module
+    return numpy
+
 
 class Encoder(object):
-    """ Base encoder class """
+    """ Base encoder class
+
+    `content_type` is the one-byte id a `TaggedEncoder` prefixes messages
+    with (see `register`)
+    """
+
+    content_type = None
 
     # pylint: disable=unused-argument
     @classmethod
@@ -44,10 +98,22 @@ class Encoder(object):
         """ Base decode function """
         logging.error('Decoding fun not implemented')
 
+    def encode_frames(self, data):
+        """ Encode data into a (body, buffers) pair. Multipart endpoints
+        send the buffers as separate frames without copying them """
+        return self.encode(data), []
+
+    # pylint: disable=unused-argument
+    def decode_frames(self, data, buffers):
+        """ Decode a body and its out-of-band buffers """
+        return self.decode(data)
+
 
 class JSONEncoder(Encoder):
     """ JSON encoder for zmqservice message """
 
+    content_type = 1
+
     def __init__(self):
         super(JSONEncoder, self).__init__()
 
@@ -55,30 +121,572 @@ class JSONEncoder(Encoder):
         return json.dumps(data).encode('utf-8')
 
     def decode(self, data):
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
         return json.loads(data.decode('utf-8'))
 
 
 class MsgPackEncoder(Encoder):
-    """ MsgPack encoder for zmqservice message """
+    """ MsgPack encoder for zmqservice message
+
+    Besides plain types, datetimes, Decimals and UUIDs are sent as msgpack
+    ext types. Each thread reuses its own Packer. `encode_stream` and
+    `decode_stream` handle batches of messages concatenated in one buffer.
+    """
+
+    content_type = 2
 
     def __init__(self):
         super(MsgPackEncoder, self).__init__()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._local = threading.local()
 
     def encode(self, data):
-        return msgpack.packb(data)
+        packer = getattr(self._local, 'packer', None)
+        if packer is None:
+            packer = self._local.packer = msgpack.Packer(
+                default=_msgpack_default)
+        try:
+            return packer.pack(data)
+        except Exception:
+            # Do not reuse a packer which may hold a partial message
+            self._local.packer = None
+            raise
 
     def decode(self, data):
-        return msgpack.unpackb(data, encoding='utf-8')
+        return msgpack.unpackb(data, raw=False, ext_hook=_msgpack_ext_hook)
+
+    def encode_stream(self, messages):
+        """ Encode messages into one buffer """
+        return b''.join(self.encode(message) for message in messages)
+
+    def decode_stream(self, data):
+        """ Decode all the messages concatenated in a buffer """
+        unpacker = msgpack.Unpacker(raw=False, ext_hook=_msgpack_ext_hook)
+        unpacker.feed(data)
+        return list(unpacker)
+
+
+# msgpack ext type codes
+EXT_DATETIME = 1
+EXT_DECIMAL = 2
+EXT_UUID = 3
+
+# (seconds, microseconds) of wall time since the epoch,
+# (utc offset in seconds, has offset)
+_DATETIME = struct.Struct('!qIi?')
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _msgpack_default(obj):
+    """ Pack the types msgpack does not know as ext types """
+    if isinstance(obj, datetime.datetime):
+        offset = obj.utcoffset()
+        wall = obj.replace(tzinfo=None) - _EPOCH
+        return msgpack.ExtType(EXT_DATETIME, _DATETIME.pack(
+            wall.days * 86400 + wall.seconds, wall.microseconds,
+            int(offset.total_seconds()) if offset is not None else 0,
+            offset is not None))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode('ascii'))
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    raise TypeError('Cannot serialize {!r}'.format(obj))
+
+
+def _msgpack_ext_hook(code, data):
+    """ Unpack the ext types packed by `_msgpack_default` """
+    if code == EXT_DATETIME:
+        seconds, microseconds, offset, aware = _DATETIME.unpack(data)
+        value = _EPOCH + datetime.timedelta(
+            seconds=seconds, microseconds=microseconds)
+        if aware:
+            value = value.replace(tzinfo=_timezone(offset))
+        return value
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode('ascii'))
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=bytes(data))
+    return msgpack.ExtType(code, data)
+
+
+class _FixedOffset(datetime.tzinfo):
+    """ A fixed UTC offset (datetime.timezone is Python 3 only) """
+
+    def __init__(self, offset):
+        super(_FixedOffset, self).__init__()
+        self.offset = datetime.timedelta(seconds=offset)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC{:+}'.format(int(self.offset.total_seconds()))
+
+
+def _timezone(offset):
+    """ Return a tzinfo for an offset in seconds """
+    if hasattr(datetime, 'timezone'):
+        return datetime.timezone(datetime.timedelta(seconds=offset))
+    return _FixedOffset(offset)
 
 
 class PickleEncoder(Encoder):
-    """ Pickle encoder for zmqservice message """
+    """ Pickle encoder for zmqservice message
 
-    def __init__(self):
+    `protocol` defaults to the interpreter's default, which both Python 2
+    and 3 can read; pass pickle.HIGHEST_PROTOCOL for speed when both ends
+    run the same Python.
+
+    With `out_of_band` (pickle protocol 5, Python 3.8+) buffers of at least
+    `min_size` bytes are sent by multipart endpoints as separate frames
+    without copying: data wrapped in pickle.PickleBuffer, numpy arrays and
+    other types supporting protocol 5. PickleBuffers are received as
+    memoryviews over the frames.
+    """
+
+    content_type = 3
+
+    # Smaller frames are copied by pyzmq anyway (zmq.COPY_THRESHOLD)
+    MIN_SIZE = 65536
+
+    def __init__(self, protocol=None, out_of_band=False, min_size=MIN_SIZE):
         super(PickleEncoder, self).__init__()
+        if out_of_band:
+            if pickle.HIGHEST_PROTOCOL < 5:
+                raise ValueError(
+                    'Out-of-band buffers need pickle protocol 5')
+            protocol = max(protocol or 0, 5)
+        self.protocol = protocol
+        self.out_of_band = out_of_band
+        self.min_size = min_size
 
     def encode(self, data):
-        return pickle.dumps(data)
+        return pickle.dumps(data, self.protocol)
 
     def decode(self, data):
         return pickle.loads(data)
+
+    def encode_frames(self, data):
+        if not self.out_of_band:
+            return self.encode(data), []
+
+        buffers = []
+
+        def collect(buf):
+            """ Keep small or non-contiguous buffers in band """
+            try:
+                raw = buf.raw()
+            except BufferError:
+                return True
+            if raw.nbytes < self.min_size:
+                return True
+            buffers.append(raw)
+            return False
+
+        body = pickle.dumps(data, self.protocol, buffer_callback=collect)
+        return body, buffers
+
+    def decode_frames(self, data, buffers):
+        return pickle.loads(data, buffers=buffers)
+
+
+# Encoders by content-type id (see `get_encoder`)
+ENCODERS = {}
+
+
+def register(encoder, content_type=None):
+    """ Register an encoder instance under a one-byte content-type id
+    (its `content_type` by default) """
+    if content_type is None:
+        content_type = encoder.content_type
+    _check_content_type(content_type)
+    if encoder.content_type != content_type:
+        encoder.content_type = content_type
+    ENCODERS[content_type] = encoder
+
+
+def _check_content_type(content_type):
+    if not isinstance(content_type, int) or not 0 < content_type < 256:
+        raise ValueError(
+            'Content type must be an int from 1 to 255, got {}'.format(
+                content_type))
+
+
+def get_encoder(content_type):
+    """ Return the encoder registered for a content-type id """
+    encoder = ENCODERS.get(content_type)
+    if encoder is None and content_type == NDArrayEncoder.content_type and \
+       load_numpy() is not None:
+        # Registered on first use so importing does not import numpy
+        encoder = NDArrayEncoder()
+        register(encoder)
+    if encoder is None:
+        raise ValueError('Unknown content type {}'.format(content_type))
+    return encoder
+
+
+for _encoder in (JSONEncoder(), MsgPackEncoder(), PickleEncoder()):
+    register(_encoder)
+
+
+class TaggedEncoder(Encoder):
+    """ Prefix each message with the content-type id of its encoder and
+    decode messages with the encoder known for their id
+
+    Messages are encoded with `default` unless an encoder is given for a
+    message (see `Requester.set_encoder`), so a method can move to another
+    encoder without both ends switching at once.
+
+    Messages are decoded only by `default` or one of `encoders` with the
+    id of the message, so they are configured like the sender's: any
+    other id raises DecodeError, so a peer cannot pick an encoder (such
+    as pickle) the endpoint did not choose. Wrappers such as
+    NDArrayEncoder and CompressedEncoder keep their id whatever they
+    wrap: give several configurations of a wrapper distinct ids with
+    their `content_type` argument.
+    """
+
+    def __init__(self, default=None, encoders=()):
+        super(TaggedEncoder, self).__init__()
+        self.default = default or get_encoder(PickleEncoder.content_type)
+        self.encoders = {}
+        for encoder in tuple(encoders) + (self.default,):
+            if encoder.content_type is None:
+                raise ValueError(
+                    '{} has no content type, set one with `register`'
+                    .format(type(encoder).__name__))
+            _check_content_type(encoder.content_type)
+            self.encoders[encoder.content_type] = encoder
+
+    def encode(self, data, encoder=None):
+        encoder = encoder or self.default
+        return _TAG.pack(encoder.content_type) + encoder.encode(data)
+
+    def decode(self, data):
+        return self.encoder_of(data).decode(data[1:])
+
+    def encode_frames(self, data, encoder=None):
+        encoder = encoder or self.default
+        body, buffers = encoder.encode_frames(data)
+        return _TAG.pack(encoder.content_type) + body, buffers
+
+    def decode_frames(self, data, buffers):
+        return self.encoder_of(data).decode_frames(data[1:], buffers)
+
+    def encoder_of(self, data):
+        """ Return the encoder which decodes an encoded message """
+        content_type = self.content_type_of(data)
+        encoder = self.encoders.get(content_type)
+        if encoder is None:
+            raise DecodeError(
+                'Unexpected content type {}'.format(content_type))
+        return encoder
+
+    @staticmethod
+    def content_type_of(data):
+        """ Return the content-type id of an encoded message """
+        if not len(data):
+            raise DecodeError('Message has no content type')
+        return bytearray(data[:1])[0]
+
+
+class NDArrayEncoder(Encoder):
+    """ Encoder which sends numpy arrays without copying them
+
+    Arrays found in the message (also inside dicts, lists and tuples) are
+    replaced by a small description of their dtype, shape and strides and
+    their memory is sent as a separate frame. Received arrays are views
+    over the received frames. The rest of the message is encoded
+    with `inner` (a PickleEncoder by default).
+
+    Endpoints without `multipart` receive a single buffer made of the
+    length-prefixed frames, which costs a copy on each side.
+
+    `content_type` overrides the id used by a `TaggedEncoder`.
+    """
+
+    content_type = 4
+
+    def __init__(self, inner=None, content_type=None):
+        super(NDArrayEncoder, self).__init__()
+        if load_numpy() is None:
+            raise ImportError('NDArrayEncoder needs numpy')
+        self.inner = inner or PickleEncoder()
+        if content_type is not None:
+            self.content_type = content_type
+
+    def encode(self, data):
+        body, buffers = self.encode_frames(data)
+        parts = [_COUNT.pack(len(buffers)), _LENGTH.pack(len(body)), body]
+        for buf in buffers:
+            parts.append(_LENGTH.pack(len(buf)))
+            parts.append(buf.tobytes())
+        return b''.join(parts)
+
+    def decode(self, data):
+        if not isinstance(data, bytes):
+            data = memoryview(data)
+        count = _COUNT.unpack_from(data)[0]
+        offset = _COUNT.size
+        frames = []
+        for _ in range(count + 1):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            frames.append(data[offset:offset + length])
+            offset += length
+        return self.decode_frames(frames[0], frames[1:])
+
+    def encode_frames(self, data):
+        buffers = []
+        return self.inner.encode(self._extract(data, buffers)), buffers
+
+    def decode_frames(self, data, buffers):
+        return self._restore(self.inner.decode(data), buffers)
+
+    def _extract(self, data, buffers):
+        """ Replace arrays by their description, collecting their memory """
+        if isinstance(data, numpy.ndarray) and \
+           not data.dtype.hasobject and data.dtype.fields is None:
+            if not (data.flags.c_contiguous or data.flags.f_contiguous):
+                data = numpy.ascontiguousarray(data)
+            buffers.append(data.ravel(order='A').view(numpy.uint8))
+            return {'__ndarray__': len(buffers) - 1,
+                    'dtype': data.dtype.str,
+                    'shape': list(data.shape),
+                    'strides': list(data.strides)}
+        if isinstance(data, dict):
+            return dict(
+                (key, self._extract(value, buffers))
+                for key, value in data.items())
+        if isinstance(data, list):
+            return [self._extract(value, buffers) for value in data]
+        if isinstance(data, tuple):
+            return tuple(self._extract(value, buffers) for value in data)
+        return data
+
+    def _restore(self, data, buffers):
+        """ Replace array descriptions by arrays over their buffers """
+        if isinstance(data, dict):
+            if '__ndarray__' in data:
+                return _ndarray(buffers[data['__ndarray__']], data['dtype'],
+                                data['shape'], data['strides'])
+            return dict(
+                (key, self._restore(value, buffers))
+                for key, value in data.items())
+        if isinstance(data, list):
+            return [self._restore(value, buffers) for value in data]
+        if isinstance(data, tuple):
+            return tuple(self._restore(value, buffers) for value in data)
+        return data
+
+
+class CompressedEncoder(Encoder):
+    """ Compress the messages of another encoder
+
+    Messages are prefixed with a flag byte: 0 when sent as is, otherwise
+    the id of the algorithm (ORed with 0x80 when compressed with the preset
+    `dictionary`). Any algorithm installed on the receiving end can be
+    decoded, whatever `algorithm` it uses itself.
+
+    Messages shorter than `min_size` (or which do not shrink) are not
+    compressed. zlib and lzma are always available (lzma on Python 3),
+    lz4 and zstd when the lz4 and zstandard packages are installed. A
+    preset dictionary (zlib and zstd only) helps with small, repetitive
+    messages: see `train`. Out-of-band buffers are not compressed.
+
+    `content_type` overrides the id used by a `TaggedEncoder`. A
+    receiving TaggedEncoder needs one among its `encoders`.
+    """
+
+    content_type = 5
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, inner=None, algorithm='zlib', min_size=256,
+                 dictionary=None, level=None, content_type=None):
+        super(CompressedEncoder, self).__init__()
+        if content_type is not None:
+            self.content_type = content_type
+        if algorithm not in CODECS:
+            raise ValueError(
+                'Compression algorithm {} is not available, use one of {}'
+                .format(algorithm, ', '.join(sorted(CODECS))))
+        self.inner = inner or PickleEncoder()
+        self.codec = CODECS[algorithm]
+        self.min_size = min_size
+        self.level = level
+        self.dictionary = None
+        if dictionary is not None:
+            self.set_dictionary(dictionary)
+
+    def set_dictionary(self, dictionary):
+        """ Compress with a preset dictionary (needed by both ends) """
+        if not self.codec.dictionaries:
+            raise ValueError('{} does not support preset dictionaries'
+                             .format(self.codec.name))
+        self.dictionary = bytes(dictionary)
+
+    def train(self, samples, size=16384):
+        """ Build and use a preset dictionary from sample messages
+
+        Returns the dictionary, which must be given to the other end
+        """
+        samples = [self.inner.encode(sample) for sample in samples]
+        if self.codec.name == 'zstd':
+            dictionary = zstandard.train_dictionary(size, samples).as_bytes()
+        else:
+            dictionary = _train_dictionary(samples, size)
+        self.set_dictionary(dictionary)
+        return dictionary
+
+    def encode(self, data):
+        return self.compress(self.inner.encode(data))
+
+    def decode(self, data):
+        return self.inner.decode(self.decompress(data))
+
+    def encode_frames(self, data):
+        body, buffers = self.inner.encode_frames(data)
+        return self.compress(body), buffers
+
+    def decode_frames(self, data, buffers):
+        return self.inner.decode_frames(self.decompress(data), buffers)
+
+    def compress(self, data):
+        """ Compress an encoded message and prefix its flag byte """
+        if len(data) >= self.min_size:
+            compressed = self.codec.compress(data, self.level, self.dictionary)
+            if len(compressed) < len(data):
+                flags = self.codec.id
+                if self.dictionary is not None:
+                    flags |= _DICTIONARY
+                return _TAG.pack(flags) + compressed
+        return _TAG.pack(0) + data
+
+    def decompress(self, data):
+        """ Decompress a message according to its flag byte """
+        if not len(data):
+            raise ValueError('Message has no compression flag')
+        flags = bytearray(data[:1])[0]
+        data = data[1:]
+        if not flags:
+            return data
+        codec = _CODECS_BY_ID.get(flags & ~_DICTIONARY)
+        if codec is None:
+            raise ValueError('Unknown compression algorithm {}'.format(flags))
+        dictionary = None
+        if flags & _DICTIONARY:
+            if self.dictionary is None:
+                raise ValueError('Message needs a preset dictionary')
+            dictionary = self.dictionary
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+        return codec.decompress(data, dictionary)
+
+
+# Compression algorithms by name. Ids are part of the wire format.
+Codec = collections.namedtuple(
+    'Codec', 'name id compress decompress dictionaries')
+
+_DICTIONARY = 0x80
+
+
+def _zlib_compress(data, level, dictionary):
+    level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+    if dictionary is None:
+        return zlib.compress(data, level)
+    compressor = zlib.compressobj(
+        level, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+        dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(data, dictionary):
+    if dictionary is None:
+        return zlib.decompress(data)
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def _lzma_compress(data, level, dictionary):  # pylint: disable=unused-argument
+    return lzma.compress(data, preset=level)
+
+
+def _lzma_decompress(data, dictionary):  # pylint: disable=unused-argument
+    return lzma.decompress(data)
+
+
+def _lz4_compress(data, level, dictionary):  # pylint: disable=unused-argument
+    return lz4_frame.compress(data, compression_level=level or 0)
+
+
+def _lz4_decompress(data, dictionary):  # pylint: disable=unused-argument
+    return lz4_frame.decompress(data)
+
+
+def _zstd_compress(data, level, dictionary):
+    if dictionary is not None:
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level, dict_data=dictionary,
+        write_content_size=True).compress(data)
+
+
+def _zstd_decompress(data, dictionary):
+    if dictionary is not None:
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+    return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+
+CODECS = {
+    # zlib preset dictionaries need Python 3
+    'zlib': Codec('zlib', 1, _zlib_compress, _zlib_decompress,
+                  sys.version_info[0] >= 3),
+}
+if lzma is not None:
+    CODECS['lzma'] = Codec('lzma', 2, _lzma_compress, _lzma_decompress, False)
+if lz4_frame is not None:
+    CODECS['lz4'] = Codec('lz4', 3, _lz4_compress, _lz4_decompress, False)
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', 4, _zstd_compress, _zstd_decompress, True)
+
+_CODECS_BY_ID = dict((codec.id, codec) for codec in CODECS.values())
+
+
+def _train_dictionary(samples, size, length=8):
+    """ Build a zlib preset dictionary from encoded sample messages
+
+    Collects the `length` byte strings found in most samples, the most
+    common last since zlib reaches the end of the dictionary cheapest
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(
+            sample[position:position + length]
+            for position in range(0, max(len(sample) - length, 0) + 1)))
+    common = [chunk for chunk, count in counts.most_common() if count > 1]
+    dictionary = []
+    total = 0
+    for chunk in common:
+        if total + len(chunk) > size:
+            break
+        dictionary.append(chunk)
+        total += len(chunk)
+    return b''.join(reversed(dictionary))
+
+
+def _ndarray(buf, dtype, shape, strides):
+    """ Return an array over a buffer without copying it """
+    if sys.version_info[0] < 3 and isinstance(buf, memoryview):
+        # numpy on python 2 does not read from memoryviews
+        buf = buf.tobytes()
+    return numpy.ndarray(
+        tuple(shape), numpy.dtype(dtype), buffer=buf, strides=tuple(strides))
@@ -0,0 +1,233 @@
+'''
+The MIT License (MIT)
+
+Copyright (c) 2016 Tony Walker
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import os
+import sys
+import threading
+
+from timeit import default_timer as clock
+
+
+# Histogram buckets: values below 2**SUB_BITS nanoseconds get a bucket of
+# their own, above that every power of two is split in 2**SUB_BITS linear
+# buckets, which bounds the relative error of a percentile to 1/16
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+
+# Percentiles reported by Histogram.summary
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Metric groups
+STAGES = 'stages'
+METHODS = 'methods'
+
+
+def _bucket(value):
+    """ Return the bucket index of a value in nanoseconds """
+    if value < SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift << SUB_BITS) + (value >> shift)
+
+
+def _bucket_range(index):
+    """ Return the (lowest, highest) value in nanoseconds of a bucket """
+    if index < SUB_COUNT:
+        return index, index
+    shift = (index >> SUB_BITS) - 1
+    lowest = (index - (shift << SUB_BITS)) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class Histogram(object):
+    """ A latency histogram with log-linear buckets
+
+    Values are recorded in seconds and kept as counts per bucket, so
+    recording is cheap and the memory used does not depend on how many
+    values were recorded.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds, count=1):
+        """ Record a value (`count` times) """
+        value = max(int(seconds * 1e9), 0)
+        index = _bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values recorded by another histogram """
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """ Return the value (in seconds) below which `percent` percent
+        of the recorded values fall """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # The highest value of the bucket, as an upper bound
+                highest = _bucket_range(index)[1]
+                return min(max(highest, self.min), self.max) / 1e9
+        return self.max / 1e9
+
+    def mean(self):
+        """ Return the mean of the recorded values in seconds """
+        if not self.count:
+            return None
+        return self.total / 1e9 / self.count
+
+    def summary(self):
+        """ Return count, mean, min, max and percentiles as a dict
+        (times in seconds) """
+        summary = {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': None if self.min is None else self.min / 1e9,
+            'max': None if self.max is None else self.max / 1e9,
+        }
+        for percent in PERCENTILES:
+            summary['p{:g}'.format(percent)] = self.percentile(percent)
+        return summary
+
+
+class Metrics(object):
+    """ Latency histograms and counters of an endpoint
+
+    Histograms are grouped by kind:
+
+      stages   time spent in each processing stage of an endpoint
+               (encode, decode, sign, verify) and the round trip of
+               the calls of a requester (roundtrip)
+      methods  time spent in each method of a Responder and in the
+               functions subscribed to each tag of a Subscriber
+
+    Counters hold the number of bytes and messages sent and received and
+    `errors` the number of failed calls per method. A Metrics may be
+    shared between endpoints and threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {STAGES: {}, METHODS: {}}
+        self.counters = {}
+        self.errors = {}
+
+    def record(self, name, seconds, group=STAGES):
+        """ Record the time spent in a stage (or method) """
+        with self.lock:
+            histograms = self.histograms.setdefault(group, {})
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    def count(self, name, value=1):
+        """ Add `value` to a counter """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def error(self, method):
+        """ Count a failed call of `method` """
+        with self.lock:
+            self.errors[method] = self.errors.get(method, 0) + 1
+
+    def transfer(self, direction, size):
+        """ Count a message of `size` bytes sent ('out') or received
+        ('in') """
+        with self.lock:
+            for name, value in (('messages_' + direction, 1),
+                                ('bytes_' + direction, size)):
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name, group=STAGES):
+        """ Return the histogram of a stage (or method), if any """
+        return self.histograms.get(group, {}).get(name)
+
+    def snapshot(self):
+        """ Return the summary of every histogram and the counters as a
+        dict of plain values """
+        with self.lock:
+            snapshot = dict(
+                (group, dict((name, histogram.summary())
+                             for name, histogram in histograms.items()))
+                for group, histograms in self.histograms.items())
+            snapshot['counters'] = dict(self.counters)
+            snapshot['errors'] = dict(self.errors)
+        return snapshot
+
+    def reset(self):
+        """ Forget everything recorded so far """
+        with self.lock:
+            self.histograms = {STAGES: {}, METHODS: {}}
+            self.counters = {}
+            self.errors = {}
+
+
+def frames_size(frames):
+    """ Return the total size in bytes of a list of frames """
+    return sum(len(frame) for frame in frames)
+
+
+def process_rss():
+    """ Return the resident set size of this process in bytes, or None
+    when it cannot be told """
+    try:
+        with open('/proc/self/statm') as handle:
+            pages = int(handle.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current size: kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
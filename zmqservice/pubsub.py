@@ -24,15 +24,106 @@ SOFTWARE.
 '''
 
 import zmq
+import time
 import logging
+import collections
 
+from .error import PublisherError
 from .error import SubscriberError
 from .error import DecodeError
 from .error import RequestParseError
 from .error import AuthenticateError
 from .error import AuthenticatorInvalidSignature
-from .core import Endpoint, Process, setGlobalContext
+from .core import Endpoint, Process, setGlobalContext, _bytes
 from .encoder import MsgPackEncoder, PickleEncoder
+from .metrics import METHODS, clock
+
+
+def _encode_tag(tag):
+    """ Return the subscription tag as bytes """
+    if isinstance(tag, bytes):
+        return tag
+    return tag.encode('utf-8')
+
+
+def _dispatch_tag(index, args):
+    """ Return the subscribed tag (as text) matching the arguments of a
+    subscribed function: (tag, message) or, for batches, a list of such
+    pairs. Metrics are kept by subscription rather than by received tag,
+    of which there may be any number. """
+    tag = _encode_tag(args[0] if len(args) == 2 else args[0][0][0])
+    matched = index.match_tag(tag)
+    if matched is not None:
+        tag = matched
+    return tag.decode('utf-8', 'replace')
+
+
+class TopicIndex(object):
+    """ Longest-prefix index of subscription tags
+
+    Tags are grouped by length so a lookup probes at most one entry per
+    distinct tag length, no matter how many tags are registered.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.lengths = []
+        self._counts = {}
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return _encode_tag(tag) in self.tags
+
+    def add(self, tag, value):
+        """ Add (or replace) the value stored for `tag` """
+        tag = _encode_tag(tag)
+        if tag not in self.tags:
+            self._counts[len(tag)] = self._counts.get(len(tag), 0) + 1
+            self._update_lengths()
+        self.tags[tag] = value
+
+    def remove(self, tag):
+        """ Remove `tag` from the index """
+        tag = _encode_tag(tag)
+        del self.tags[tag]
+        self._counts[len(tag)] -= 1
+        if not self._counts[len(tag)]:
+            del self._counts[len(tag)]
+        self._update_lengths()
+
+    def match(self, subTag):
+        """ Return the value of the longest tag prefixing `subTag` """
+        size = len(subTag)
+        for length in self.lengths:
+            if length <= size:
+                value = self.tags.get(subTag[:length])
+                if value is not None:
+                    return value
+        return None
+
+    def match_tag(self, subTag):
+        """ Return the longest tag prefixing `subTag`, or None """
+        size = len(subTag)
+        for length in self.lengths:
+            if length <= size and subTag[:length] in self.tags:
+                return subTag[:length]
+        return None
+
+    def _update_lengths(self):
+        self.lengths = sorted(self._counts, reverse=True)
+
+
+class BatchFunction(object):
+    """ A function subscribed with `batch`, which is called with a list
+    of (tag, message) pairs """
+
+    def __init__(self, fun):
+        self.fun = fun
+
+    def __call__(self, pairs):
+        return self.fun(pairs)
 
 
 class Subscriber(Endpoint, Process):
@@ -42,7 +133,8 @@ class Subscriber(Endpoint, Process):
     # pylint: disable=too-many-arguments
     # pylint: disable=no-member
     def __init__(self, address, encoder=None, authenticator=None,
-                 socket=None, bind=None, timeouts=(None, None), logger=None):
+                 socket=None, bind=None, timeouts=(None, None), logger=None,
+                 multipart=False, drain=1, tuning=None):
         setGlobalContext()
 
         # Defaults
@@ -57,86 +149,201 @@ class Subscriber(Endpoint, Process):
                 bind = False
 
         super(Subscriber, self).__init__(
-            socket, address, bind, encoder, authenticator, timeouts, logger)
+            socket, address, bind, encoder, authenticator, timeouts, logger,
+            multipart, tuning)
 
         self.methods = {}
         self.descriptions = {}
+        self.index = TopicIndex()
+
+        # Maximum number of messages handled by a call to `process`
+        self.drain = drain
+
+        # Messages of a received batch waiting to be processed
+        self.backlog = collections.deque()
+
+    def match(self, subTag):
+        """ Fetch the function registered for a certain tag """
+        return self.index.match(subTag)
 
     def parse(self, subscription):
         """ Fetch the function registered for a certain subscription """
-        subTag, message = subscription.split(" ",1)
-        for name in self.methods:
-            tag = bytes(name.encode('utf-8'))
-            if subTag.startswith(tag):
-                fun = self.methods.get(name)
-                return subTag, message, fun
-        return None, None, None
+        subTag, message = subscription.split(b' ', 1)
+        fun = self.match(subTag)
+        if fun is None:
+            return None, None, None
+        return subTag, message, fun
+
+    def receive_subscription(self, flags=0):
+        """ Receive a subscription, verify and decode its message
+
+        Returns a (tag, message, function) tuple
+        """
+        if self.backlog:
+            return self.backlog.popleft()
+        if self.multipart:
+            frames = self.socket.recv_multipart(flags, copy=False)
+        else:
+            frames = [self.socket.recv(flags)]
+        return self.parse_subscription(frames)
+
+    def parse_subscription(self, frames):
+        """ Verify and decode the frames of a received subscription
+
+        Returns a (tag, message, function) tuple. When the subscription is
+        a batch, the first message is returned and the others are queued
+        in `backlog`.
+        """
+        if self.multipart:
+            subTag = _bytes(frames[0])
+            fun = self.match(subTag)
+            if fun is None:
+                return None, None, None
+            messages = self.parse_batch(frames[1:], tag=subTag)
+            self.backlog.extend(
+                (subTag, message, fun) for message in messages[1:])
+            return subTag, messages[0], fun
+
+        tag, message, fun = self.parse(frames[0])
+        if fun is None:
+            return None, None, None
+        message = self.verify(message)
+        message = self.decode(message)
+        return tag, message, fun
 
     def register(self, name, fun, description=None):
         raise SubscriberError('Operation not allowed on this type of service')
 
     # pylint: disable=no-member
-    def subscribe(self, tag, fun, description=None):
-        """ Subscribe to something and register a function """
+    def subscribe(self, tag, fun, description=None, batch=False):
+        """ Subscribe to something and register a function
+
+        With `batch` set, `fun` is called once per `process` with the list
+        of (tag, message) pairs received for it, instead of once per message
+        """
         self.methods[tag] = fun
         self.descriptions[tag] = description
-        self.socket.setsockopt(zmq.SUBSCRIBE, tag)
+        self.index.add(tag, BatchFunction(fun) if batch else fun)
+        self.socket.setsockopt(zmq.SUBSCRIBE, _encode_tag(tag))
+
+    # pylint: disable=no-member
+    def unsubscribe(self, tag):
+        """ Unsubscribe from something and unregister its function """
+        if tag not in self.methods:
+            raise SubscriberError('Not subscribed to `{}`'.format(tag))
+        del self.methods[tag]
+        del self.descriptions[tag]
+        self.index.remove(tag)
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, _encode_tag(tag))
 
     # pylint: disable=logging-format-interpolation
     # pylint: disable=duplicate-code
     def process(self):
-        """ Receive a subscription from the socket and process it """
+        """ Receive subscriptions from the socket and process them
+
+        Blocks until a subscription arrives, then drains up to `drain` - 1
+        more which are already waiting, without blocking.
+        """
+
+        received = []
+        flags = 0
+
+        for _ in range(self.drain):
+            try:
+                tag, message, fun = self.receive_subscription(flags)
+
+            except zmq.Again:
+                if not flags:
+                    raise
+                break
+
+            except AuthenticateError as exception:
+                self.logger.error(
+                    'Subscriber error while authenticating request: {}'
+                    .format(exception), exc_info=1)
+
+            except AuthenticatorInvalidSignature as exception:
+                self.logger.error(
+                    'Subscriber error while authenticating request: {}'
+                    .format(exception), exc_info=1)
+
+            except DecodeError as exception:
+                self.logger.error(
+                    'Subscriber error while decoding request: {}'
+                    .format(exception), exc_info=1)
+
+            except RequestParseError as exception:
+                self.logger.error(
+                    'Subscriber error while parsing request: {}'
+                    .format(exception), exc_info=1)
+            else:
+                self.logger.debug(
+                    'Subscriber received payload: {}'
+                    .format(message))
+                if fun is not None:
+                    received.append((tag, message, fun))
 
-        subscription = None
-        result = None
+            flags = zmq.NOBLOCK
 
-        try:
-            subscription = self.socket.recv()
-
-        except AuthenticateError as exception:
-            self.logger.error(
-                'Subscriber error while authenticating request: {}'
-                .format(exception), exc_info=1)
-
-        except AuthenticatorInvalidSignature as exception:
-            self.logger.error(
-                'Subscriber error while authenticating request: {}'
-                .format(exception), exc_info=1)
-
-        except DecodeError as exception:
-            self.logger.error(
-                'Subscriber error while decoding request: {}'
-                .format(exception), exc_info=1)
-
-        except RequestParseError as exception:
-            self.logger.error(
-                'Subscriber error while parsing request: {}'
-                .format(exception), exc_info=1)
-        else:
-            self.logger.debug(
-                'Subscriber received payload: {}'
-                .format(subscription))
-
-        tag, message, fun = self.parse(subscription)
-        message = self.verify(message)
-        message = self.decode(message)
+        # Return result of the last call to check successful execution
+        # when testing
+        result = None
+        for fun, args in self.schedule(received):
+            result = self.dispatch(fun, *args)
+        return result
 
+    def schedule(self, received):
+        """ Turn received (tag, message, function) tuples into a list of
+        (function, args) calls
+
+        Functions subscribed with `batch` are called once, with all of
+        their (tag, message) pairs, after the per-message functions
+        """
+        calls = []
+        batches = collections.OrderedDict()
+        for tag, message, fun in received:
+            if isinstance(fun, BatchFunction):
+                batches.setdefault(fun, []).append((tag, message))
+            else:
+                calls.append((fun, (tag, message)))
+        calls.extend((fun, (pairs,)) for fun, pairs in batches.items())
+        return calls
+
+    def dispatch(self, fun, *args):
+        """ Run a subscribed function """
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
         try:
-            result = fun(tag, message)
+            return fun(*args)
         except Exception as exception:
             self.logger.error(exception, exc_info=1)
-
-        # Return result to check successful execution of `fun` when testing
-        return result
+        finally:
+            if metrics is not None:
+                metrics.record(_dispatch_tag(self.index, args),
+                               clock() - started, METHODS)
 
 
 class Publisher(Endpoint):
-    """ A Publisher sends messages down the zmq socket """
+    """ A Publisher sends messages down the zmq socket
+
+    Batching (multipart only): with `batch_size` and/or `batch_window`
+    (in microseconds) set, messages are buffered per tag and sent as a
+    single multipart message once a tag has `batch_size` messages or the
+    oldest buffered message is `batch_window` old. The window is checked
+    when publishing; call `flush` to send what is left when going idle.
+    Subscribers unpack batches transparently.
+    """
 
     # pylint: disable=too-many-arguments
     # pylint: disable=no-member
     def __init__(self, address, encoder=None, authenticator=None,
-                 socket=None, bind=True, timeouts=(None, None), logger=None):
+                 socket=None, bind=True, timeouts=(None, None), logger=None,
+                 multipart=False, batch_size=None, batch_window=None,
+                 tuning=None):
+        if (batch_size or batch_window) and not multipart:
+            raise PublisherError('Batching requires multipart=True')
+
         setGlobalContext()
 
         # Defaults
@@ -145,17 +352,65 @@ class Publisher(Endpoint):
         encoder = encoder or PickleEncoder()
 
         super(Publisher, self).__init__(
-            socket, address, bind, encoder, authenticator, timeouts, logger)
+            socket, address, bind, encoder, authenticator, timeouts, logger,
+            multipart, tuning)
+
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.batches = {}
+        self._batch_started = None
 
     def build_payload(self, tag, message):
         """ Encode, sign payload(optional) and attach subscription tag """
         message = self.encode(message)
         message = self.sign(message)
-        #payload = bytes(tag.encode('utf-8')) +" " + message
-        payload = "%s %s" % (tag, message)
-        return payload
+        return b' '.join((_encode_tag(tag), message))
 
     def publish(self, tag, message):
         """ Publish a message down the socket """
+        if self.batch_size or self.batch_window:
+            self.buffer(tag, message)
+            return
+        if self.multipart:
+            tag = _encode_tag(tag)
+            frames = self.build_frames(message, tag=tag)
+            frames.insert(0, tag)
+            self.socket.send_multipart(frames, copy=False)
+            return
         payload = self.build_payload(tag, message)
         self.socket.send(payload)
+
+    def buffer(self, tag, message):
+        """ Add a message to the batch of its tag, sending batches which
+        are full or too old """
+        tag = _encode_tag(tag)
+        batch = self.batches.setdefault(tag, [])
+        batch.append(self.encode(message))
+
+        now = time.time()
+        if self._batch_started is None:
+            self._batch_started = now
+
+        if self.batch_size and len(batch) >= self.batch_size:
+            self.flush(tag)
+        if self.batch_window and self.batches and \
+           (now - self._batch_started) * 1e6 >= self.batch_window:
+            self.flush()
+
+    def flush(self, tag=None):
+        """ Send the buffered messages of `tag` (default: of all tags) """
+        tags = list(self.batches) if tag is None else [_encode_tag(tag)]
+        for tag in tags:
+            encoded = self.batches.pop(tag, None)
+            if encoded:
+                frames = self.build_batch(encoded, tag)
+                frames.insert(0, tag)
+                self.socket.send_multipart(frames, copy=False)
+        if not self.batches:
+            self._batch_started = None
+
+    def close(self):
+        """ Send buffered messages and close the socket """
+        if not self.socket.closed:
+            self.flush()
+        super(Publisher, self).close()
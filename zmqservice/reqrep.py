@@ -23,26 +23,73 @@ SOFTWARE.
 
 '''
 
+import os
+import math
+import time
 import uuid
 import zmq
+import heapq
+import itertools
 import logging
+import threading
 
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .error import ClientError
 from .error import DecodeError
+from .error import EncodeError
 from .error import RequestParseError
 from .error import AuthenticateError
 from .error import AuthenticatorInvalidSignature
-from .encoder import MsgPackEncoder
+from .encoder import PickleEncoder
+from .metrics import METHODS, PERCENTILES, clock, process_rss
+
+from .core import Endpoint, Process, Waker, setGlobalContext, split_envelope
+
+
+# Reserved method name used to send many calls in a single request
+BATCH_METHOD = '__batch__'
+
+# Reserved method name returning the stats and health of a responder
+STATS_METHOD = '__stats__'
 
-from .core import Endpoint, Process, setGlobalContext
+# Stage of the metrics of a requester timing calls from sending the
+# request to receiving the reply
+ROUNDTRIP = 'roundtrip'
+
+
+def _record_roundtrip(metrics, started):
+    """ Return a future callback recording the round trip of a call """
+    def record(future):
+        if future.exception() is None:
+            metrics.record(ROUNDTRIP, clock() - started)
+    return record
 
 
 class Responder(Endpoint, Process):
-    """ A service which responds to requests """
+    """ A service which responds to requests
+
+    Requests carry a 64-bit reference in their header and responses are
+    (result, error) pairs. With `compat` the original format is used
+    instead: a uuid4 string reference inside the request and responses of
+    the form {'result', 'error', 'ref'}. Both ends must agree.
+
+    With `expose_stats` the reserved `__stats__` method answers `stats`
+    to any caller; it is off by default as it reveals the pid, memory
+    and timings of the service.
+    """
 
     # pylint: disable=too-many-arguments
     # pylint: disable=no-member
     def __init__(self, address, encoder=None, authenticator=None,
-                 socket=None, bind=True, timeouts=(None, None)):
+                 socket=None, bind=True, timeouts=(None, None),
+                 multipart=False, compat=False, tuning=None,
+                 expose_stats=False):
         setGlobalContext()
 
         # Defaults
@@ -51,25 +98,106 @@ class Responder(Endpoint, Process):
         encoder = encoder or PickleEncoder()
 
         super(Responder, self).__init__(
-            socket, address, bind, encoder, authenticator, timeouts)
+            socket, address, bind, encoder, authenticator, timeouts,
+            multipart=multipart, tuning=tuning)
 
+        self.compat = compat
+        self.expose_stats = expose_stats
         self.methods = {}
         self.descriptions = {}
+        self.started = time.time()
 
     def execute(self, method, args, ref):
-        """ Execute the method with args """
+        """ Execute the method with args and return the response """
 
-        response = {'result': None, 'error': None, 'ref': ref}
-        fun = self.methods.get(method)
-        if not fun:
-            response['error'] = 'Method `{}` not found'.format(method)
+        if method == BATCH_METHOD:
+            result, error = self.execute_many(args), None
+        elif method == STATS_METHOD and self.expose_stats:
+            result, error = self.stats(), None
         else:
+            result, error = self.invoke(method, args)
+        return self.build_response(result, error, ref)
+
+    def build_response(self, result, error, ref):
+        """ Build the response sent back to a `Requester` """
+        if self.compat:
+            return {'result': result, 'error': error, 'ref': ref}
+        return result, error
+
+    def execute_many(self, calls):
+        """ Execute a batch of (method, args) calls in order
+
+        Returns a list of (result, error) pairs, one for each call
+        """
+        results = []
+        for call in calls:
             try:
-                response['result'] = fun(*args)
+                method, args = call
             except Exception as exception:
-                logging.error(exception, exc_info=1)
-                response['error'] = str(exception)
-        return response
+                results.append((None, 'Malformed call: {}'.format(exception)))
+            else:
+                results.append(self.invoke(method, args))
+        return results
+
+    def invoke(self, method, args):
+        """ Call the function registered as `method` and return a
+        (result, error) pair """
+        fun = self.methods.get(method)
+        if not fun:
+            return None, 'Method `{}` not found'.format(method)
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        try:
+            return fun(*args), None
+        except Exception as exception:
+            logging.error(exception, exc_info=1)
+            if metrics is not None:
+                metrics.error(method)
+            return None, str(exception)
+        finally:
+            if metrics is not None:
+                metrics.record(method, clock() - started, METHODS)
+
+    def stats(self):
+        """ Return the health of this service as a dict, answered to the
+        reserved `__stats__` method with `expose_stats`
+
+        Holds the pid, uptime, resident memory and queue depths and, with
+        metrics enabled (see `enable_metrics`), the calls, errors and
+        latency percentiles of each method, the time spent in each stage
+        and the bytes sent and received.
+        """
+        snapshot = self.metrics.snapshot() if self.metrics else {}
+        timings = snapshot.get(METHODS, {})
+        errors = snapshot.get('errors', {})
+        methods = {}
+        for name in set(self.methods) | set(timings):
+            summary = timings.get(name) or {}
+            methods[name] = {
+                'calls': summary.get('count', 0),
+                'errors': errors.get(name, 0),
+                'mean': summary.get('mean'),
+                'max': summary.get('max'),
+            }
+            for percent in PERCENTILES:
+                key = 'p{:g}'.format(percent)
+                methods[name][key] = summary.get(key)
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'rss': process_rss(),
+            'metrics': self.metrics is not None,
+            'queues': self.queue_depths(),
+            'methods': methods,
+            'stages': snapshot.get('stages', {}),
+            'counters': snapshot.get('counters', {}),
+        }
+
+    def queue_depths(self):
+        """ Return the number of requests and replies waiting in the
+        queues of this service, by queue """
+        return {}
 
     def register(self, name, fun, description=None):
         """ Register function on this service """
@@ -86,53 +214,247 @@ class Responder(Endpoint, Process):
         else:
             return method, args, ref
 
+    def unpack_request(self, frames):
+        """ Authenticate, decode and parse the frames of a request into
+        (method, args, ref) """
+        if self.compat:
+            return self.parse(self.unpack(frames))
+        ref, payload = self.unpack(frames, ref=True)
+        try:
+            method, args = payload
+        except Exception as exception:
+            raise RequestParseError(exception)
+        return method, args, ref
+
     # pylint: disable=logging-format-interpolation
+    def pack_response(self, response, ref):
+        """ Encode and sign (optional) a response into the frames of a
+        reply. A request which could not be handled (no response) gets
+        an empty reply, and a result which cannot be encoded is replaced
+        by an error """
+        if response is None:
+            return self.pack('')
+        try:
+            return self._pack_response(response, ref)
+        except EncodeError as exception:
+            logging.error(
+                'Service error while encoding response: {}'
+                .format(exception), exc_info=1)
+            error = self.build_response(
+                None, 'Cannot encode result: {}'.format(exception), ref)
+            return self._pack_response(error, ref)
+
+    def _pack_response(self, response, ref):
+        if self.compat:
+            return self.pack(response)
+        return self.pack(response, ref)
+
+    def error_response(self, frames, error):
+        """ Return the (response, ref) pair answering a request which
+        could not be handled
+
+        The error response carries the reference of the request, so its
+        caller is not left waiting. Without a readable reference (or in
+        `compat` mode, where it is part of the payload) there is no
+        response and the reply is empty.
+        """
+        ref = None if self.compat else self.read_ref(frames)
+        if ref is None:
+            return None, None
+        return self.build_response(None, error, ref), ref
+
     def process(self):
         """ Receive data from socket and process request """
 
-        response = None
+        if self.multipart:
+            frames = self.socket.recv_multipart(copy=False)
+        else:
+            frames = [self.socket.recv()]
+
+        response, ref = self.handle(frames)
+        self.socket.send_multipart(
+            self.pack_response(response, ref), copy=False)
+
+    # pylint: disable=logging-format-interpolation
+    def handle(self, frames):
+        """ Authenticate, decode and execute a request
+
+        Returns a (response, ref) pair. A request which could not be
+        handled gets an error response (see `error_response`)
+        """
 
         try:
-            payload = self.socket.recv()
-            method, args, ref = self.parse(payload)
+            method, args, ref = self.unpack_request(frames)
             response = self.execute(method, args, ref)
 
         except AuthenticateError as exception:
             logging.error(
                 'Service error while authenticating request: {}'
                 .format(exception), exc_info=1)
+            return self.error_response(frames, 'Cannot authenticate request')
 
         except AuthenticatorInvalidSignature as exception:
             logging.error(
                 'Service error while authenticating request: {}'
                 .format(exception), exc_info=1)
+            return self.error_response(frames, 'Cannot authenticate request')
 
         except DecodeError as exception:
             logging.error(
                 'Service error while decoding request: {}'
                 .format(exception), exc_info=1)
+            return self.error_response(
+                frames, 'Cannot decode request: {}'.format(exception))
 
         except RequestParseError as exception:
             logging.error(
                 'Service error while parsing request: {}'
                 .format(exception), exc_info=1)
+            return self.error_response(
+                frames, 'Cannot parse request: {}'.format(exception))
 
-        else:
-            logging.debug('Service received payload: {}'.format(payload))
+        logging.debug('Service received request: {}'.format(
+            (method, args, ref)))
+        return response, ref
 
-        if response:
-            self.send(response)
-        else:
-            self.send('')
+
+class ConcurrentResponder(Responder):
+    """ A service which executes requests on a pool of worker threads
+
+    Uses a ROUTER socket, so a slow method does not hold up other clients:
+    each request is handed to the pool and its reply is routed back to the
+    client as soon as it is ready, possibly out of order. Only the thread
+    running `process` touches the ROUTER socket; workers queue their
+    replies and wake it up through an inproc socket.
+
+    At most `max_pending` requests (4 per worker by default) are waiting
+    for or running on a worker; further requests wait in the socket queue.
+    """
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=no-member
+    def __init__(self, address, encoder=None, authenticator=None,
+                 socket=None, bind=True, timeouts=(None, None),
+                 multipart=False, workers=4, compat=False, tuning=None,
+                 max_pending=None, expose_stats=False):
+        setGlobalContext()
+
+        # Defaults
+        socket = socket or zmq.context.socket(zmq.ROUTER)
+
+        super(ConcurrentResponder, self).__init__(
+            address, encoder, authenticator, socket, bind, timeouts,
+            multipart, compat, tuning, expose_stats)
+
+        self.pool = ThreadPoolExecutor(workers)
+        self.replies = Queue.Queue()
+        self.waker = Waker()
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * workers)
+        self._paused = False
+        # Requests submitted to the pool and not yet picked by a worker
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.poller.register(self.waker.socket, zmq.POLLIN)
+
+    # pylint: disable=logging-format-interpolation
+    def process(self):
+        """ Dispatch incoming requests and send back finished replies """
+
+        for socket, _ in self.poller.poll():
+            if socket is self.waker.socket:
+                self.flush()
+                continue
+
+            if not self._slots.acquire(False):
+                # Leave requests in the socket queue until a worker is done
+                self.poller.modify(self.socket, 0)
+                self._paused = True
+                continue
+
+            frames = self.socket.recv_multipart(copy=False)
+            try:
+                envelope, frames = split_envelope(frames)
+            except RequestParseError as exception:
+                # Without an envelope there is no way to reply
+                self._slots.release()
+                logging.error(
+                    'Service error while parsing request: {}'
+                    .format(exception), exc_info=1)
+                continue
+            with self._lock:
+                self._waiting += 1
+            self.pool.submit(self.work, envelope, frames)
+
+    # pylint: disable=logging-format-interpolation
+    # pylint: disable=broad-except
+    def work(self, envelope, frames):
+        """ Handle a request on a worker thread and queue its reply
+
+        Any error is logged and answered, so the client is not left waiting
+        """
+
+        with self._lock:
+            self._waiting -= 1
+        try:
+            try:
+                response, ref = self.handle(frames)
+                reply = self.pack_response(response, ref)
+            except Exception as exception:
+                logging.error(
+                    'Service error while handling request: {}'
+                    .format(exception), exc_info=1)
+                response, ref = self.error_response(
+                    frames, 'Cannot handle request: {}'.format(exception))
+                reply = self.pack_response(response, ref)
+            self.replies.put(envelope + reply)
+        finally:
+            self._slots.release()
+            self.waker.wake()
+
+    def queue_depths(self):
+        """ Return the number of requests waiting for a worker and of
+        replies waiting to be sent """
+        return {
+            'requests': self._waiting,
+            'replies': self.replies.qsize(),
+        }
+
+    def flush(self):
+        """ Send all the replies finished by the workers """
+        self.waker.clear()
+        if self._paused:
+            # A worker is done, so there is room for more requests
+            self.poller.modify(self.socket, zmq.POLLIN)
+            self._paused = False
+        while True:
+            try:
+                frames = self.replies.get_nowait()
+            except Queue.Empty:
+                break
+            self.socket.send_multipart(frames, copy=False)
+
+    def close(self):
+        """ Stop the workers and close the sockets """
+        self.pool.shutdown(wait=False)
+        self.waker.close()
+        super(ConcurrentResponder, self).close()
 
 
 class Requester(Endpoint):
-    """ A requester client """
+    """ A requester client
+
+    Calls are referenced by a per-connection counter. Use `compat` to talk
+    to a `Responder` using the original (uuid4 reference) format.
+    """
 
     # pylint: disable=too-many-arguments
     # pylint: disable=no-member
     def __init__(self, address, encoder=None, authenticator=None,
-                 socket=None, bind=False, timeouts=(None, None)):
+                 socket=None, bind=False, timeouts=(None, None),
+                 multipart=False, compat=False, tuning=None):
         setGlobalContext()
 
         # Defaults
@@ -141,22 +463,258 @@ class Requester(Endpoint):
         encoder = encoder or PickleEncoder()
 
         super(Requester, self).__init__(
-            socket, address, bind, encoder, authenticator, timeouts)
-
-    @classmethod
-    def build_payload(cls, method, args):
-        """ Build the payload to be sent to a `Responder` """
-        ref = str(uuid.uuid4())
-        return (method, args, ref)
+            socket, address, bind, encoder, authenticator, timeouts,
+            multipart=multipart, tuning=tuning)
+
+        self.compat = compat
+        self.refs = itertools.count(1)
+        self.encoders = {}
+
+    def set_encoder(self, method, encoder):
+        """ Encode the requests for `method` with `encoder` instead of the
+        default one. Needs a `TaggedEncoder` on both ends """
+        self.encoders[method] = encoder
+
+    def build_payload(self, method, args):
+        """ Build the (method, args, ref) payload to be sent to a
+        `Responder` """
+        if self.compat:
+            return (method, args, str(uuid.uuid4()))
+        return (method, args, next(self.refs))
+
+    def pack_request(self, payload, encoder=None):
+        """ Encode and sign (optional) a payload into the frames of a
+        request """
+        encoder = encoder or self.encoders.get(payload[0])
+        if self.compat:
+            return self.pack(payload, encoder=encoder)
+        method, args, ref = payload
+        return self.pack((method, args), ref, encoder)
+
+    def unpack_response(self, frames):
+        """ Authenticate and decode the frames of a reply into
+        (ref, result, error) """
+        if self.compat:
+            res = self.unpack(frames)
+            return res['ref'], res['result'], res['error']
+        ref, (result, error) = self.unpack(frames, ref=True)
+        return ref, result, error
 
-    # pylint: disable=logging-format-interpolation
     def call(self, method, *args):
         """ Make a call to a `Responder` and return the result """
+        return self.call_with(None, method, *args)
+
+    # pylint: disable=logging-format-interpolation
+    def call_with(self, encoder, method, *args):
+        """ Make a call with the request encoded by `encoder` (see
+        `set_encoder`) and return the result """
 
         payload = self.build_payload(method, args)
         logging.debug('* Client will send payload: {}'.format(payload))
-        self.send(payload)
+        frames = self.pack_request(payload, encoder)
+
+        metrics = self.metrics
+        if metrics is not None:
+            started = clock()
+        self.socket.send_multipart(frames, copy=False)
+        frames = self.socket.recv_multipart(copy=False)
+        if metrics is not None:
+            metrics.record(ROUNDTRIP, clock() - started)
+
+        ref, result, error = self.unpack_response(frames)
+        assert payload[2] == ref
+        return result, error
+
+    def call_many(self, calls):
+        """ Make many calls to a `Responder` in a single request
+
+        `calls` is a sequence of (method, args) pairs. Returns a list of
+        (result, error) pairs in the same order.
+        """
+        res, err = self.call(BATCH_METHOD, *[tuple(call) for call in calls])
+        if err is not None:
+            raise ClientError(err)
+        return [tuple(pair) for pair in res]
+
+    def stats(self):
+        """ Return the stats and health of the `Responder` (see
+        `Responder.stats`) """
+        res, err = self.call(STATS_METHOD)
+        if err is not None:
+            raise ClientError(err)
+        return res
+
+
+class PipelinedRequester(Requester):
+    """ A requester client with many calls in flight on one connection
+
+    Uses a DEALER socket owned by a background I/O thread. `call_async`
+    returns a future right away and replies are matched to their calls
+    by reference, so throughput is no longer bound by the round trip
+    time. At most `max_outstanding` calls are in flight at once; further
+    calls block until a reply frees a slot.
+
+    With a receive timeout set, calls without a reply in time fail with
+    a `ClientError` and free their slot. So do calls which cannot be sent
+    right away (no connected peer with `zmq.IMMEDIATE`, or the send
+    high-water mark reached), as the I/O thread never blocks on a send.
+    """
+
+    # pylint: disable=too-many-arguments
+    # pylint: disable=no-member
+    def __init__(self, address, encoder=None, authenticator=None,
+                 socket=None, bind=False, timeouts=(None, None),
+                 multipart=False, max_outstanding=100, compat=False,
+                 tuning=None):
+        setGlobalContext()
 
-        res = self.receive()
-        assert payload[2] == res['ref']
-        return res['result'], res['error']
+        # Defaults
+        socket = socket or zmq.context.socket(zmq.DEALER)
+
+        super(PipelinedRequester, self).__init__(
+            address, encoder, authenticator, socket, bind, timeouts,
+            multipart, compat, tuning)
+
+        self.pending = {}
+        self.requests = Queue.Queue()
+        self.waker = Waker()
+        self._slots = threading.BoundedSemaphore(max_outstanding)
+        self._closed = False
+
+        # The I/O thread owns the socket, so read the timeout beforehand
+        timeout = self.socket.getsockopt(zmq.RCVTIMEO)
+        self.timeout = timeout / 1000.0 if timeout >= 0 else None
+        # (deadline, ref) of the calls sent, a heap owned by the I/O thread
+        self.deadlines = []
+
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_async(self, method, *args):
+        """ Make a call to a `Responder` and return a future
+
+        The future resolves to the same (result, error) pair `call` returns
+        """
+        return self.call_async_with(None, method, *args)
+
+    # pylint: disable=logging-format-interpolation
+    def call_async_with(self, encoder, method, *args):
+        """ `call_async` with the request encoded by `encoder` """
+
+        if self._closed:
+            raise ClientError('Requester is closed')
+
+        payload = self.build_payload(method, args)
+        logging.debug('* Client will send payload: {}'.format(payload))
+        frames = [b''] + self.pack_request(payload, encoder)
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        deadline = None if self.timeout is None else clock() + self.timeout
+        if self.metrics is not None:
+            future.add_done_callback(_record_roundtrip(self.metrics, clock()))
+
+        self._slots.acquire()
+        self.pending[payload[2]] = future
+        self.requests.put((frames, payload[2], deadline))
+        self.waker.wake()
+        return future
+
+    def call_with(self, encoder, method, *args):
+        """ Make a call with the request encoded by `encoder` and return
+        the result """
+        return self.call_async_with(encoder, method, *args).result()
+
+    def run(self):
+        """ Send queued requests and resolve the calls waiting for replies
+        (runs in the background I/O thread) """
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.waker.socket, zmq.POLLIN)
+
+        while not self._closed:
+            for socket, _ in poller.poll(self.poll_timeout()):
+                if socket is self.waker.socket:
+                    self.waker.clear()
+                    self.flush()
+                else:
+                    self.resolve(self.socket.recv_multipart(copy=False))
+            self.expire()
+
+    def poll_timeout(self):
+        """ Return the milliseconds until the next deadline, or None """
+        if not self.deadlines:
+            return None
+        return max(0, int(math.ceil((self.deadlines[0][0] - clock()) * 1e3)))
+
+    # pylint: disable=logging-format-interpolation
+    def flush(self):
+        """ Send all queued requests, failing those which cannot be sent
+        without blocking """
+        while True:
+            try:
+                frames, ref, deadline = self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self.socket.send_multipart(frames, zmq.NOBLOCK, copy=False)
+            except zmq.ZMQError as exception:
+                logging.error(
+                    'Client error while sending request: {}'
+                    .format(exception))
+                future = self.pending.pop(ref, None)
+                if future is not None:
+                    self._slots.release()
+                    future.set_exception(ClientError(
+                        'Cannot send request: {}'.format(exception)))
+                continue
+            if deadline is not None:
+                heapq.heappush(self.deadlines, (deadline, ref))
+
+    def expire(self):
+        """ Fail the calls still waiting for a reply past their deadline """
+        now = clock()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, ref = heapq.heappop(self.deadlines)
+            future = self.pending.pop(ref, None)
+            if future is not None:
+                self._slots.release()
+                future.set_exception(ClientError(
+                    'No reply within {}s'.format(self.timeout)))
+
+    # pylint: disable=logging-format-interpolation
+    def resolve(self, frames):
+        """ Resolve the call waiting for the reply in `frames` """
+        try:
+            _, frames = split_envelope(frames)
+            ref, result, error = self.unpack_response(frames)
+        except Exception as exception:
+            logging.error(
+                'Client error while reading response: {}'
+                .format(exception), exc_info=1)
+            return
+        future = self.pending.pop(ref, None)
+        if future is None:
+            # The call timed out already
+            logging.warning(
+                'Client received a reply to no pending call: {}'.format(ref))
+            return
+        self._slots.release()
+        future.set_result((result, error))
+
+    def close(self):
+        """ Stop the I/O thread, fail pending calls and close the socket """
+        if self._closed:
+            return
+        self._closed = True
+        self.waker.wake()
+        self._thread.join()
+        for ref in list(self.pending):
+            self.pending.pop(ref).set_exception(
+                ClientError('Requester closed before receiving a reply'))
+            self._slots.release()
+        self.waker.close()
+        super(PipelinedRequester, self).close()
@@ -1,7 +1,117 @@
+import zmq
 import threading
-import Queue
+import collections
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .core import Waker
+from .error import SubscriberError
+from .pubsub import Subscriber, TopicIndex
+
+# Overflow policies for a bounded SubscriberQueue
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+CONFLATE = 'conflate'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, CONFLATE)
+
+# Executors for SubscriberThread dispatch partitions
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+class SubscriberQueue(Queue.Queue):
+    """ A queue of (tag, message) pairs with an overflow policy. When the
+    queue holds maxsize items (0 is unbounded):
+
+      block        put() waits for the consumer (backpressure reaches the
+                   socket, where the zmq high water mark applies)
+      drop-oldest  the oldest queued message is discarded
+      drop-newest  the incoming message is discarded
+      conflate     only the latest message per tag is kept; maxsize limits
+                   the number of distinct tags and the oldest tag is dropped
+
+    Counters for enqueued, dropped and peak depth are kept for monitoring.
+    """
+
+    def __init__(self, maxsize=0, policy=BLOCK):
+        if policy not in POLICIES:
+            raise SubscriberError(
+                'Unknown queue policy {}, expected one of {}'.format(
+                    policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+        self.peak = 0
+        # Queue.Queue is an old style class on python 2
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        if self.policy == CONFLATE:
+            self.queue = collections.OrderedDict()
+        else:
+            self.queue = collections.deque()
+
+    def _qsize(self, len=len):  # pylint: disable=redefined-builtin
+        return len(self.queue)
+
+    def _put(self, item):
+        if self.policy == CONFLATE:
+            tag, message = item
+            self.queue[tag] = message
+        else:
+            self.queue.append(item)
+        self.enqueued += 1
+        self.peak = max(self.peak, self._qsize())
+
+    def _get(self):
+        if self.policy == CONFLATE:
+            return self.queue.popitem(last=False)
+        return self.queue.popleft()
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == BLOCK:
+            return Queue.Queue.put(self, item, block, timeout)
+
+        # The other policies never wait for space
+        with self.mutex:
+            if self.policy == CONFLATE and item[0] in self.queue:
+                # Replace the waiting message in place
+                self.dropped += 1
+                self._put(item)
+                return
+
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                self._get()
+                self.unfinished_tasks -= 1
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def stats(self):
+        """ Return the queue counters as a dict """
+        with self.mutex:
+            return {
+                'policy': self.policy,
+                'capacity': self.maxsize,
+                'depth': self._qsize(),
+                'peak': self.peak,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+            }
 
-from pubsub import Subscriber
 
 class SubscriberThread(threading.Thread):
     """ This class uses the Subscriber in a way that handles the "slow subscriber"
@@ -10,26 +120,120 @@ class SubscriberThread(threading.Thread):
     to invoke the desired callback for each message tag recieved off the queue.
     In this way all callback functions are called from the main thread and
     messages are taken off of the network stack ASAP in the background thread.
+
+    The queue is unbounded by default. Pass queue_size and queue_policy (see
+    SubscriberQueue) to bound it; stats() reports what has been dropped.
+
+    With workers > 0 handler() hands each callback to one of N single worker
+    partitions chosen by tag and returns a future. Messages with the same tag
+    are handled in order while different tags run in parallel. Pass
+    pool='process' for CPU bound callbacks; the callbacks and messages must
+    then be picklable. At most in_flight (default 2) callbacks wait or run
+    per partition: handler() blocks until one is done, so a slow callback
+    leaves the backlog in the bounded queue where its policy applies.
+
+    close() may be called from any thread: it wakes the background thread,
+    which closes its own socket, and waits for it to exit.
     """
     def __init__(self, *args, **kwargs):
         threading.Thread.__init__(self)
+        queue_size = kwargs.pop('queue_size', 0)
+        queue_policy = kwargs.pop('queue_policy', BLOCK)
+        workers = kwargs.pop('workers', 0)
+        pool = kwargs.pop('pool', 'thread')
+        in_flight = kwargs.pop('in_flight', 2)
+        if pool not in EXECUTORS:
+            raise SubscriberError(
+                'Unknown pool {}, expected one of {}'.format(
+                    pool, ', '.join(sorted(EXECUTORS))))
+        self.queue = SubscriberQueue(queue_size, queue_policy)
+        self.partitions = [EXECUTORS[pool](1) for _ in range(workers)]
+        self.slots = [threading.BoundedSemaphore(in_flight)
+                      for _ in range(workers)]
         self.subscriber = Subscriber(*args, **kwargs)
-        self.queue = Queue.Queue()
+        self.waker = Waker()
+        self._closed = False
         self.methods = {}
+        self.index = TopicIndex()
         self.daemon = True
 
         def queue(tag, message):
-            self.queue.put( (tag, message) )
+            # Wait for space (with the block policy) only while open
+            while not self._closed:
+                try:
+                    self.queue.put( (tag, message), timeout=0.1 )
+                    return
+                except Queue.Full:
+                    pass
 
         self.callback = queue
 
     def subscribe(self, tag, fun, description=None):
         self.methods[tag] = fun
+        self.index.add(tag, fun)
         self.subscriber.subscribe(tag, self.callback, description)
 
+    def unsubscribe(self, tag):
+        self.subscriber.unsubscribe(tag)
+        del self.methods[tag]
+        self.index.remove(tag)
+
+    def stats(self):
+        """ Return the enqueued, dropped and peak depth counters """
+        return self.queue.stats()
+
     def handler(self, block=True, timeout=None):
         tag, message = self.queue.get(block, timeout)
-        self.methods[tag](tag, message)
+        fun = self.index.match(tag)
+        if fun is None:
+            return None
+        if not self.partitions:
+            return fun(tag, message)
+        index = self.partition_index(tag)
+        slots = self.slots[index]
+        slots.acquire()
+        try:
+            future = self.partitions[index].submit(fun, tag, message)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def partition(self, tag):
+        """ Return the executor which handles all messages for a tag """
+        return self.partitions[self.partition_index(tag)]
+
+    def partition_index(self, tag):
+        """ Return the index of the partition of a tag """
+        return hash(tag) % len(self.partitions)
+
+    def close(self):
+        """ Stop the background thread, close the subscriber and wait for
+        dispatched callbacks """
+        if self._closed:
+            return
+        self._closed = True
+        if self.is_alive():
+            self.waker.wake()
+            self.join()
+        else:
+            self.subscriber.close()
+        self.waker.close()
+        for partition in self.partitions:
+            partition.shutdown(wait=True)
 
     def run(self):
-        self.subscriber.start()
+        poller = zmq.Poller()
+        poller.register(self.subscriber.socket, zmq.POLLIN)
+        poller.register(self.waker.socket, zmq.POLLIN)
+        try:
+            while not self._closed:
+                for socket, _ in poller.poll():
+                    if socket is self.waker.socket:
+                        self.waker.clear()
+                    else:
+                        self.subscriber.process()
+        finally:
+            # The socket belongs to this thread
+            self.subscriber.close()
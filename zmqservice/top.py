@@ -0,0 +1,207 @@
+'''
+The MIT License (MIT)
+
+Copyright (c) 2016 Tony Walker
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+# A `top` like view of a running Responder, polling its `__stats__` method
+# (answered by responders created with `expose_stats=True`):
+#
+#   zmqservice-top tcp://127.0.0.1:5555 --interval 2 --sort p99
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+import zmq
+
+from .crypto import Authenticator
+from .encoder import JSONEncoder, MsgPackEncoder, PickleEncoder
+from .reqrep import Requester
+
+ENCODERS = {
+    'pickle': PickleEncoder,
+    'msgpack': MsgPackEncoder,
+    'json': JSONEncoder,
+}
+
+# Columns of the method table: (title, key, format)
+COLUMNS = (
+    ('CALLS', 'calls', '{:>10}'),
+    ('CALLS/S', 'rate', '{:>10}'),
+    ('ERRORS', 'errors', '{:>8}'),
+    ('MEAN', 'mean', '{:>10}'),
+    ('P50', 'p50', '{:>10}'),
+    ('P99', 'p99', '{:>10}'),
+    ('MAX', 'max', '{:>10}'),
+)
+
+CLEAR = '\x1b[2J\x1b[H'
+
+
+def format_time(seconds):
+    """ Format a duration in seconds with a suitable unit """
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds >= 1.0 / scale:
+            return '{:.1f}{}'.format(seconds * scale, unit)
+    return '{:.0f}ns'.format(seconds * 1e9)
+
+
+def format_size(size):
+    """ Format a size in bytes with a suitable unit """
+    if size is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '{:.0f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}T'.format(size)
+
+
+def render(stats, previous=None, sort='calls'):
+    """ Return the text showing `stats`, with call rates computed against
+    the `previous` stats if given """
+    counters = stats['counters']
+    lines = [
+        'pid {}  uptime {:.0f}s  rss {}  in {}  out {}'.format(
+            stats['pid'], stats['uptime'], format_size(stats['rss']),
+            format_size(counters.get('bytes_in')),
+            format_size(counters.get('bytes_out'))),
+        'queues {}'.format(', '.join(
+            '{} {}'.format(name, depth)
+            for name, depth in sorted(stats['queues'].items())) or '-'),
+    ]
+    if not stats['metrics']:
+        lines.append('metrics disabled: call enable_metrics() on the '
+                     'service for per-method numbers')
+
+    elapsed = previous and stats['uptime'] - previous['uptime']
+    rows = []
+    for name, method in stats['methods'].items():
+        row = dict(method)
+        if elapsed:
+            before = previous['methods'].get(name, {}).get('calls', 0)
+            row['rate'] = (method['calls'] - before) / elapsed
+        else:
+            row['rate'] = None
+        rows.append((name, row))
+    rows.sort(key=lambda item: item[1].get(sort) or 0, reverse=True)
+
+    lines.append('')
+    lines.append('{:<24}'.format('METHOD') + ''.join(
+        fmt.format(title) for title, _, fmt in COLUMNS))
+    for name, row in rows:
+        cells = []
+        for _, key, fmt in COLUMNS:
+            value = row.get(key)
+            if key in ('calls', 'errors'):
+                value = str(value)
+            elif key == 'rate':
+                value = '-' if value is None else '{:.1f}'.format(value)
+            else:
+                value = format_time(value)
+            cells.append(fmt.format(value))
+        lines.append('{:<24}'.format(name[:24]) + ''.join(cells))
+
+    stages = stats['stages']
+    if stages:
+        lines.append('')
+        lines.append('{:<24}{:>10}{:>10}{:>10}'.format(
+            'STAGE', 'COUNT', 'P50', 'P99'))
+        for name in sorted(stages):
+            stage = stages[name]
+            lines.append('{:<24}{:>10}{:>10}{:>10}'.format(
+                name, stage['count'], format_time(stage['p50']),
+                format_time(stage['p99'])))
+    return '\n'.join(lines)
+
+
+def parse_args(argv):
+    """ Parse the command line """
+    parser = argparse.ArgumentParser(
+        prog='zmqservice-top',
+        description='Show the live stats of a running Responder')
+    parser.add_argument('address', help='address of the service')
+    parser.add_argument('-i', '--interval', type=float, default=2.0,
+                        help='seconds between updates (default: 2)')
+    parser.add_argument('-n', '--iterations', type=int, default=0,
+                        help='number of updates, 0 to run until '
+                             'interrupted (default: 0)')
+    parser.add_argument('-s', '--sort', default='calls',
+                        choices=[key for _, key, _ in COLUMNS],
+                        help='column to sort methods by (default: calls)')
+    parser.add_argument('-e', '--encoder', default='pickle',
+                        choices=sorted(ENCODERS),
+                        help='encoder of the service (default: pickle)')
+    parser.add_argument('--secret', help='authenticator secret')
+    parser.add_argument('--multipart', action='store_true',
+                        help='the service uses multipart messages')
+    parser.add_argument('--compat', action='store_true',
+                        help='the service uses the compat request format')
+    parser.add_argument('--timeout', type=int, default=5000,
+                        help='milliseconds to wait for a reply '
+                             '(default: 5000)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Entry point of zmqservice-top """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    authenticator = Authenticator(args.secret) if args.secret else None
+    requester = Requester(
+        args.address, ENCODERS[args.encoder](), authenticator,
+        timeouts=(args.timeout, args.timeout), multipart=args.multipart,
+        compat=args.compat)
+
+    previous = None
+    iteration = 0
+    try:
+        while True:
+            try:
+                stats = requester.stats()
+            except zmq.Again:
+                print('No reply from {} within {}ms'.format(
+                    args.address, args.timeout), file=sys.stderr)
+                return 1
+            text = render(stats, previous, args.sort)
+            if args.iterations != 1:
+                text = CLEAR + text
+            print(text)
+            sys.stdout.flush()
+
+            iteration += 1
+            if args.iterations and iteration >= args.iterations:
+                return 0
+            previous = stats
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        requester.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+'''
+The MIT License (MIT)
+
+Copyright (c) 2016 Tony Walker
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import logging
+
+import zmq
+
+from .error import ConfigError
+
+
+# Socket options a tuning may set, by their lower case zmq names.
+# Send and receive timeouts are set with the `timeouts` of endpoints.
+SOCKET_OPTIONS = (
+    'sndhwm', 'rcvhwm', 'sndbuf', 'rcvbuf', 'linger', 'immediate',
+    'reconnect_ivl', 'reconnect_ivl_max', 'backlog', 'maxmsgsize',
+    'tcp_keepalive', 'tcp_keepalive_idle', 'tcp_keepalive_intvl',
+    'tcp_keepalive_cnt', 'handshake_ivl', 'heartbeat_ivl',
+    'heartbeat_timeout', 'heartbeat_ttl', 'tos', 'affinity', 'conflate',
+)
+
+# Named tunings. A tuning may start from another one with a `profile` key
+PROFILES = {
+    # zmq defaults, besides the linger set by endpoints
+    'default': {},
+    # Small queues, no queueing towards peers which are not connected yet,
+    # and fast detection of lost peers
+    'low-latency': {
+        'sndhwm': 1000,
+        'rcvhwm': 1000,
+        'immediate': 1,
+        'reconnect_ivl': 10,
+        'reconnect_ivl_max': 1000,
+        'tcp_keepalive': 1,
+        'tcp_keepalive_idle': 10,
+        'tcp_keepalive_intvl': 5,
+        'tcp_keepalive_cnt': 3,
+    },
+    # Deep queues and larger kernel buffers so bursts are absorbed
+    'high-throughput': {
+        'sndhwm': 100000,
+        'rcvhwm': 100000,
+        'sndbuf': 4 * 1024 * 1024,
+        'rcvbuf': 4 * 1024 * 1024,
+        'backlog': 1024,
+        'tcp_keepalive': 1,
+    },
+    # Large transfers: everything is queued and sent before closing (a
+    # lingering endpoint is not unbound on close, see `Endpoint.close`)
+    'bulk': {
+        'sndhwm': 0,
+        'rcvhwm': 0,
+        'sndbuf': 16 * 1024 * 1024,
+        'rcvbuf': 16 * 1024 * 1024,
+        'linger': 30000,
+        'tcp_keepalive': 1,
+    },
+}
+
+
+def register_profile(name, options):
+    """ Add (or replace) a named tuning profile
+
+    `options` maps socket options (see SOCKET_OPTIONS) to values and may
+    name a `profile` to start from.
+    """
+    PROFILES[name] = dict(options)
+    # Fail now rather than when an endpoint uses it
+    resolve(name)
+
+
+def resolve(tuning, _seen=()):
+    """ Return the socket options of a tuning: a profile name, a dict of
+    options (which may name a `profile` to start from) or None """
+    if tuning is None:
+        return {}
+    if not isinstance(tuning, dict):
+        if tuning not in PROFILES:
+            raise ConfigError('Unknown tuning profile: {}'.format(tuning))
+        if tuning in _seen:
+            raise ConfigError(
+                'Tuning profile {} refers to itself'.format(tuning))
+        return resolve(PROFILES[tuning], _seen + (tuning,))
+
+    options = dict(tuning)
+    base = options.pop('profile', None)
+    for name in options:
+        if name not in SOCKET_OPTIONS:
+            raise ConfigError('Unknown socket option: {}'.format(name))
+    resolved = resolve(base, _seen) if base is not None else {}
+    resolved.update(options)
+    return resolved
+
+
+def apply(socket, tuning, logger=None):
+    """ Set the socket options of a tuning on a zmq socket
+
+    Options take effect for connections made afterwards, so this is done
+    before binding or connecting. Options unknown to the installed zmq
+    are skipped.
+    """
+    for name, value in sorted(resolve(tuning).items()):
+        option = getattr(zmq, name.upper(), None)
+        if option is None:
+            (logger or logging.getLogger()).debug(
+                'Socket option {} is not supported, skipped'.format(name))
+            continue
+        socket.setsockopt(option, value)